@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Ce module secondaire définit le cache des réponses des archives: les
+# réponses des requêtes TAP de CADC (CFHT) et des formulaires du WDB d'ESO sont
+# gardées compressées (gzip) dans le dossier .query_cache du dossier de
+# travail. Une même requête relancée pour la même cible, ou la même
+# recherche de calibrations pour une nuit déjà vue, est alors lue sur le disque
+# sans rien demander à l'archive.
+#
+# Chaque réponse est rangée sous l'empreinte (sha1) de la requête normalisée:
+# l'url et ses paramètres triés, les espaces de trop retirés. Une réponse plus
+# vieille que cache_ttl est redemandée, et les réponses les moins récemment lues
+# sont effacées quand le cache dépasse cache_max_size.
+
+################### On va importer les modules standards ########################
+
+import os
+import gzip
+import time
+import hashlib
+import logging
+import threading
+import requests
+
+########################## Paramètres de départ #################################
+
+directory = os.getcwd()
+use_cache = True
+cache_directory = directory+'/.query_cache'
+cache_ttl = 7*24*3600. # secondes avant de redemander une réponse
+cache_max_size = 500*1024*1024 # octets, au-delà on efface les plus anciennes
+cache_low_water = 0.8 # l'éviction descend à cette fraction de cache_max_size
+
+# Taille totale du cache, mesurée une seule fois puis tenue à jour à chaque
+# écriture: le dossier n'est parcouru de nouveau que lors d'une éviction.
+_size_lock = threading.Lock()
+_cache_size = None
+
+############################ Clé d'une requête ##################################
+
+# Les requêtes ADQL sont construites avec des retours à la ligne et des
+# indentations différentes d'un module à l'autre: on ne garde qu'un espace.
+
+def normalize_value(value):
+
+    if not isinstance(value, basestring):
+        value = str(value)
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+
+    return ' '.join(value.split())
+
+def query_key(url,params=None):
+
+    items = sorted((normalize_value(k), normalize_value(v))
+                   for k, v in (params or {}).items())
+    text = normalize_value(url)+'?'+'&'.join(k+'='+v for k, v in items)
+
+    return hashlib.sha1(text).hexdigest()
+
+def cache_path(key):
+    return cache_directory+'/'+key[:2]+'/'+key+'.gz'
+
+############################ Lecture et écriture ################################
+
+# La date de modification du fichier est celle de la réponse (pour cache_ttl),
+# la date d'accès celle de la dernière lecture (pour l'éviction).
+
+def read_cached(key,ttl=None):
+
+    if ttl is None:
+        ttl = cache_ttl
+    path = cache_path(key)
+    try:
+        mtime = os.path.getmtime(path)
+        if time.time() - mtime > ttl:
+            return None
+        with gzip.open(path, 'rb') as f:
+            body = f.read()
+        os.utime(path, (time.time(), mtime))
+    except (IOError, OSError, EOFError):
+        return None
+
+    return body
+
+# Écriture dans un fichier temporaire propre au thread puis renommage: une
+# réponse n'est jamais lue à moitié écrite.
+
+def write_cached(key,body):
+
+    path = cache_path(key)
+    if not os.path.exists(os.path.dirname(path)):
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError:
+            pass # créé entre-temps par un autre thread
+
+    part = path+'.'+str(os.getpid())+'.'+str(threading.current_thread().ident)
+    with gzip.open(part, 'wb') as f:
+        f.write(body)
+    size = os.path.getsize(part)
+    old = os.path.getsize(path) if os.path.exists(path) else 0
+    os.rename(part, path)
+
+    if add_size(size-old) > cache_max_size:
+        evict_cache()
+
+# Réponse illisible: on l'efface pour la redemander
+
+def drop_cached(key):
+
+    path = cache_path(key)
+    try:
+        size = os.path.getsize(path)
+        os.remove(path)
+    except OSError:
+        return
+    add_size(-size)
+
+############################## Éviction ########################################
+
+# Réponses du cache: liste de (date d'accès, taille, fichier)
+
+def scan_cache():
+
+    files = []
+    for root, dirs, names in os.walk(cache_directory):
+        for name in names:
+            if not name.endswith('.gz'):
+                continue
+            path = os.path.join(root, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            files.append((st.st_atime, st.st_size, path))
+
+    return files
+
+# Ajoute delta octets à la taille du cache (mesurée au premier appel) et
+# renvoie la nouvelle taille
+
+def add_size(delta):
+
+    global _cache_size
+    with _size_lock:
+        if _cache_size is None:
+            _cache_size = sum(size for (atime, size, path) in scan_cache())
+        else:
+            _cache_size += delta
+
+        return _cache_size
+
+# Efface les réponses les moins récemment lues jusqu'à repasser sous
+# cache_low_water*max_size octets: l'éviction libère assez de place pour ne
+# pas revenir à chaque écriture.
+
+def evict_cache(max_size=None):
+
+    global _cache_size
+    if max_size is None:
+        max_size = cache_max_size
+
+    with _size_lock:
+        files = scan_cache()
+        total = sum(size for (atime, size, path) in files)
+        if total <= max_size:
+            _cache_size = total
+            return 0
+
+        removed = 0
+        for (atime, size, path) in sorted(files):
+            if total <= cache_low_water*max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+        _cache_size = total
+
+    logging.info(str(removed)+" responses evicted from the query cache")
+
+    return removed
+
+############################## Requêtes ########################################
+
+# GET avec cache. parse(body) lit la réponse (tableau pandas, etc.) et lève
+# une exception si elle n'est pas lisible: une page d'erreur ou de maintenance
+# servie avec le code 200 n'est donc jamais gardée, et une réponse gardée qui
+# ne se lit plus est effacée puis redemandée. Renvoie parse(body), ou le
+# contenu brut sans parse. Une erreur HTTP est levée comme par
+# raise_for_status. session peut être une requests.Session ou le module
+# requests lui-même.
+
+def cached_get(url,params=None,session=requests,timeout=None,ttl=None,
+               parse=None):
+
+    if parse is None:
+        parse = lambda body: body
+
+    key = query_key(url,params)
+    if use_cache:
+        body = read_cached(key,ttl)
+        if body is not None:
+            try:
+                result = parse(body)
+            except Exception as e:
+                logging.warning("Unreadable response dropped from the query "
+                                "cache ("+key+": "+str(e)+")")
+                drop_cached(key)
+            else:
+                logging.debug("Response read from the query cache ("+key+")")
+                return result
+
+    r = session.get(url, params=params, timeout=timeout)
+    r.raise_for_status()
+    result = parse(r.content)
+
+    if use_cache:
+        try:
+            write_cached(key,r.content)
+        except (IOError, OSError) as e:
+            logging.warning("Response not cached ("+str(e)+")")
+
+    return result
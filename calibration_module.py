@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Ce module secondaire définit l'index local des calibrations (BIAS, DARK et
+# FLAT) de CFHT et d'ESO: une base SQLite (calibrations.sqlite dans le dossier
+# de travail) partagée par toutes les cibles. Les calibrations y sont rangées
+# par archive, instrument, type (BIAS/DARK ou FLAT) et filtre (pour les flats),
+# et la base garde la liste des nuits déjà demandées à l'archive.
+#
+# Une nuit est le jour MJD entier: int(MJD). Une recherche de calibrations ne
+# demande à l'archive que les nuits absentes de l'index; le choix des N
+# calibrations les plus proches de chaque image se fait ensuite localement,
+# par une recherche par intervalle dans la base.
+
+################### On va importer les modules standards ########################
+
+import os
+import math
+import time
+import logging
+import sqlite3
+import threading
+import pandas as pd
+
+########################## Paramètres de départ #################################
+
+directory = os.getcwd()
+index_file = directory+'/calibrations.sqlite'
+recent_nights = 30 # nuits récentes (jours) redemandées: l'archive peut encore
+                   # recevoir des calibrations
+
+_lock = threading.Lock()
+_db = {}
+
+MJD_UNIX = 40587.0 # MJD du 1er janvier 1970
+
+############################## Base SQLite ######################################
+
+# Une seule connexion par fichier, partagée par tous les threads (cibles et
+# archives en parallèle): les accès sont protégés par _lock.
+
+def open_index(path=None):
+
+    if path is None:
+        path = index_file
+
+    with _lock:
+        if path in _db:
+            return _db[path]
+
+        db = sqlite3.connect(path, check_same_thread=False)
+        db.text_factory = str
+        db.execute('''CREATE TABLE IF NOT EXISTS frames (
+                      archive TEXT NOT NULL,
+                      instrument TEXT NOT NULL,
+                      kind TEXT NOT NULL,
+                      filter TEXT NOT NULL,
+                      dataset TEXT NOT NULL,
+                      name TEXT,
+                      type TEXT,
+                      start REAL,
+                      end REAL,
+                      PRIMARY KEY (archive, instrument, kind, filter,
+                                   dataset))''')
+        db.execute('''CREATE INDEX IF NOT EXISTS frames_start
+                      ON frames (archive, instrument, kind, filter, start)''')
+        db.execute('''CREATE TABLE IF NOT EXISTS nights (
+                      archive TEXT NOT NULL,
+                      instrument TEXT NOT NULL,
+                      kind TEXT NOT NULL,
+                      filter TEXT NOT NULL,
+                      night INTEGER NOT NULL,
+                      PRIMARY KEY (archive, instrument, kind, filter,
+                                   night))''')
+        db.commit()
+        _db[path] = db
+
+    return db
+
+################################ Nuits ##########################################
+
+# key: (archive, instrument, kind, filter); filter vaut '' pour BIAS/DARK
+
+def night(mjd):
+    return int(math.floor(mjd))
+
+def known_nights(db,key,first,last):
+
+    with _lock:
+        rows = db.execute('SELECT night FROM nights WHERE archive = ? AND '
+                          'instrument = ? AND kind = ? AND filter = ? AND '
+                          'night BETWEEN ? AND ?',
+                          tuple(key)+(first, last)).fetchall()
+
+    return set(n for (n,) in rows)
+
+# Nuits touchées par la fenêtre [lo, hi]
+
+def window_nights(lo,hi):
+    return range(night(lo), max(night(lo)+1, int(math.ceil(hi))))
+
+# Nuits des fenêtres [lo, hi] absentes de l'index, regroupées en suites de
+# nuits consécutives (au plus max_span nuits): [(première, dernière)]
+
+def missing_ranges(db,key,windows,max_span=None):
+
+    nights = set()
+    for lo, hi in windows:
+        first = night(lo)
+        last = night(hi)
+        nights.update(set(range(first, last+1))
+                      - known_nights(db,key,first,last))
+
+    ranges = []
+    for n in sorted(nights):
+        if (ranges and n == ranges[-1][1]+1 and
+            (max_span is None or n - ranges[-1][0] < max_span)):
+            ranges[-1][1] = n
+        else:
+            ranges.append([n, n])
+
+    return [(first, last) for first, last in ranges]
+
+# Ajoute les calibrations lues pour les nuits first..last. rows: liste de
+# (dataset, name, type, start, end). Les nuits récentes et celles de
+# incomplete (réponse tronquée par l'archive) ne sont pas notées comme
+# complètes: elles seront redemandées.
+
+def add_nights(db,key,first,last,rows,incomplete=()):
+
+    today = night(time.time()/86400.0 + MJD_UNIX)
+    last_complete = min(last, today - recent_nights)
+
+    with _lock:
+        db.executemany('INSERT OR REPLACE INTO frames (archive, instrument, '
+                       'kind, filter, dataset, name, type, start, end) '
+                       'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                       [tuple(key)+tuple(row) for row in rows])
+        db.executemany('INSERT OR IGNORE INTO nights (archive, instrument, '
+                       'kind, filter, night) VALUES (?, ?, ?, ?, ?)',
+                       [tuple(key)+(n,)
+                        for n in range(first, last_complete+1)
+                        if n not in incomplete])
+        db.commit()
+
+############################ Recherche locale ###################################
+
+# Calibrations de l'index qui touchent les fenêtres [lo, hi], sous forme de
+# tableau pandas. columns donne les noms des colonnes (dataset, name, type,
+# start, end) attendus par le module de l'archive; une colonne None est omise.
+
+def calibration_table(db,key,windows,columns):
+
+    rows = []
+    with _lock:
+        for lo, hi in windows:
+            rows.extend(db.execute('SELECT dataset, name, type, start, end '
+                                   'FROM frames WHERE archive = ? AND '
+                                   'instrument = ? AND kind = ? AND '
+                                   'filter = ? AND start <= ? AND '
+                                   'COALESCE(end, start) >= ?',
+                                   tuple(key)+(hi, lo)).fetchall())
+
+    table = pd.DataFrame(rows, columns=['dataset','name','type','start',
+                                        'end'])
+    table = table.drop_duplicates('dataset').reset_index(drop=True)
+    table.columns = columns
+    table = table[[c for c in columns if c is not None]]
+
+    return table
@@ -22,10 +22,19 @@ import requests
 import numpy as np
 import pandas as pd
 from getpass import getpass
+from multiprocessing.pool import ThreadPool
 from tqdm import tqdm
-from astroquery.simbad import Simbad as sd
 from requests.auth import HTTPBasicAuth
 
+###################### Importation des modules personnels ####################
+
+import cache_module as cache
+import calibration_module as calibration
+import download_module as download
+import manifest_module as manifest
+import results_module as results
+import simbad_module as simbad
+
 ########################## Paramètres de départ #################################
 
 # Comme son nom indique, on va définir les paramètres de départ, soit le nom de
@@ -241,86 +250,179 @@ def query_object_2(obj_center,Ra_box,DEC_box,inst):
     
     return query
 
-##################### Searching Scientific Images #################################
+######################### Requêtes TAP concurrentes ##############################
 
-# -------------------- Cas sphérical search box ---------------------
+# Chaque requête TAP attend surtout la réponse du serveur de CADC. Les requêtes
+# des différents instruments sont donc envoyées en parallèle par un pool de
+# threads qui partagent une même session HTTP (connexions gardées ouvertes). La
+# durée de la recherche devient celle de la requête la plus lente.
 
-def cfht_search_images(obj_center,Sphere_Radius,tap_url):
-    
-    ############################## Instrument MEGAPRIME #####################
-    
-    logging.info("Searching in MegaPrime")
+CFHT_INSTRUMENTS = ["MegaPrime","WIRCam","CFH12K","UH8K"]
+tap_timeout = 300 # secondes, par requête
+tap_workers = 4 # requêtes TAP simultanées au maximum
+
+tap_session = requests.Session()
+tap_session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=8))
+tap_session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=8))
+
+# On veut passer des paramètres dans les URLs. Le module Requests permet de
+# fournir ces arguments sous forme de dictionnaire, en utilisant l’argument
+# params. Les données sont récupérées sous forme de tableau pandas. Une requête
+# déjà faite est relue dans le cache des réponses (cache_module).
+
+# Une page html ou un VOTable d'erreur servi avec le code 200 lève ValueError et
+# n'est pas gardé dans le cache.
+
+def parse_tap(rawTable):
+
+    if rawTable.lstrip().startswith(b'<'):
+        raise ValueError("TAP response is not a CSV table")
+
+    return pd.read_csv(io.StringIO(rawTable.decode('utf-8')), header=0)
+
+# maxrec: nombre maximal de lignes renvoyées (limite par défaut de CADC sinon)
+
+def tap_query(tap_url,query,timeout=tap_timeout,maxrec=None):
 
-    # On veut passer des paramètres dans les URLs. Le module Requests permet de
-    # fournir ces arguments sous forme de dictionnaire, en utilisant l’argument
-    # params.
-        
     payload = {'REQUEST': 'doQuery', 'LANG': 'ADQL', 'FORMAT': 'CSV',
-               'QUERY':query_object(obj_center,Sphere_Radius,"MegaPrime")}
-                                                                     
-    rawTable = requests.get(tap_url, params=payload).content
+               'QUERY': query}
+    if maxrec is not None:
+        payload['MAXREC'] = str(maxrec)
 
-    # On récupère les données sous forme de tableau en utilisant le module pandas
+    return cache.cached_get(tap_url, params=payload, session=tap_session,
+                            timeout=timeout, parse=parse_tap)
 
-    Table_obs = pd.read_csv(io.StringIO(rawTable.decode('utf-8')), header=0)
+# queries: liste de (instrument, requête). Renvoie {instrument: tableau}.
 
-    # ---------------- Recherche des images ayant pas de noms défini ------------
+def query_instruments(tap_url,queries,timeout=tap_timeout):
 
-    # Certaines images, récent ou pas, n'ont pas de noms propres (NaN). Ils
-    # peuvent être important à les étudier. Pour les intégrer dans la recherche,
-    # il faut leur changer de noms
+    logging.info("Querying "+", ".join(inst for inst, query in queries)
+                 +" in parallel")
 
-    logging.info("Searching for unnamed objects present in MegaPrime")
+    pool = ThreadPool(len(queries))
+    try:
+        tables = pool.map(lambda q: tap_query(tap_url,q[1],timeout), queries)
+    finally:
+        pool.close()
+        pool.join()
 
-    null_columns = Table_obs.columns[Table_obs.isnull().any()]
-    # On recherche dans le tableau, les colonnes où il y a des éléments vides et
-    # on fait le compte
+    return dict((inst, table) for (inst, query), table in zip(queries, tables))
 
 
-    counter = 0
-    for f in Table_obs['"Target Name"'].isnull():
-        if f ==True:
-            counter +=1
+######################## Requête unique pour CFHT ################################
 
-    #print counter
-    #print Table_obs
-    #sys.exit("test 2.2")
+# Les requêtes des instruments ne diffèrent que par la liste des noms
+# d'instruments et par la marge du champ de vue. On peut donc tout demander en
+# une seule requête TAP: la condition WHERE est un OU des empreintes de chaque
+# instrument, et la colonne "Instrument" permet de séparer le résultat
+# localement. Si le résultat atteint la limite TOP, on revient aux requêtes
+# par instrument (en parallèle).
 
-    if counter != 0:
-        logging.info("There are "+str(counter)+" unnamed images found")
-        c = 0
-        # On fait le changement
-        N = len(Table_obs['"Target Name"'])
-        for it, i in enumerate(Table_obs['"Target Name"']):
-            update_process(N,it)
-            for ft, f in enumerate(Table_obs['"Target Name"'].isnull()):
-                if f ==True:
-                    if it == ft:
-                        c +=1
-                        Table_obs.loc[it, '"Target Name"'] = "unnamed_obj_"+str(c)
-            # La dernière ligne permet de changer les valeurs d'un tableau
-            # en évitant l'erreur SettingWithCopyWarning.
-        logging.info(st(c)+" unnamed images have been named")
-    else:
-        logging.info("No unnamed image has been found")
+# Noms dans la colonne instrument_name et champ de vue (deg) de chaque
+# instrument, comme dans query_object
+CFHT_FOOTPRINTS = {"MegaPrime": (['MegaPrime'], 0.95),
+                   "WIRCam": (['WIRCam'], 0.36),
+                   "UH8K": (['UH8K','UH8K MOSAIC CAMERA'], 0.48),
+                   "CFH12K": (['CFH12K MOSAIC'], 0.7)}
 
-    # ------ Effacer les objets mal identifiés et callibration des images -------
+CFHT_TOP = 10000 # lignes max par instrument
 
-    # Certains observations de type BIAS, DARK ou FLAT sont marqués comme OBJECT.
-    # Ces objects doivent être retirés.
+# Rwidth et Dwidth: largeur de la boîte sans le champ de vue (Sphere_Radius
+# pour le cas sphérique, Ra_box et DEC_box pour le cas rectangulaire)
 
-    if len(Table_obs) != 0:
-        wrong_objects = np.where(map(
-                                     lambda x: "BIAS" in x or "FLAT" in x or
-                                     "DARK" in x, Table_obs['"Target Name"']))[0]
+def query_all_objects(obj_center,Rwidth,Dwidth,insts):
+
+    footprints = []
+    for inst in insts:
+        (names, fov) = CFHT_FOOTPRINTS[inst]
+        footprints.append(
+            '''( INTERSECTS( RANGE_S2D({},{},{},{}), Plane.position_bounds ) = 1 \
+            AND Observation.instrument_name IN ( {} ) )'''.format(
+                obj_center[0]-0.5*(Rwidth+fov), obj_center[0]+0.5*(Rwidth+fov),
+                obj_center[1]-0.5*(Dwidth+fov), obj_center[1]+0.5*(Dwidth+fov),
+                ",".join("'{0}'".format(n) for n in names)))
+
+    # Voir ADQL dans le site de cadc:/
+    string_0 = '''SELECT TOP {} Plane.planeURI AS "Plane URI",\
+        Plane.productID AS "Product ID", \
+        Observation.instrument_name AS "Instrument",\
+        Plane.time_bounds_lower AS "Start Date",\
+        Plane.time_exposure AS "Int. Time",\
+        Plane.energy_bandpassName AS "Filter",\
+        Observation.target_name AS "Target Name",\
+        Plane.dataProductType AS "Data Type" \
+        FROM caom2.Plane AS Plane \
+        JOIN caom2.Observation AS Observation ON Plane.obsID =
+        Observation.obsID \
+        WHERE ( ( '''.format(CFHT_TOP*len(insts))
+
+    string_2 = ''' ) \
+        AND Observation.type = 'OBJECT' \
+        AND  ( Plane.quality_flag IS NULL OR Plane.quality_flag !=
+        'junk' ) )'''
+
+    query = string_0+' OR '.join(footprints)+string_2
 
-        # On veut avoir que des images callibrées (finit par *******p)
-        cond_megaprime = np.where(np.array(
-                                    [s[-1:] for s in Table_obs['"Product ID"']]
-                                       ) == 'p')[0]
-        if len(wrong_objects) != 0:
-            cond_megaprime = np.setdiff1d(cond_megaprime, wrong_objects)
+    return query
+
+# Sépare le résultat de la requête unique en un tableau par instrument
+
+def split_instruments(Table_obs,insts):
+
+    tables = {}
+    for inst in insts:
+        (names, fov) = CFHT_FOOTPRINTS[inst]
+        rows = Table_obs['"Instrument"'].isin(names).values
+        tables[inst] = Table_obs[rows].reset_index(drop=True)
+
+    return tables
+
+# queries: requêtes par instrument, utilisées si la requête unique est tronquée
+
+def cfht_object_tables(tap_url,obj_center,Rwidth,Dwidth,queries):
+
+    insts = [inst for inst, query in queries]
+    logging.info("Querying "+", ".join(insts)+" in a single request")
+
+    Table_obs = tap_query(tap_url, query_all_objects(obj_center,Rwidth,Dwidth,
+                                                     insts))
+    if len(Table_obs) >= CFHT_TOP*len(insts):
+        logging.info("Single request truncated, querying each instrument")
+        return query_instruments(tap_url, queries)
+
+    return split_instruments(Table_obs, insts)
+
+
+##################### Searching Scientific Images #################################
 
+# -------------------- Cas sphérical search box ---------------------
+
+def cfht_search_images(obj_center,Sphere_Radius,tap_url):
+    
+    # Une seule requête pour les 4 instruments
+    tables = cfht_object_tables(tap_url,obj_center,Sphere_Radius,Sphere_Radius,
+                                [(inst, query_object(obj_center,Sphere_Radius,
+                                                     inst))
+                                 for inst in CFHT_INSTRUMENTS])
+
+    ############################## Instrument MEGAPRIME #####################
+    
+    logging.info("Searching in MegaPrime")
+
+    Table_obs = tables.pop("MegaPrime")
+
+    # ------- Images sans nom, calibrations et images non calibrées ----------
+
+    # Les images sans nom (NaN) sont renommées unnamed_obj_N; les observations
+    # BIAS, DARK ou FLAT marquées comme OBJECT sont retirées et on ne garde que
+    # les images calibrées (Product ID en *******p).
+
+    cond_megaprime = results.normalize_results(Table_obs,"MegaPrime",
+                                               '"Target Name"',
+                                               drop_calibrations=True,
+                                               suffix_column='"Product ID"')
+
+    if len(Table_obs) != 0:
         planeURI_megaprime = Table_obs['"Plane URI"'][cond_megaprime]
 
         N_megaprime = len(planeURI_megaprime)
@@ -339,70 +441,20 @@ def cfht_search_images(obj_center,Sphere_Radius,tap_url):
 
     logging.info("Searching in WIRCam")
 
-    # On veut passer des paramètres dans les URLs. Le module Requests permet de
-    # fournir ces arguments sous forme de dictionnaire, en utilisant l’argument
-    # params.
+    Table_obs = tables.pop("WIRCam")
 
-    payload = {'REQUEST': 'doQuery', 'LANG': 'ADQL', 'FORMAT': 'CSV',
-               'QUERY':query_object(obj_center,Sphere_Radius,"WIRCam")}
-
-    rawTable = requests.get(tap_url, params=payload).content
-
-    # On récupère les données sous forme de tableau en utilisant le module pandas
-
-    Table_obs = pd.read_csv(io.StringIO(rawTable.decode('utf-8')), header=0)
-
-    # ---------------- Recherche des images ayant pas de noms défini -------------
-
-    # Certaines images, récent ou pas, n'ont pas de noms propres (NaN). Ils
-    # peuvent être important à les étudier. Pour les intégrer dans la recherche,
-    # il faut leur changer de noms
-
-    logging.info("Searching for unnamed objects present in WIRCam")
-
-    null_columns = Table_obs.columns[Table_obs.isnull().any()]
-    # On recherche dans le tableau, les colonnes où il y a des éléments vides et
-    # on fait le compte
-
-    counter = 0
-    for f in Table_obs['"Target Name"'].isnull():
-        if f ==True:
-            counter +=1
-
-    if counter != 0:
-        logging.info("There are "+str(counter)+" unnamed images found")
-        c = 0
-        # On fait le changement
-        N = len(Table_obs['"Target Name"'])
-        for it, i in enumerate(Table_obs['"Target Name"']):
-            update_process(N,it)
-            for ft, f in enumerate(Table_obs['"Target Name"'].isnull()):
-                if f ==True:
-                    if it == ft:
-                        c +=1
-                        Table_obs.loc[it, '"Target Name"'] = "unnamed_obj_"+str(c)
-        # La dernière ligne permet de changer les valeurs d'un tableau
-        # en évitant l'erreur SettingWithCopyWarning.
-        logging.info(str(c)+" unnamed images have been named")
-    else:
-        logging.info("No unnamed image has been found")
+    # ------- Images sans nom, calibrations et images non calibrées ----------
 
-    # ------ Effacer les objets mal identifiés et callibration des images --------
+    # Les images sans nom (NaN) sont renommées unnamed_obj_N; les observations
+    # BIAS, DARK ou FLAT marquées comme OBJECT sont retirées et on ne garde que
+    # les images calibrées (Product ID en *******p).
 
-    # Certains observations de type BIAS, DARK ou FLAT sont marqués comme OBJECT.
-    # Ces objects doivent être retirés.
+    cond_wircam = results.normalize_results(Table_obs,"WIRCam",
+                                            '"Target Name"',
+                                            drop_calibrations=True,
+                                            suffix_column='"Product ID"')
 
     if len(Table_obs) != 0:
-        wrong_objects = np.where(map(
-                                 lambda x: "BIAS" in x or "FLAT" in x or "DARK" in
-                                 x, Table_obs['"Target Name"']))[0]
-        # On veut avoir que des images callibrées (finit par *******p)
-        cond_wircam = np.where(np.array(
-                                    [s[-1:] for s in Table_obs['"Product ID"']]
-                                    ) == 'p')[0]
-        if len(wrong_objects) != 0:
-            cond_wircam = np.setdiff1d(cond_wircam, wrong_objects)
-                                                                    
         planeURI_wircam = Table_obs['"Plane URI"'][cond_wircam]
                                                                     
         N_wircam = len(planeURI_wircam)
@@ -421,70 +473,20 @@ def cfht_search_images(obj_center,Sphere_Radius,tap_url):
 
     logging.info("Searching in CFH12K")
 
-    # On veut passer des paramètres dans les URLs. Le module Requests permet de
-    # fournir ces arguments sous forme de dictionnaire, en utilisant l’argument
-    # params.
+    Table_obs = tables.pop("CFH12K")
 
-    payload = {'REQUEST': 'doQuery', 'LANG': 'ADQL', 'FORMAT': 'CSV',
-               'QUERY':query_object(obj_center,Sphere_Radius,"CFH12K")}
-
-    rawTable = requests.get(tap_url, params=payload).content
-
-    # On récupère les données sous forme de tableau en utilisant le module pandas
-
-    Table_obs = pd.read_csv(io.StringIO(rawTable.decode('utf-8')), header=0)
-
-    # ---------------- Recherche des images ayant pas de noms défini -------------
-
-    # Certaines images, récent ou pas, n'ont pas de noms propres (NaN). Ils
-    # peuvent être important à les étudier. Pour les intégrer dans la recherche,
-    # il faut leur changer de noms
-
-    logging.info("Searching for unnamed objects present in CFH12K")
-
-    null_columns = Table_obs.columns[Table_obs.isnull().any()]
-    # On recherche dans le tableau, les colonnes où il y a des éléments vides et
-    # on fait le compte
-
-    counter = 0
-    for f in Table_obs['"Target Name"'].isnull():
-        if f ==True:
-            counter +=1
-
-    if counter != 0:
-        logging.info("There are "+str(counter)+" unnamed images found")
-        c = 0
-        # On fait le changement
-        N = len(Table_obs['"Target Name"'])
-        for it, i in enumerate(Table_obs['"Target Name"']):
-            update_process(N,it)
-            for ft, f in enumerate(Table_obs['"Target Name"'].isnull()):
-                if f ==True:
-                    if it == ft:
-                        c +=1
-                        Table_obs.loc[it, '"Target Name"'] = "unnamed_obj_"+str(c)
-        # La dernière ligne permet de changer les valeurs d'un tableau
-        # en évitant l'erreur SettingWithCopyWarning.
-        logging.info(st(c)+" unnamed images have been named")
-    else:
-        logging.info("No unnamed image has been found")
+    # ------- Images sans nom, calibrations et images non calibrées ----------
 
-    # ------ Effacer les objets mal identifiés et callibration des images --------
+    # Les images sans nom (NaN) sont renommées unnamed_obj_N; les observations
+    # BIAS, DARK ou FLAT marquées comme OBJECT sont retirées et on ne garde que
+    # les images calibrées (Product ID en *******p).
 
-    # Certains observations de type BIAS, DARK ou FLAT sont marqués comme OBJECT.
-    # Ces objects doivent être retirés.
+    cond_cfh12 = results.normalize_results(Table_obs,"CFH12K",
+                                           '"Target Name"',
+                                           drop_calibrations=True,
+                                           suffix_column='"Product ID"')
 
     if len(Table_obs) != 0:
-        wrong_objects = np.where(map(
-                                 lambda x: "BIAS" in x or "FLAT" in x or "DARK" in
-                                 x, Table_obs['"Target Name"']))[0]
-        # On veut avoir que des images callibrées (finit par *******p)
-        cond_cfh12 = np.where(np.array(
-                                   [s[-1:] for s in Table_obs['"Product ID"']])
-                                    == 'p')[0]
-        if len(wrong_objects) != 0:
-            cond_cfh12 = np.setdiff1d(cond_cfh12, wrong_objects)
-                                                                    
         planeURI_cfh12 = Table_obs['"Plane URI"'][cond_cfh12]
         dates_cfh12    = Table_obs['"Start Date"'][cond_cfh12]
         filters_cfh12  = Table_obs['"Filter"'][cond_cfh12]
@@ -508,70 +510,20 @@ def cfht_search_images(obj_center,Sphere_Radius,tap_url):
 
     logging.info("Searching in UH8K")
 
-    # On veut passer des paramètres dans les URLs. Le module Requests permet de
-    # fournir ces arguments sous forme de dictionnaire, en utilisant l’argument
-    # params.
+    Table_obs = tables.pop("UH8K")
 
-    payload = {'REQUEST': 'doQuery', 'LANG': 'ADQL', 'FORMAT': 'CSV',
-               'QUERY':query_object(obj_center,Sphere_Radius,"UH8K")}
-
-    rawTable = requests.get(tap_url, params=payload).content
-
-    # On récupère les données sous forme de tableau en utilisant le module pandas
-
-    Table_obs = pd.read_csv(io.StringIO(rawTable.decode('utf-8')), header=0)
-
-    # ---------------- Recherche des images ayant pas de noms défini -------------
-
-    # Certaines images, récent ou pas, n'ont pas de noms propres (NaN). Ils
-    # peuvent être important à les étudier. Pour les intégrer dans la recherche,
-    # il faut leur changer de noms
-
-    logging.info("Searching for unnamed objects present in UH8K")
-
-    null_columns = Table_obs.columns[Table_obs.isnull().any()]
-    # On recherche dans le tableau, les colonnes où il y a des éléments vides et
-    # on fait le compte
-
-    counter = 0
-    for f in Table_obs['"Target Name"'].isnull():
-        if f ==True:
-            counter +=1
-
-    if counter != 0:
-        logging.info("There are "+str(counter)+" unnamed images found")
-        c = 0
-        # On fait le changement
-        N = len(Table_obs['"Target Name"'])
-        for it, i in enumerate(Table_obs['"Target Name"']):
-            update_process(N,it)
-            for ft, f in enumerate(Table_obs['"Target Name"'].isnull()):
-                if f ==True:
-                    if it == ft:
-                        c +=1
-                        Table_obs.loc[it, '"Target Name"'] = "unnamed_obj_"+str(c)
-        # La dernière ligne permet de changer les valeurs d'un tableau
-        # en évitant l'erreur SettingWithCopyWarning.
-        logging.info(st(c)+" unnamed images have been named")
-    else:
-        logging.info("No unnamed image has been found")
+    # ------- Images sans nom, calibrations et images non calibrées ----------
 
-    # ------ Effacer les objets mal identifiés et callibration des images --------
+    # Les images sans nom (NaN) sont renommées unnamed_obj_N; les observations
+    # BIAS, DARK ou FLAT marquées comme OBJECT sont retirées et on ne garde que
+    # les images calibrées (Product ID en *******p).
 
-    # Certains observations de type BIAS, DARK ou FLAT sont marqués comme OBJECT.
-    # Ces objects doivent être retirés.
+    cond_uh8k = results.normalize_results(Table_obs,"UH8K",
+                                          '"Target Name"',
+                                          drop_calibrations=True,
+                                          suffix_column='"Product ID"')
 
     if len(Table_obs) != 0:
-        wrong_objects = np.where(map(
-                                 lambda x: "BIAS" in x or "FLAT" in x or "DARK" in
-                                 x, Table_obs['"Target Name"']))[0]
-        # On veut avoir que des images callibrées (finit par *******p)
-        cond_uh8k = np.where(np.array(
-                                  [s[-1:] for s in Table_obs['"Product ID"']]
-                                   ) == 'p')[0]
-        if len(wrong_objects) != 0:
-            cond_uh8k = np.setdiff1d(cond_uh8k, wrong_objects)
-                                                                    
         planeURI_uh8k = Table_obs['"Plane URI"'][cond_uh8k]
         dates_uh8k    = Table_obs['"Start Date"'][cond_uh8k]
         filters_uh8k  = Table_obs['"Filter"'][cond_uh8k]
@@ -603,80 +555,30 @@ def cfht_search_images(obj_center,Sphere_Radius,tap_url):
 
 def cfht_search_images_2(obj_center,Ra_box,DEC_box,tap_url):
     
+    # Une seule requête pour les 4 instruments
+    tables = cfht_object_tables(tap_url,obj_center,Ra_box,DEC_box,
+                                [(inst, query_object_2(obj_center,Ra_box,
+                                                       DEC_box,inst))
+                                 for inst in CFHT_INSTRUMENTS])
+
     ############################## Instrument MEGAPRIME ##########################
     
     logging.info("Searching in MegaPrime")
     
-    # On veut passer des paramètres dans les URLs. Le module Requests permet de
-    # fournir ces arguments sous forme de dictionnaire, en utilisant l’argument
-    # params.
-    
-    payload = {'REQUEST': 'doQuery', 'LANG': 'ADQL', 'FORMAT': 'CSV',
-               'QUERY':query_object_2(obj_center,Ra_box,DEC_box,"MegaPrime")}
-    
-    rawTable = requests.get(tap_url, params=payload).content
-    
-    # On récupère les données sous forme de tableau en utilisant le module pandas
-    
-    Table_obs = pd.read_csv(io.StringIO(rawTable.decode('utf-8')), header=0)
-    
-    # ---------------- Recherche des images ayant pas de noms défini ------------
-    
-    # Certaines images, récent ou pas, n'ont pas de noms propres (NaN). Ils
-    # peuvent être important à les étudier. Pour les intégrer dans la recherche,
-    # il faut leur changer de noms
-    
-    logging.info("Searching for unnamed objects present in MegaPrime")
-    
-    null_columns = Table_obs.columns[Table_obs.isnull().any()]
-    # On recherche dans le tableau, les colonnes où il y a des éléments vides et
-    # on fait le compte
-    
-    
-    counter = 0
-    for f in Table_obs['"Target Name"'].isnull():
-        if f ==True:
-            counter +=1
-    
-    #print counter
-    #print Table_obs
-    #sys.exit("test 2.2")
-    
-    if counter != 0:
-        logging.info("There are "+str(counter)+" unnamed images found")
-        c = 0
-        # On fait le changement
-        N = len(Table_obs['"Target Name"'])
-        for it, i in enumerate(Table_obs['"Target Name"']):
-            update_process(N,it)
-            for ft, f in enumerate(Table_obs['"Target Name"'].isnull()):
-                if f ==True:
-                    if it == ft:
-                        c +=1
-                        Table_obs.loc[it, '"Target Name"'] = "unnamed_obj_"+str(c)
-        # La dernière ligne permet de changer les valeurs d'un tableau
-        # en évitant l'erreur SettingWithCopyWarning.
-        logging.info(st(c)+" unnamed images have been named")
-    else:
-        logging.info("No unnamed image has been found")
-    
-    # ------ Effacer les objets mal identifiés et callibration des images -------
-    
-    # Certains observations de type BIAS, DARK ou FLAT sont marqués comme OBJECT.
-    # Ces objects doivent être retirés.
+    Table_obs = tables.pop("MegaPrime")
     
+    # ------- Images sans nom, calibrations et images non calibrées ----------
+
+    # Les images sans nom (NaN) sont renommées unnamed_obj_N; les observations
+    # BIAS, DARK ou FLAT marquées comme OBJECT sont retirées et on ne garde que
+    # les images calibrées (Product ID en *******p).
+
+    cond_megaprime = results.normalize_results(Table_obs,"MegaPrime",
+                                               '"Target Name"',
+                                               drop_calibrations=True,
+                                               suffix_column='"Product ID"')
+
     if len(Table_obs) != 0:
-        wrong_objects = np.where(map(
-                                     lambda x: "BIAS" in x or "FLAT" in x or
-                                     "DARK" in x, Table_obs['"Target Name"']))[0]
-                                     
-        # On veut avoir que des images callibrées (finit par *******p)
-        cond_megaprime = np.where(np.array(
-                                     [s[-1:] for s in Table_obs['"Product ID"']]
-                                        ) == 'p')[0]
-        if len(wrong_objects) != 0:
-            cond_megaprime = np.setdiff1d(cond_megaprime, wrong_objects)
-            
         planeURI_megaprime = Table_obs['"Plane URI"'][cond_megaprime]
                                                                         
         N_megaprime = len(planeURI_megaprime)
@@ -695,70 +597,20 @@ def cfht_search_images_2(obj_center,Ra_box,DEC_box,tap_url):
     
     logging.info("Searching in WIRCam")
     
-    # On veut passer des paramètres dans les URLs. Le module Requests permet de
-    # fournir ces arguments sous forme de dictionnaire, en utilisant l’argument
-    # params.
-    
-    payload = {'REQUEST': 'doQuery', 'LANG': 'ADQL', 'FORMAT': 'CSV',
-               'QUERY':query_object_2(obj_center,Ra_box,DEC_box,"WIRCam")}
-    
-    rawTable = requests.get(tap_url, params=payload).content
-    
-    # On récupère les données sous forme de tableau en utilisant le module pandas
-    
-    Table_obs = pd.read_csv(io.StringIO(rawTable.decode('utf-8')), header=0)
-    
-    # ---------------- Recherche des images ayant pas de noms défini -------------
-    
-    # Certaines images, récent ou pas, n'ont pas de noms propres (NaN). Ils
-    # peuvent être important à les étudier. Pour les intégrer dans la recherche,
-    # il faut leur changer de noms
-    
-    logging.info("Searching for unnamed objects present in WIRCam")
-    
-    null_columns = Table_obs.columns[Table_obs.isnull().any()]
-    # On recherche dans le tableau, les colonnes où il y a des éléments vides et
-    # on fait le compte
-    
-    counter = 0
-    for f in Table_obs['"Target Name"'].isnull():
-        if f ==True:
-            counter +=1
-    
-    if counter != 0:
-        logging.info("There are "+str(counter)+" unnamed images found")
-        c = 0
-        # On fait le changement
-        N = len(Table_obs['"Target Name"'])
-        for it, i in enumerate(Table_obs['"Target Name"']):
-            update_process(N,it)
-            for ft, f in enumerate(Table_obs['"Target Name"'].isnull()):
-                if f ==True:
-                    if it == ft:
-                        c +=1
-                        Table_obs.loc[it, '"Target Name"'] = "unnamed_obj_"+str(c)
-        # La dernière ligne permet de changer les valeurs d'un tableau
-        # en évitant l'erreur SettingWithCopyWarning.
-        logging.info(str(c)+" unnamed images have been named")
-    else:
-        logging.info("No unnamed image has been found")
-    
-    # ------ Effacer les objets mal identifiés et callibration des images --------
-    
-    # Certains observations de type BIAS, DARK ou FLAT sont marqués comme OBJECT.
-    # Ces objects doivent être retirés.
+    Table_obs = tables.pop("WIRCam")
     
+    # ------- Images sans nom, calibrations et images non calibrées ----------
+
+    # Les images sans nom (NaN) sont renommées unnamed_obj_N; les observations
+    # BIAS, DARK ou FLAT marquées comme OBJECT sont retirées et on ne garde que
+    # les images calibrées (Product ID en *******p).
+
+    cond_wircam = results.normalize_results(Table_obs,"WIRCam",
+                                            '"Target Name"',
+                                            drop_calibrations=True,
+                                            suffix_column='"Product ID"')
+
     if len(Table_obs) != 0:
-        wrong_objects = np.where(map(
-                                lambda x: "BIAS" in x or "FLAT" in x or "DARK" in
-                                x, Table_obs['"Target Name"']))[0]
-        # On veut avoir que des images callibrées (finit par *******p)
-        cond_wircam = np.where(np.array(
-                                    [s[-1:] for s in Table_obs['"Product ID"']]
-                                    ) == 'p')[0]
-        if len(wrong_objects) != 0:
-            cond_wircam = np.setdiff1d(cond_wircam, wrong_objects)
-                                                                     
         planeURI_wircam = Table_obs['"Plane URI"'][cond_wircam]
                                                                      
         N_wircam = len(planeURI_wircam)
@@ -777,70 +629,20 @@ def cfht_search_images_2(obj_center,Ra_box,DEC_box,tap_url):
     
     logging.info("Searching in CFH12K")
     
-    # On veut passer des paramètres dans les URLs. Le module Requests permet de
-    # fournir ces arguments sous forme de dictionnaire, en utilisant l’argument
-    # params.
-    
-    payload = {'REQUEST': 'doQuery', 'LANG': 'ADQL', 'FORMAT': 'CSV',
-               'QUERY':query_object_2(obj_center,Ra_box,DEC_box,"CFH12K")}
-    
-    rawTable = requests.get(tap_url, params=payload).content
-    
-    # On récupère les données sous forme de tableau en utilisant le module pandas
-    
-    Table_obs = pd.read_csv(io.StringIO(rawTable.decode('utf-8')), header=0)
-    
-    # ---------------- Recherche des images ayant pas de noms défini -------------
-    
-    # Certaines images, récent ou pas, n'ont pas de noms propres (NaN). Ils
-    # peuvent être important à les étudier. Pour les intégrer dans la recherche,
-    # il faut leur changer de noms
-    
-    logging.info("Searching for unnamed objects present in CFH12K")
-    
-    null_columns = Table_obs.columns[Table_obs.isnull().any()]
-    # On recherche dans le tableau, les colonnes où il y a des éléments vides et
-    # on fait le compte
-    
-    counter = 0
-    for f in Table_obs['"Target Name"'].isnull():
-        if f ==True:
-            counter +=1
-    
-    if counter != 0:
-        logging.info("There are "+str(counter)+" unnamed images found")
-        c = 0
-        # On fait le changement
-        N = len(Table_obs['"Target Name"'])
-        for it, i in enumerate(Table_obs['"Target Name"']):
-            update_process(N,it)
-            for ft, f in enumerate(Table_obs['"Target Name"'].isnull()):
-                if f ==True:
-                    if it == ft:
-                        c +=1
-                        Table_obs.loc[it, '"Target Name"'] = "unnamed_obj_"+str(c)
-        # La dernière ligne permet de changer les valeurs d'un tableau
-        # en évitant l'erreur SettingWithCopyWarning.
-        logging.info(st(c)+" unnamed images have been named")
-    else:
-        logging.info("No unnamed image has been found")
-    
-    # ------ Effacer les objets mal identifiés et callibration des images --------
-    
-    # Certains observations de type BIAS, DARK ou FLAT sont marqués comme OBJECT.
-    # Ces objects doivent être retirés.
+    Table_obs = tables.pop("CFH12K")
     
+    # ------- Images sans nom, calibrations et images non calibrées ----------
+
+    # Les images sans nom (NaN) sont renommées unnamed_obj_N; les observations
+    # BIAS, DARK ou FLAT marquées comme OBJECT sont retirées et on ne garde que
+    # les images calibrées (Product ID en *******p).
+
+    cond_cfh12 = results.normalize_results(Table_obs,"CFH12K",
+                                           '"Target Name"',
+                                           drop_calibrations=True,
+                                           suffix_column='"Product ID"')
+
     if len(Table_obs) != 0:
-        wrong_objects = np.where(map(
-                                lambda x: "BIAS" in x or "FLAT" in x or "DARK" in
-                                x, Table_obs['"Target Name"']))[0]
-        # On veut avoir que des images callibrées (finit par *******p)
-        cond_cfh12 = np.where(np.array(
-                                    [s[-1:] for s in Table_obs['"Product ID"']])
-                                    == 'p')[0]
-        if len(wrong_objects) != 0:
-            cond_cfh12 = np.setdiff1d(cond_cfh12, wrong_objects)
-                                                           
         planeURI_cfh12 = Table_obs['"Plane URI"'][cond_cfh12]
         dates_cfh12    = Table_obs['"Start Date"'][cond_cfh12]
         filters_cfh12  = Table_obs['"Filter"'][cond_cfh12]
@@ -864,70 +666,20 @@ def cfht_search_images_2(obj_center,Ra_box,DEC_box,tap_url):
     
     logging.info("Searching in UH8K")
     
-    # On veut passer des paramètres dans les URLs. Le module Requests permet de
-    # fournir ces arguments sous forme de dictionnaire, en utilisant l’argument
-    # params.
-    
-    payload = {'REQUEST': 'doQuery', 'LANG': 'ADQL', 'FORMAT': 'CSV',
-        'QUERY':query_object_2(obj_center,Ra_box,DEC_box,"UH8K")}
-    
-    rawTable = requests.get(tap_url, params=payload).content
-    
-    # On récupère les données sous forme de tableau en utilisant le module pandas
-    
-    Table_obs = pd.read_csv(io.StringIO(rawTable.decode('utf-8')), header=0)
-    
-    # ---------------- Recherche des images ayant pas de noms défini -------------
-    
-    # Certaines images, récent ou pas, n'ont pas de noms propres (NaN). Ils
-    # peuvent être important à les étudier. Pour les intégrer dans la recherche,
-    # il faut leur changer de noms
-    
-    logging.info("Searching for unnamed objects present in UH8K")
-    
-    null_columns = Table_obs.columns[Table_obs.isnull().any()]
-    # On recherche dans le tableau, les colonnes où il y a des éléments vides et
-    # on fait le compte
-    
-    counter = 0
-    for f in Table_obs['"Target Name"'].isnull():
-        if f ==True:
-            counter +=1
-    
-    if counter != 0:
-        logging.info("There are "+str(counter)+" unnamed images found")
-        c = 0
-        # On fait le changement
-        N = len(Table_obs['"Target Name"'])
-        for it, i in enumerate(Table_obs['"Target Name"']):
-            update_process(N,it)
-            for ft, f in enumerate(Table_obs['"Target Name"'].isnull()):
-                if f ==True:
-                    if it == ft:
-                        c +=1
-                        Table_obs.loc[it, '"Target Name"'] = "unnamed_obj_"+str(c)
-        # La dernière ligne permet de changer les valeurs d'un tableau
-        # en évitant l'erreur SettingWithCopyWarning.
-        logging.info(st(c)+" unnamed images have been named")
-    else:
-        logging.info("No unnamed image has been found")
-    
-    # ------ Effacer les objets mal identifiés et callibration des images --------
-    
-    # Certains observations de type BIAS, DARK ou FLAT sont marqués comme OBJECT.
-    # Ces objects doivent être retirés.
+    Table_obs = tables.pop("UH8K")
     
+    # ------- Images sans nom, calibrations et images non calibrées ----------
+
+    # Les images sans nom (NaN) sont renommées unnamed_obj_N; les observations
+    # BIAS, DARK ou FLAT marquées comme OBJECT sont retirées et on ne garde que
+    # les images calibrées (Product ID en *******p).
+
+    cond_uh8k = results.normalize_results(Table_obs,"UH8K",
+                                          '"Target Name"',
+                                          drop_calibrations=True,
+                                          suffix_column='"Product ID"')
+
     if len(Table_obs) != 0:
-        wrong_objects = np.where(map(
-                                lambda x: "BIAS" in x or "FLAT" in x or "DARK" in
-                                x, Table_obs['"Target Name"']))[0]
-        # On veut avoir que des images callibrées (finit par *******p)
-        cond_uh8k = np.where(np.array(
-                                    [s[-1:] for s in Table_obs['"Product ID"']]
-                                     ) == 'p')[0]
-        if len(wrong_objects) != 0:
-            cond_uh8k = np.setdiff1d(cond_uh8k, wrong_objects)
-                                                                   
         planeURI_uh8k = Table_obs['"Plane URI"'][cond_uh8k]
         dates_uh8k    = Table_obs['"Start Date"'][cond_uh8k]
         filters_uh8k  = Table_obs['"Filter"'][cond_uh8k]
@@ -977,6 +729,7 @@ def query_bias_dark(date,interval,inst):
                    Plane.productID AS "Product ID",
                    Observation.instrument_name AS "Instrument",
                    Plane.time_bounds_lower AS "Start Date",
+                   Plane.time_bounds_upper AS "End Date",
                    Plane.time_exposure AS "Int. Time",
                    Plane.energy_bandpassName AS "Filter",
                    Observation.type AS "Obs. Type"
@@ -1002,7 +755,7 @@ def query_bias_dark(date,interval,inst):
 def query_flat(date,interval,Filter,inst):
 
       if inst == "CFH12K":
-         INST = "('CF12K MOSAIC')"
+         INST = "('CFH12K MOSAIC')"
          OTYP = "('FLAT')"
 
       elif inst == "UH8K":
@@ -1017,6 +770,7 @@ def query_flat(date,interval,Filter,inst):
                     Plane.productID AS "Product ID",
                     Observation.instrument_name AS "Instrument",
                     Plane.time_bounds_lower AS "Start Date",
+                    Plane.time_bounds_upper AS "End Date",
                     Plane.time_exposure AS "Int. Time",
                     Plane.energy_bandpassName AS "Filter",
                     Observation.type AS "Obs. Type"
@@ -1041,6 +795,126 @@ def query_flat(date,interval,Filter,inst):
 
       return query
 
+# Les dates des images scientifiques sont proches les unes des autres: au lieu
+# de 2 requêtes par image, on fusionne les fenêtres [date-interval/2,
+# date+interval/2] qui se chevauchent (par filtre pour les flats). Les
+# calibrations sont rangées par nuit dans l'index local (calibration_module):
+# seules les nuits encore absentes de l'index sont demandées à CADC, une fois
+# pour toutes les cibles. Les 10 calibrations les plus proches de chaque image
+# sont ensuite choisies localement, avec la même condition de chevauchement que
+# la requête (colonnes "Start Date" et "End Date"). Une requête qui atteint la
+# limite de TAP_MAXREC lignes est coupée en deux.
+
+FBD_MAX_SPAN = 730.0 # jours, longueur maximale d'une fenêtre fusionnée
+N_FBD = 10 # calibrations gardées par image et par type
+TAP_MAXREC = 50000 # lignes max renvoyées par une requête de calibrations
+
+# Colonnes des tableaux de calibrations (dataset, nom, type, début, fin)
+FBD_COLUMNS = ['"Plane URI"','"Product ID"','"Obs. Type"','"Start Date"',
+               '"End Date"']
+
+def merge_windows(dates,interval,max_span=FBD_MAX_SPAN):
+
+    windows = []
+    for date in np.sort(np.asarray(dates, dtype=float)):
+        lo = date - 0.5*interval
+        hi = date + 0.5*interval
+        if (windows and lo <= windows[-1][1] and
+            (max_span is None or hi - windows[-1][0] <= max_span)):
+            windows[-1][1] = hi
+        else:
+            windows.append([lo, hi])
+
+    return windows
+
+# Calibrations d'une fenêtre [lo, hi]. Renvoie le tableau et la liste des
+# fenêtres [lo, hi] encore tronquées (une nuit ou moins, qui atteint toujours
+# TAP_MAXREC lignes): leurs nuits sont incomplètes.
+
+def fetch_fbd_window(tap_url,lo,hi,make_query):
+
+    table = tap_query(tap_url, make_query(0.5*(lo+hi), hi-lo),
+                      maxrec=TAP_MAXREC)
+    if len(table) < TAP_MAXREC:
+        return table, []
+
+    if hi - lo <= 1.0:
+        logging.warning("TAP response truncated to "+str(TAP_MAXREC)+" rows "
+                        "between MJD "+str(lo)+" and "+str(hi)
+                        +", these nights will be requested again")
+        return table, [(lo, hi)]
+
+    # Fenêtre tronquée: on la coupe en deux
+    mid = 0.5*(lo+hi)
+    table_lo, truncated_lo = fetch_fbd_window(tap_url,lo,mid,make_query)
+    table_hi, truncated_hi = fetch_fbd_window(tap_url,mid,hi,make_query)
+    table = pd.concat([table_lo, table_hi], ignore_index=True)
+    table = table.drop_duplicates('"Plane URI"').reset_index(drop=True)
+
+    return table, truncated_lo+truncated_hi
+
+# Calibrations des fenêtres, lues dans l'index après avoir demandé à CADC les
+# nuits manquantes (requêtes en parallèle). make_query(date, interval) renvoie
+# la requête ADQL d'une fenêtre. key: ('CFHT', instrument, type, filtre).
+# Renvoie le tableau et le nombre de requêtes faites.
+
+def fetch_calibrations(tap_url,key,windows,make_query):
+
+    db = calibration.open_index()
+    ranges = calibration.missing_ranges(db,key,windows,FBD_MAX_SPAN)
+
+    def fetch(night_range):
+        (first, last) = night_range
+        try:
+            table, truncated = fetch_fbd_window(tap_url,first,last+1,
+                                                make_query)
+        except Exception as e:
+            logging.warning("No calibration read for "+str(key)
+                            +" between MJD "+str(first)+" and "+str(last+1)
+                            +" ("+str(e)+")")
+            return
+
+        start = pd.to_numeric(table['"Start Date"'], errors='coerce').values
+        end = pd.to_numeric(table['"End Date"'], errors='coerce').values
+        rows = [(str(d), str(p), str(t), s,
+                 None if np.isnan(e) else e)
+                for (d, p, t, s, e) in zip(table['"Plane URI"'],
+                                           table['"Product ID"'],
+                                           table['"Obs. Type"'],start,end)
+                if not np.isnan(s)]
+        incomplete = set()
+        for lo, hi in truncated:
+            incomplete.update(calibration.window_nights(lo,hi))
+        calibration.add_nights(db,key,first,last,rows,incomplete)
+
+    if len(ranges) != 0:
+        pool = ThreadPool(min(len(ranges), tap_workers))
+        try:
+            pool.map(fetch, ranges)
+        finally:
+            pool.close()
+            pool.join()
+
+    return (calibration.calibration_table(db,key,windows,FBD_COLUMNS),
+            len(ranges))
+
+# Lignes des N_FBD calibrations les plus proches de date parmi celles dont
+# l'intervalle de temps touche [date-interval/2, date+interval/2], et leur écart
+# en jours
+
+def nearest_fbd(table,date,interval):
+
+    start = table['"Start Date"'].values.astype(float)
+    end = table['"End Date"'].values.astype(float)
+    end = np.where(np.isnan(end), start, end)
+
+    inside = np.where((start <= date + 0.5*interval) &
+                      (end >= date - 0.5*interval))[0]
+    dt = np.abs(start[inside] - date)
+    order = np.argsort(dt, kind='mergesort')[:N_FBD]
+
+    return inside[order], dt[order]
+
 # Maintenant on va chercher ces dossiers pour les instruments CFHT
 
 def Search_FBD(dates,filters,pIDs,inst,tap_url):
@@ -1052,49 +926,61 @@ def Search_FBD(dates,filters,pIDs,inst,tap_url):
     N = len(dates)
     logging.info("Searching BIAS, DARK and FLAT for "+inst+" observations")
 
+    dates = np.asarray(dates, dtype=float)
+    filters = np.asarray(list(filters), dtype=object)
+    pIDs = list(pIDs)
+
+    # --------------------- Requêtes par fenêtres fusionnées -------------------
+    windows = merge_windows(dates,dt4bias)
+    (temp_bds, n_queries) = fetch_calibrations(tap_url,
+                                               ('CFHT', inst, 'BIAS/DARK', ''),
+                                               windows,
+                                               lambda date, interval:
+                                                   query_bias_dark(date,
+                                                                   interval,
+                                                                   inst))
+
+    # De plus on identifie les différent type d'objet; Bias ou Dark
+    temp_bias = temp_bds.loc[temp_bds['"Obs. Type"'] ==
+                             'BIAS'].reset_index(drop=True)
+
+    temp_dark = temp_bds.loc[temp_bds['"Obs. Type"'] ==
+                             'DARK'].reset_index(drop=True)
+
+    temp_flats = {}
+    for filt in set(filters):
+        windows = merge_windows(dates[filters == filt],dt4flat)
+        (temp_flats[filt], n) = fetch_calibrations(tap_url,
+                                                   ('CFHT', inst, 'FLAT',
+                                                    str(filt)),
+                                                   windows,
+                                                   lambda date, interval:
+                                                       query_flat(date,
+                                                                  interval,
+                                                                  filt,inst))
+        n_queries += n
+
+    logging.info(str(n_queries)+" TAP requests for "+str(N)+" "+inst
+                 +" observations")
+
     # La fonction np.empty renvoie un nouveau tableau de forme et de type donné,
     # avec des valeurs aléatoires. Dans ce cas N listes de 10 valeurs.
 
-    URIs_bias = np.empty((N,10), dtype=object)
-    URIs_dark = np.empty((N,10), dtype=object)
-    URIs_flat = np.empty((N,10), dtype=object)
+    URIs_bias = np.empty((N,N_FBD), dtype=object)
+    URIs_dark = np.empty((N,N_FBD), dtype=object)
+    URIs_flat = np.empty((N,N_FBD), dtype=object)
 
     for i,(date,filt,pID) in enumerate(zip(dates,filters,pIDs)):
         update_process(N,i)
 
-        # Idem que payload voir étapes précédents
-        temp_load = {'REQUEST':'doQuery', 'LANG':'ADQL', 'FORMAT':'CSV',
-                     'QUERY':query_bias_dark(date,dt4bias,inst)}
-
-        rawTable = requests.get(tap_url, params=temp_load).content
-
-        # On récupère les données sous forme de tableau en utilisant le module
-        # pandas
-        temp_bds = pd.read_csv(io.StringIO(rawTable.decode('utf-8')), header=0)
-
-        # De plus on identifie les différent type d'objet; Bias ou Dark
-        temp_bias = temp_bds.loc[temp_bds['"Obs. Type"'] ==
-                                 'BIAS'].reset_index(drop=True)
-
-        temp_dark = temp_bds.loc[temp_bds['"Obs. Type"'] ==
-                                 'DARK'].reset_index(drop=True)
-
         #------------------------------- BIAS ----------------------------------
         URIs_bias[i,:] = None
-        if len(temp_bias) != 0:
-            # On ne garde que des recents objets
-            dt_bias = np.abs(temp_bias['"Start Date"'] - date)
-            try:
-                bias_id = np.argsort(dt_bias)[:10]
-            except Exception as e:
-                logging.warning(str("Object ",pID," with less than 10 BIAS."))
-                bias_id = np.argsort(dt_bias)
-                pass
-
+        (bias_id, dt_bias) = nearest_fbd(temp_bias,date,dt4bias)
+        if len(bias_id) != 0:
             # En cas de durée très longue
-            if any(dt_bias[bias_id] > dt4bias):
+            if any(dt_bias > dt4bias):
                 logging.warning("Bias time span for object "+str(pID)+" :"
-                                +str(np.max(dt_bias[bias_id]))+" MJDs.")
+                                +str(np.max(dt_bias))+" MJDs.")
 
             # On ajoute ces fichiers dans leur tableau correspondant.
             URIs_bias[i,:len(bias_id)] = temp_bias['"Plane URI"'].iloc[bias_id]
@@ -1104,20 +990,12 @@ def Search_FBD(dates,filters,pIDs,inst,tap_url):
 
         #------------------------------- DARK ----------------------------------
         URIs_dark[i,:] = None
-        if len(temp_dark) != 0:
-            # On ne garde que des recents objets
-            dt_dark = np.abs(temp_dark['"Start Date"'] - date)
-            try:
-                dark_id = np.argsort(dt_dark)[:10]
-            except Exception as e:
-                logging.warning(str("Object ",pID," with less than 10 DARKS."))
-                dark_id = np.argsort(dt_dark)
-                pass
-    
+        (dark_id, dt_dark) = nearest_fbd(temp_dark,date,dt4bias)
+        if len(dark_id) != 0:
             # En cas de durée très longue
-            if any(dt_dark[dark_id] > dt4bias):
+            if any(dt_dark > dt4bias):
                 logging.warning("Dark time span for object "+str(pID)+" :"
-                                +str(np.max(dt_dark[dark_id]))+" MJDs.")
+                                +str(np.max(dt_dark))+" MJDs.")
     
             # On ajoute ces fichiers dans leur tableau correspondant.
             URIs_dark[i,:len(dark_id)] = temp_dark['"Plane URI"'].iloc[dark_id]
@@ -1127,30 +1005,15 @@ def Search_FBD(dates,filters,pIDs,inst,tap_url):
 
 
         #------------------------------ FLAT ------------------------------------
-        temp_load = {'REQUEST': 'doQuery', 'LANG': 'ADQL','FORMAT':'CSV',
-                     'QUERY':query_flat(date,dt4flat,filt,"CFH12K")}
-
-        rawTable = requests.get(tap_url, params=temp_load).content
-    
-        # On récupère les données sous forme de tableau en utilisant le module
-        # pandas
-        temp_flat = pd.read_csv(io.StringIO(rawTable.decode('utf-8')), header=0)
+        temp_flat = temp_flats[filt]
 
         URIs_flat[i,:] = None
-        if len(temp_flat) != 0:
-            # On ne garde que des recents objets
-            dt_flat = np.abs(temp_flat['"Start Date"'] - date)
-            try:
-                flat_id = np.argsort(dt_flat)[:10]
-            except Exception as e:
-                logging.warning(str("Object ",pID," with less than 10 FLATS."))
-                flat_id = np.argsort(dt_flat)
-                pass
-    
+        (flat_id, dt_flat) = nearest_fbd(temp_flat,date,dt4flat)
+        if len(flat_id) != 0:
             # En cas de durée très longue
-            if any(dt_flat[flat_id] > dt4flat):
+            if any(dt_flat > dt4flat):
                 logging.warning("Flat time span for object "+str(pID)+" :"
-                                +str(np.max(dt_dark[dark_id]))+" MJDs.")
+                                +str(np.max(dt_flat))+" MJDs.")
     
             # On ajoute ces fichiers dans leur tableau correspondant.
             URIs_flat[i,:len(flat_id)] = temp_flat['"Plane URI"'].iloc[flat_id]
@@ -1183,201 +1046,118 @@ def Search_FBD(dates,filters,pIDs,inst,tap_url):
 ##################### Telechargement des images astronomiques ####################
 
 # Lors de la telechargement sur le site de CFHT, il faut une autorisation, soit un
-# identifiant et un mot de passe. On défini donc:
+# identifiant et un mot de passe. Les images sont téléchargées par le moteur
+# commun (download_module): en parallèle, avec reprise des fichiers incomplets.
 
-def download_cfht_images(usr,pss,download_url,N_megaprime,N_wircam,N_cfh12,N_uh8k,
-                         planeURI_megaprime,planeURI_wircam,planeURI_cfh12,
-                         planeURI_cfh12_fbd,planeURI_uh8k,planeURI_uh8k_fbd,
-                         output_directory):
-    
-    # ------------------- Téléchargement des images MegaPrime ------------------
-    if N_megaprime != 0:
-        logging.info("Downloading images from MegaPrime instrument")
-        out_dir = output_directory+"/MegaPrime/"
-        if not os.path.exists(out_dir):
-            os.makedirs(out_dir)
-            logging.info("The directory "+str(out_dir)+" have been created.")
+# Liste des (lien, fichier, planeURI) à télécharger pour une liste de planeURI.
+# Le planeURI sert de clé dans le dépôt commun des images (download_module).
 
-        else:
-            logging.info("The directory "+str(out_dir)+" is already created.")
+def cfht_jobs(planeURIs,download_url,out_dir):
 
+    jobs = []
+    for plist in planeURIs:
 
-        for plist in tqdm(planeURI_megaprime):
-            
-            (aa,bb) = plist.split(':')
-            (kk,cc,ff) = bb.split('/')
-        
-            link = download_url+'{}/{}.fits.fz?'.format(kk,ff)
-        
-            r = requests.get(link, auth=HTTPBasicAuth(usr, pss), stream=True)
-            total_length = int(r.headers.get('content-length', 0))
-            block_length = 1024
-            wrote = 0
-            
-            if not os.path.exists(out_dir+"/{}.fits.fz".format(ff)):
-                with open(out_dir+"/{}.fits.fz".format(ff), 'wb') as f:
-                    for data in tqdm(r.iter_content(block_length), total=math.ceil
-                                     (total_length//block_length), unit='KB',
-                                      unit_scale=True):
-                        wrote += len(data)
-                        f.write(data)
-
-                if total_length != 0 and wrote != total_length:
-                    logging.error("Something went wrong")
-
-                logging.info("The image "+ff+" has been downloaded.")
-                    
-            else:
-                logging.info("The image "+ff+" has already been downloaded.")
+        (aa,bb) = plist.split(':')
+        (kk,cc,ff) = bb.split('/')
 
-        logging.info("Download completed ")
-        logging.info("--------------------------------------------------------")
+        jobs.append((download_url+'{}/{}.fits.fz?'.format(kk,ff),
+                     out_dir+"/{}.fits.fz".format(ff), plist))
 
-    #sys.exit("test 7")
+    return jobs
 
-    # -------------------- Téléchargement des images WIRCam ----------------------
-    if N_wircam != 0:
-        logging.info("Downloading images from WIRCam instrument")
-        out_dir = output_directory+"/WIRCam/"
+def download_cfht_images(usr,pss,download_url,N_megaprime,N_wircam,N_cfh12,N_uh8k,
+                         planeURI_megaprime,planeURI_wircam,planeURI_cfh12,
+                         planeURI_cfh12_fbd,planeURI_uh8k,planeURI_uh8k_fbd,
+                         output_directory,n_workers=download.n_workers,db=None,
+                         session=None):
+
+    # Une session peut être partagée entre plusieurs cibles (mode batch)
+    own_session = session is None
+    if own_session:
+        session = download.new_session(HTTPBasicAuth(usr, pss), n_workers)
+    journal = output_directory+'/download_journal.txt'
+
+    # Pour CFH12K et UH8K, on doit additionner les 2 listes planeURI: images +
+    # calibrations, et retirer les doublures.
+    instruments = [("MegaPrime", N_megaprime, planeURI_megaprime),
+                   ("WIRCam", N_wircam, planeURI_wircam),
+                   ("CFH12K", N_cfh12,
+                    set(np.concatenate((planeURI_cfh12,planeURI_cfh12_fbd),
+                                       axis=0))),
+                   ("UH8K", N_uh8k,
+                    set(np.concatenate((planeURI_uh8k,planeURI_uh8k_fbd),
+                                       axis=0)))]
+
+    plans = []
+    for (inst, N, planeURIs) in instruments:
+        if N == 0:
+            continue
+
+        out_dir = output_directory+"/"+inst+"/"
+        plans.append((inst, out_dir,
+                      cfht_jobs(planeURIs,download_url,out_dir)))
+
+    # Toutes les images prévues sont notées dans le manifeste avant le premier
+    # téléchargement: une reprise n'aura plus besoin d'interroger l'archive.
+    if db is not None:
+        manifest.add_datasets(db,"CFHT",
+                              [(plist, inst, link, path, None)
+                               for (inst, out_dir, jobs) in plans
+                               for (link, path, plist) in jobs])
+        manifest.set_archive_stage(db,"CFHT",manifest.PLANNED)
+        done = manifest.done_paths(db,"CFHT")
+
+    failed = 0
+    for (inst, out_dir, jobs) in plans:
+
+        logging.info("Downloading images from "+inst+" instrument")
         if not os.path.exists(out_dir):
             os.makedirs(out_dir)
             logging.info("The directory "+str(out_dir)+" have been created.")
-    
-        else:
-            logging.info("The directory "+str(out_dir)+" is already created.")
-    
-    
-    
-        for plist in tqdm(planeURI_wircam):
-            
-            (aa,bb) = plist.split(':')
-            (kk,cc,ff) = bb.split('/')
-
-            link = download_url+'{}/{}.fits.fz?'.format(kk,ff)
-    
-            r = requests.get(link, auth=HTTPBasicAuth(usr, pss), stream=True)
-            total_length = int(r.headers.get('content-length', 0))
-            block_length = 1024
-            wrote = 0
-        
-            if not os.path.exists(out_dir+"/{}.fits.fz".format(ff)):
-                with open(out_dir+"/{}.fits.fz".format(ff), 'wb') as f:
-                    for data in tqdm(r.iter_content(block_length), total=math.ceil
-                                     (total_length//block_length), unit='KB',
-                                     unit_scale=True):
-                        wrote += len(data)
-                        f.write(data)
-        
-                if total_length != 0 and wrote != total_length:
-                    logging.error("Something went wrong")
-
-                logging.info("The image "+ff+" has been downloaded.")
-                    
-            else:
-                logging.info("The image "+ff+" has already been downloaded.")
-    
-        logging.info("Download completed ")
-        logging.info("--------------------------------------------------------")
 
-    # ------------------- Téléchargement des images CFH12K -----------------------
-    if N_cfh12 != 0:
-        logging.info("Downloading images from CFH12K instrument")
-        out_dir = output_directory+"/CFH12K/"
-        if not os.path.exists(out_dir):
-            os.makedirs(out_dir)
-            logging.info("The directory "+str(out_dir)+" have been created.")
-    
         else:
             logging.info("The directory "+str(out_dir)+" is already created.")
 
-        # On doit additionner les 2 listes planeURI: images + calibrations.
-        planeURI_cfh12 = np.concatenate((planeURI_cfh12,planeURI_cfh12_fbd),
-                                        axis=0)
+            if db is None:
+                # Les fichiers corrompus d'un téléchargement précédent sont
+                # effacés et seront téléchargés de nouveau
+                download.verify_download_tree(out_dir,journal)
+            else:
+                # Le manifeste sait déjà quels fichiers sont terminés
+                jobs = [job for job in jobs if job[1] not in done]
 
-        # On retire les doublures.
-        planeURI_cfh12 = set(planeURI_cfh12)
+        counts = download.download_files(session,jobs,n_workers,journal,db)
+        failed += counts['failed']
 
-    
-        for plist in tqdm(planeURI_cfh12):
-        
-            (aa,bb) = plist.split(':')
-            (kk,cc,ff) = bb.split('/')
-        
-            link = download_url+'{}/{}.fits.fz?'.format(kk,ff)
-            r = requests.get(link, auth=HTTPBasicAuth(usr, pss), stream=True)
-            total_length = int(r.headers.get('content-length', 0))
-            block_length = 1024
-            wrote = 0
-        
-            if not os.path.exists(out_dir+"/{}.fits.fz".format(ff)):
-                with open(out_dir+"/{}.fits.fz".format(ff), 'wb') as f:
-                    for data in tqdm(r.iter_content(block_length), total=math.ceil
-                                     (total_length//block_length), unit='KB',
-                                     unit_scale=True):
-                        wrote += len(data)
-                        f.write(data)
-        
-                if total_length != 0 and wrote != total_length:
-                    logging.error("Something went wrong")
-
-                logging.info("The image "+ff+" have been downloaded.")
-                    
-            else:
-                logging.info("The image "+ff+" has already been downloaded.")
-    
         logging.info("Download completed ")
         logging.info("--------------------------------------------------------")
 
-    # ---------------------- Téléchargement des images UH8K ----------------------
-    if N_uh8k != 0:
-        logging.info("Downloading images from UH8K instrument")
-        out_dir = output_directory+"/UH8K/"
-        if not os.path.exists(out_dir):
-            os.makedirs(out_dir)
-            logging.info("The directory "+str(out_dir)+" have been created.")
-    
-        else:
-            logging.info("The directory "+str(out_dir)+" is already created.")
-    
-        # On doit additionner les 2 listes planeURI: images + calibrations.
-        planeURI_uh8k = np.concatenate((planeURI_uh8k,planeURI_uh8k_fbd),axis=0)
-    
-        # On retire les doublures.
-        planeURI_uh8k = set(planeURI_uh8k)
+    if own_session:
+        session.close()
 
-    
-        for plist in tqdm(planeURI_uh8k):
-        
-            (aa,bb) = plist.split(':')
-            (kk,cc,ff) = bb.split('/')
-
-            link = download_url+'{}/{}.fits.fz?'.format(kk,ff)
-            r = requests.get(link, auth=HTTPBasicAuth(usr, pss), stream=True)
-            total_length = int(r.headers.get('content-length', 0))
-            block_length = 1024
-            wrote = 0
-        
-            if not os.path.exists(out_dir+"/{}.fits.fz".format(ff)):
-                with open(out_dir+"/{}.fits.fz".format(ff), 'wb') as f:
-                    for data in tqdm(r.iter_content(block_length), total=math.ceil
-                                     (total_length//block_length), unit='KB',
-                                     unit_scale=True):
-                        wrote += len(data)
-                        f.write(data)
-        
-                if total_length != 0 and wrote != total_length:
-                    logging.error("Something went wrong")
+    if db is not None and failed == 0:
+        manifest.set_archive_stage(db,"CFHT",manifest.DONE)
 
-                logging.info("The image "+ff+" have been downloaded.")
-                    
-            else:
-                logging.info("The image "+ff+" has already been downloaded.")
-    
-        logging.info("Download completed ")
-        logging.info("--------------------------------------------------------")
+    logging.info("All CFHT images downloaded")
+    return
+
+# Reprise après un arrêt: les images à télécharger sont relues dans le manifeste,
+# sans nouvelle requête à l'archive.
+
+def resume_cfht_downloads(usr,pss,output_directory,db,
+                          n_workers=download.n_workers,session=None):
 
+    # Une session peut être partagée entre plusieurs cibles (mode batch)
+    own_session = session is None
+    if own_session:
+        session = download.new_session(HTTPBasicAuth(usr, pss), n_workers)
+    download.download_manifest(session,db,"CFHT",n_workers,
+                               output_directory+'/download_journal.txt')
+    if own_session:
+        session.close()
 
     logging.info("All CFHT images downloaded")
+
     return
 
 ##################################################################################
@@ -1407,14 +1187,7 @@ if __name__ == "__main__":
         sys.exit('''You should choose between r and b; circle or rectangle''')
 
     # --------- Coordonnées de l'objet en degrés ------------------
-    sd.reset_votable_fields()
-    sd.remove_votable_fields('coordinates')
-    sd.add_votable_fields('ra(d;A;ICRS)', 'dec(d;D;ICRS)')
-
-    table = sd.query_object(Object, wildcard=False)
-
-    RA_center_deg = table[0][1]
-    DEC_center_deg = table[0][2]
+    (RA_center_deg, DEC_center_deg) = simbad.object_center(Object)
 
     CENTRE = np.array([RA_center_deg, DEC_center_deg])
 
@@ -0,0 +1,457 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Ce module secondaire définit le moteur de téléchargement commun aux archives
+# (CFHT, ESO). Les images sont téléchargées en parallèle par un pool de threads
+# qui partagent une même session HTTP (connexions gardées ouvertes), avec de
+# gros blocs de lecture.
+#
+# Une image déjà présente est sautée avant même d'ouvrir la connexion. Une image
+# est d'abord écrite dans un fichier .part, renommé à la fin du téléchargement:
+# après une interruption, le téléchargement reprend là où il s'était arrêté
+# grâce à l'en-tête HTTP Range. Les erreurs passagères (réseau, erreurs 5xx)
+# sont réessayées avec une attente qui double à chaque fois, et chaque fichier
+# terminé peut être noté dans un journal.
+#
+# Avant le renommage, le fichier est vérifié: taille annoncée par le serveur,
+# somme de contrôle quand l'archive en donne une (en-têtes Digest ou
+# Content-MD5) et début du fichier (en-tête FITS ou fichier compressé). Un
+# fichier final est donc toujours complet, et verify_download_tree permet de
+# revérifier un dossier déjà téléchargé.
+#
+# Si un manifeste est donné (manifest_module), le statut, la taille, la somme de
+# contrôle et le nombre de tentatives de chaque image y sont notés.
+#
+# Une même image (même planeURI CFHT ou même Dataset ID ESO) peut appartenir à
+# plusieurs cibles voisines. Les images sont donc gardées une seule fois dans un
+# dépôt commun (.store dans le dossier de travail), rangé par clé, et les
+# dossiers des cibles y sont reliés par des liens physiques (une copie si le
+# système de fichiers ne les permet pas). Chaque image n'est ainsi téléchargée
+# qu'une fois, quel que soit le nombre de cibles qui la contiennent.
+
+################### On va importer les modules standards ########################
+
+import os
+import re
+import time
+import base64
+import shutil
+import hashlib
+import logging
+import threading
+import requests
+from multiprocessing.pool import ThreadPool
+from tqdm import tqdm
+import manifest_module as manifest
+
+########################## Paramètres de départ #################################
+
+n_workers = 4 # téléchargements simultanés
+block_length = 1024*1024 # octets lus à la fois
+timeout = 300 # secondes sans réponse du serveur
+retries = 3 # nouvelles tentatives après une erreur passagère
+backoff = 5.0 # secondes avant la première nouvelle tentative
+
+_journal_lock = threading.Lock()
+
+# Dépôt commun des images
+use_store = True
+store_directory = os.getcwd()+'/.store'
+_store_locks = {} # un verrou par clé: deux cibles n'ont pas la même image à la
+_store_guard = threading.Lock() # fois en téléchargement
+
+# Début d'un fichier FITS, compressé (compress .Z, gzip) ou non
+FITS_MAGIC = ('SIMPLE  =', '\x1f\x9d', '\x1f\x8b')
+FITS_EXTENSIONS = ('.fits', '.fz', '.Z', '.gz')
+FITS_BLOCK = 2880 # un fichier FITS non compressé est un multiple de 2880 octets
+
+############################## Session HTTP #####################################
+
+# Une session par archive, partagée par tous les threads. Le pool de connexions
+# doit être au moins aussi grand que le nombre de threads.
+
+def new_session(auth=None,pool_size=n_workers):
+
+    session = requests.Session()
+    session.auth = auth
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size,
+                                            pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    return session
+
+############################ Vérification des fichiers ##########################
+
+# Sommes de contrôle données par le serveur: {'md5': ..., 'sha256': ...} en
+# hexadécimal. Content-MD5 ne porte que sur le corps de la réponse, on ne le
+# garde que pour une réponse complète (200).
+
+def server_digests(r):
+
+    digests = {}
+    for item in r.headers.get('Digest', '').split(','):
+        if '=' not in item:
+            continue
+        (name, value) = item.strip().split('=', 1)
+        name = name.strip().lower().replace('-', '')
+        if name in ('md5', 'sha256'):
+            try:
+                digests[name] = base64.b64decode(value).encode('hex')
+            except (TypeError, ValueError):
+                pass
+
+    md5 = r.headers.get('Content-MD5')
+    if md5 and r.status_code == 200 and 'md5' not in digests:
+        if re.match(r'^[0-9a-fA-F]{32}$', md5):
+            digests['md5'] = md5.lower()
+        else:
+            try:
+                digests['md5'] = base64.b64decode(md5).encode('hex')
+            except (TypeError, ValueError):
+                pass
+
+    return digests
+
+def file_digest(path,name):
+
+    h = hashlib.new(name)
+    with open(path, 'rb') as f:
+        for data in iter(lambda: f.read(block_length), ''):
+            h.update(data)
+
+    return h.hexdigest()
+
+# Renvoie None si le fichier semble correct, sinon la raison du rejet. size et
+# digests sont vérifiés quand ils sont connus.
+
+def check_file(path,size=None,digests={}):
+
+    actual = os.path.getsize(path)
+    if size is not None and actual != size:
+        return "size "+str(actual)+" instead of "+str(size)
+
+    with open(path, 'rb') as f:
+        head = f.read(len(FITS_MAGIC[0]))
+    if not head.startswith(FITS_MAGIC):
+        return "not a FITS or compressed file"
+    if head.startswith(FITS_MAGIC[0]) and actual % FITS_BLOCK != 0:
+        return "FITS size not a multiple of "+str(FITS_BLOCK)
+
+    for name, value in digests.items():
+        if file_digest(path,name) != value:
+            return name+" checksum mismatch"
+
+    return None
+
+# Taille totale du fichier: Content-Range pour une reprise, sinon
+# Content-Length (sauf si le corps est compressé pendant le transfert)
+
+def expected_size(r,offset):
+
+    match = re.match(r'bytes \d+-\d+/(\d+)', r.headers.get('Content-Range', ''))
+    if match:
+        return int(match.group(1))
+
+    length = r.headers.get('content-length')
+    encoding = r.headers.get('Content-Encoding', 'identity')
+    if length is None or encoding != 'identity':
+        return None
+
+    return offset + int(length)
+
+# Revérifie les fichiers FITS d'un dossier (et de ses sous-dossiers). Les
+# fichiers corrompus sont effacés pour être téléchargés de nouveau, avec leur
+# original du dépôt commun s'ils y sont reliés (sinon le prochain
+# téléchargement relierait la même copie corrompue); ceux du journal doivent en
+# plus avoir la taille qui y est notée. Renvoie la liste des fichiers effacés.
+
+def verify_download_tree(directory,journal=None):
+
+    sizes = {}
+    if journal is not None and os.path.exists(journal):
+        with open(journal) as f:
+            for line in f:
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) >= 4 and fields[3]:
+                    sizes[os.path.normpath(fields[1])] = int(fields[3])
+
+    corrupt = []
+    inodes = set()
+    for root, dirs, files in os.walk(directory):
+        for name in files:
+            if not name.endswith(FITS_EXTENSIONS):
+                continue
+            path = os.path.join(root, name)
+            reason = check_file(path, sizes.get(os.path.normpath(path)))
+            if reason is not None:
+                logging.warning("Corrupted file "+path+" ("+reason
+                                +"), it will be downloaded again")
+                st = os.stat(path)
+                if st.st_nlink > 1:
+                    inodes.add((st.st_dev, st.st_ino))
+                os.remove(path)
+                corrupt.append(path)
+
+    # Originaux corrompus du dépôt: même inode que les fichiers effacés
+    if len(inodes) != 0:
+        for stored in store_files(inodes):
+            logging.warning("Corrupted file "+stored+" removed from the store")
+            os.remove(stored)
+
+    if len(corrupt) != 0:
+        logging.info(str(len(corrupt))+" corrupted files found in "
+                     +directory)
+
+    return corrupt
+
+########################### Téléchargement d'un fichier #########################
+
+# Renvoie 'skipped' si le fichier existe déjà, 'downloaded' s'il vient d'être
+# téléchargé et vérifié, et 'failed' sinon. Un transfert coupé garde son .part
+# pour la reprise; un fichier rejeté par la vérification est effacé. Si info est
+# un dictionnaire, on y met la somme de contrôle donnée par le serveur.
+
+def download_file(session,link,path,info=None):
+
+    # On vérifie avant de se connecter
+    if os.path.exists(path):
+        return 'skipped'
+
+    part = path+'.part'
+    offset = 0
+    headers = {}
+    if os.path.exists(part):
+        offset = os.path.getsize(part)
+        headers['Range'] = 'bytes={}-'.format(offset)
+
+    r = session.get(link, headers=headers, stream=True, timeout=timeout)
+    try:
+        if offset != 0 and r.status_code == 416:
+            # Le .part ne correspond plus au fichier du serveur
+            r.close()
+            os.remove(part)
+            return download_file(session,link,path,info)
+
+        r.raise_for_status()
+        if offset != 0 and r.status_code != 206:
+            # Le serveur ne sait pas reprendre: on repart de zéro
+            offset = 0
+
+        size = expected_size(r,offset)
+        digests = server_digests(r)
+        with open(part, 'ab' if offset != 0 else 'wb') as f:
+            for data in r.iter_content(block_length):
+                f.write(data)
+    finally:
+        r.close()
+
+    if size is not None and os.path.getsize(part) < size:
+        logging.error("Something went wrong with "+os.path.basename(path)
+                      +" ("+str(os.path.getsize(part))+" of "+str(size)
+                      +" bytes written)")
+        return 'failed'
+
+    reason = check_file(part,size,digests)
+    if reason is not None:
+        logging.error("Download of "+os.path.basename(path)+" rejected: "
+                      +reason)
+        os.remove(part)
+        return 'failed'
+
+    if info is not None and len(digests) != 0:
+        name = sorted(digests)[-1] # sha256 plutôt que md5
+        info['checksum'] = name+':'+digests[name]
+
+    # Renommage atomique: le fichier final est toujours complet
+    os.rename(part, path)
+
+    return 'downloaded'
+
+# Les erreurs HTTP 4xx (sauf 408 et 429) ne sont pas réessayées
+
+def transient(e):
+
+    if isinstance(e, requests.exceptions.HTTPError) and e.response is not None:
+        code = e.response.status_code
+        return code >= 500 or code in (408, 429)
+
+    return True
+
+def safe_download(session,link,path,retries=retries,info=None):
+
+    for attempt in range(retries+1):
+        try:
+            status = download_file(session,link,path,info)
+        except (requests.exceptions.RequestException, IOError, OSError) as e:
+            logging.error("Download of "+os.path.basename(path)+" failed: "
+                          +str(e))
+            if not transient(e):
+                return 'failed'
+            status = 'failed'
+
+        if status != 'failed' or attempt == retries:
+            return status
+
+        time.sleep(backoff*2**attempt)
+        logging.info("Retrying "+os.path.basename(path))
+
+    return status
+
+# Journal des fichiers terminés: une ligne "statut<TAB>fichier<TAB>lien<TAB>taille"
+
+def write_journal(journal,status,link,path):
+
+    with _journal_lock:
+        with open(journal, 'a') as f:
+            f.write(status+'\t'+path+'\t'+link+'\t'
+                    +str(os.path.getsize(path))+'\n')
+
+############################## Dépôt commun #####################################
+
+# Fichier du dépôt pour une clé: .store/ab/abcdef...<extension du fichier>
+
+def store_path(key,path):
+
+    digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    return os.path.join(store_directory, digest[:2],
+                        digest+os.path.splitext(path)[1])
+
+# Fichiers du dépôt dont (périphérique, inode) est dans inodes
+
+def store_files(inodes):
+
+    found = []
+    for root, dirs, files in os.walk(store_directory):
+        for name in files:
+            stored = os.path.join(root, name)
+            try:
+                st = os.stat(stored)
+            except OSError:
+                continue
+            if (st.st_dev, st.st_ino) in inodes:
+                found.append(stored)
+
+    return found
+
+def key_lock(key):
+
+    with _store_guard:
+        return _store_locks.setdefault(key, threading.Lock())
+
+# Lien physique vers le dépôt, ou copie si ce n'est pas possible (autre disque,
+# système de fichiers sans liens)
+
+def link_file(source,path):
+
+    try:
+        os.link(source, path)
+    except (OSError, AttributeError):
+        shutil.copy2(source, path)
+
+# Comme safe_download, mais l'image passe par le dépôt: 'linked' si elle y était
+# déjà (téléchargée pour une autre cible). La copie du dépôt est revérifiée
+# avant d'être reliée: corrompue, elle est effacée et téléchargée de nouveau.
+
+def stored_download(session,link,path,key,info=None):
+
+    if os.path.exists(path):
+        return 'skipped'
+
+    stored = store_path(key,path)
+    with key_lock(key):
+        if os.path.exists(stored):
+            reason = check_file(stored)
+            if reason is not None:
+                logging.warning("Corrupted file "+stored+" ("+reason
+                                +"), removed from the store")
+                os.remove(stored)
+
+        if os.path.exists(stored):
+            status = 'linked'
+        else:
+            if not os.path.exists(os.path.dirname(stored)):
+                try:
+                    os.makedirs(os.path.dirname(stored))
+                except OSError:
+                    pass # créé entre-temps par un autre thread
+            status = safe_download(session,link,stored,info=info)
+            if status == 'failed':
+                return status
+
+    link_file(stored,path)
+
+    return status
+
+######################## Téléchargement d'une liste #############################
+
+# jobs: liste de (lien, fichier de sortie) ou de (lien, fichier de sortie, clé);
+# avec une clé, l'image passe par le dépôt commun. Renvoie le nombre de fichiers
+# par statut. Si journal est donné, les fichiers terminés y sont ajoutés; si db est
+# un manifeste ouvert, chaque résultat y est noté.
+
+def download_files(session,jobs,workers=n_workers,journal=None,db=None):
+
+    # Les threads de téléchargement portent le nom du thread appelant (cible et
+    # archive dans main_code), pour le log
+    name = threading.current_thread().name+':download'
+
+    def run(job):
+        threading.current_thread().name = name
+        (link, path) = job[:2]
+        info = {}
+        if use_store and len(job) > 2:
+            status = stored_download(session,link,path,job[2],info)
+        else:
+            status = safe_download(session,link,path,info=info)
+        if journal is not None and status in ('downloaded', 'linked'):
+            write_journal(journal,status,link,path)
+        if db is not None:
+            if status == 'failed':
+                manifest.record_download(db,path,manifest.FAILED)
+            else:
+                manifest.record_download(db,path,manifest.DONE,
+                                         os.path.getsize(path),
+                                         info.get('checksum'))
+        return status
+
+    counts = {'downloaded': 0, 'linked': 0, 'skipped': 0, 'failed': 0}
+    if len(jobs) == 0:
+        return counts
+
+    pool = ThreadPool(max(1, min(workers, len(jobs))))
+    try:
+        bar = tqdm(total=len(jobs), unit='file')
+        for status in pool.imap_unordered(run, jobs):
+            counts[status] += 1
+            bar.update(1)
+        bar.close()
+    finally:
+        pool.close()
+        pool.join()
+
+    logging.info(str(counts['downloaded'])+" images downloaded, "
+                 +str(counts['linked'])+" taken from the store, "
+                 +str(counts['skipped'])+" already downloaded, "
+                 +str(counts['failed'])+" failed.")
+
+    return counts
+
+# Reprise d'une archive à partir du manifeste: seules les images qui ne sont pas
+# encore téléchargées sont demandées, sans tester les fichiers déjà terminés.
+
+def download_manifest(session,db,archive,workers=n_workers,journal=None):
+
+    jobs = manifest.pending_downloads(db,archive)
+    logging.info(str(len(jobs))+" "+archive+" images left to download.")
+    for job in jobs:
+        path = job[1]
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+
+    counts = download_files(session,jobs,workers,journal,db)
+    if counts['failed'] == 0:
+        manifest.set_archive_stage(db,archive,manifest.DONE)
+
+    return counts
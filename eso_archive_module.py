@@ -22,15 +22,26 @@ import io
 import os
 import math
 import re
+import time
 import logging
+import threading
 import requests
 import numpy as np
 import pandas as pd
 from getpass import getpass
+from multiprocessing.pool import ThreadPool
 from tqdm import tqdm
-from astroquery.simbad import Simbad as sd
 from requests.auth import HTTPBasicAuth
 
+###################### Importation des modules personnels ####################
+
+import cache_module as cache
+import calibration_module as calibration
+import download_module as download
+import manifest_module as manifest
+import results_module as results
+import simbad_module as simbad
+
 ########################## Paramètres de départ #################################
 
 # Comme son nom indique, on va définir les paramètres de départ, soit le nom de
@@ -222,6 +233,67 @@ def query_object_2(Object,obj_center,Ra_box,DEC_box,inst):
 
     return query
 
+###################### Lecture des réponses du WDB #############################
+
+# Colonnes utilisées dans les tableaux des images scientifiques
+SCIENCE_COLUMNS = ['Dataset ID','Orig Name','OBJECT','Filter','MJD-OBS']
+
+# Lecture d'un tableau csv du WDB (les images de SOFI et ses flats ont des '>'
+# dans les noms de filtres)
+
+def read_wdb_csv(rawTable,sofi_flat=False):
+
+    if sofi_flat:
+        return pd.read_csv(io.StringIO(rawTable.decode('utf-8')),
+                           header=0,quoting=3, escapechar='>',
+                           quotechar='"',comment='#',index_col=False)
+
+    return pd.read_csv(io.StringIO(rawTable.decode('utf-8')),
+                       header=0,quoting=1, quotechar='"',
+                       comment='#', index_col=False)
+
+# Lecture avec vérification des colonnes: une page d'erreur du WDB lève
+# ValueError (et n'est pas gardée dans le cache des réponses)
+
+def parse_wdb(rawTable,columns,sofi_flat=False):
+
+    table = read_wdb_csv(rawTable,sofi_flat)
+    missing = [c for c in columns if c is not None and c not in table.columns]
+    if len(missing) != 0:
+        raise ValueError("WDB response without column "+", ".join(missing))
+
+    return table
+
+######################### Correction des filtres ################################
+
+# Le WDB renvoie parfois le filtre sous forme de lien html (filter_name=...). On
+# en tire le nom du filtre et sa longueur d'onde, "nom,xxxx", comme le faisait
+# l'ancien découpage par split('='), split('"') et split('<'), mais avec une
+# seule expression régulière appliquée à toute la colonne. Renvoie la colonne
+# corrigée et le nombre de corrections.
+
+FILTER_LINK = (r'^[^=]*=[^=]*=[^=]*='
+               r'(?P<tail>[^"=]*"(?P<name>[^"<]*)<[^"<]*"[^"=]*)$')
+
+def repair_filters(filters):
+
+    filters = pd.Series(filters)
+    text = results.text_values(filters)
+    broken = text.str.contains('filter_name', regex=False, na=False).values
+    if not broken.any():
+        return (filters, 0)
+
+    parts = text[broken].str.extract(FILTER_LINK, expand=True)
+    fixed = (parts['name']+','+parts['tail'].str[-5:-1]).dropna()
+    if len(fixed) != broken.sum():
+        logging.warning(str(broken.sum()-len(fixed))
+                        +" filter names could not be corrected")
+
+    filters = filters.copy()
+    filters.loc[fixed.index] = fixed
+
+    return (filters, len(fixed))
+
 ###################### Searching Scientific Images ##############################
 
 # ------------------- Cas spherical search box -----------------------------
@@ -238,21 +310,14 @@ def eso_search_images(Object,obj_center,Sphere_Radius,tap_url):
     # params.
         
 
-    r = requests.get(tap_url, params=query_object(Object,obj_center,
-                                                  Sphere_Radius,"SOFI"))
-
-    #print r.url
-    rawTable = r.content
-    #with open('query2.csv', 'wb') as f:
-    #    f.write(rawTable)
-
-
     # On récupère les données sous forme de tableau en utilisant le module pandas
+    # Une erreur de l'archive pour cet instrument ne fait que le passer.
 
     try:
-        Table_obs = pd.read_csv(io.StringIO(rawTable.decode('utf-8')), header=0,
-                                quoting=3, escapechar='>', quotechar='"',
-                                comment='#', index_col=False)
+        query = query_object(Object,obj_center,Sphere_Radius,"SOFI")
+        Table_obs = cache.cached_get(tap_url, params=query,
+                                     parse=lambda raw:
+                                         parse_wdb(raw,SCIENCE_COLUMNS,True))
 
 
         #print Table_obs.keys()
@@ -261,65 +326,20 @@ def eso_search_images(Object,obj_center,Sphere_Radius,tap_url):
         #print Table_obs['MJD-OBS'][1]
         #print Table_obs
     
-        for ij , j in enumerate(Table_obs['Dataset ID']):
-            for it, i in enumerate(Table_obs['Orig Name']):
-                if it == ij:
-                    Orig_Id[j] = i
-
-        # ------------ Recherche des images ayant pas de noms défini -----------
-
-        # Certaines images, récent ou pas, n'ont pas de noms propres (NaN). Ils
-        # peuvent être important à les étudier. Pour les intégrer dans la
-        # recherche, il faut leur changer de noms
-
-        logging.info("Searching for unnamed objects present in SOFI")
+        # Nom d'origine de chaque image, colonne contre colonne
+        Orig_Id.update(zip(Table_obs['Dataset ID'], Table_obs['Orig Name']))
 
-        null_columns = Table_obs.columns[Table_obs.isnull().any()]
-        # On recherche dans le tableau, les colonnes où il y a des éléments vides
-        # et on fait le compte
+        # ------------------ Images sans nom --------------------------------
 
+        # Les images sans nom (NaN) sont renommées unnamed_obj_N
 
-        counter = 0
-        for f in Table_obs['OBJECT'].isnull():
-            if f ==True:
-                counter +=1
-
-        #print counter
-        #print Table_obs
-        #sys.exit("test 2.2")
-
-        if counter != 0:
-            logging.info("There are "+str(counter)+" unnamed images found")
-            c = 0
-            # On fait le changement
-            N = len(Table_obs['OBJECT'])
-            for it, i in enumerate(Table_obs['OBJECT']):
-                update_process(N,it)
-                for ft, f in enumerate(Table_obs['OBJECT'].isnull()):
-                    if f ==True:
-                        if it == ft:
-                            c +=1
-                            Table_obs.loc[it, 'OBJECT'] = "unnamed_obj_"+str(c)
-                    # La dernière ligne permet de changer les valeurs d'un tableau
-                    # en évitant l'erreur SettingWithCopyWarning.
-            logging.info(str(c)+" unnamed images have been named")
-        else:
-            logging.info("No unnamed image has been found")
+        results.normalize_results(Table_obs,"SOFI",'OBJECT')
 
         # Maintenant on regarde s'il existe des erreurs concernant le format
-        # pour les filtres utilises.
-
-        gi = 0
-        for it, i in enumerate(Table_obs['Filter']):
-	    if 'filter_name' in i:
-		# print i
-		(w1,w2,w3,w4) = i.split('=')
-		(y1,y2,y3) = w4.split('"')
-		(x1,x2) = y2.split('<')
-		u = '{},{}'.format(x1,w4[-5:-1])
-		# print u
-		Table_obs.loc[it, 'Filter'] = u
-		gi +=1
+        # pour les filtres utilises (voir repair_filters).
+
+        (filters, gi) = repair_filters(Table_obs['Filter'])
+        Table_obs['Filter'] = filters
         logging.info(str(gi)+" Errors in filter name has been found and corrected")
 
         if len(Table_obs) != 0:
@@ -341,6 +361,7 @@ def eso_search_images(Object,obj_center,Sphere_Radius,tap_url):
             orig_id_sofi = []
 
     except Exception as e:
+        logging.warning("No SOFI image read ("+str(e)+")")
         N_sofi = 0
         planeURI_sofi = []
         dates_sofi = []
@@ -361,20 +382,14 @@ def eso_search_images(Object,obj_center,Sphere_Radius,tap_url):
     # fournir ces arguments sous forme de dictionnaire, en utilisant l’argument
     # params.
 
-    r = requests.get(tap_url, params=query_object(Object,obj_center,
-                                                  Sphere_Radius,"WFI"))
-    #print r.url
-    rawTable = r.content
-    #with open('query2.csv', 'wb') as f:
-    #    f.write(rawTable)
-
-
     # On récupère les données sous forme de tableau en utilisant le module pandas
+    # Une erreur de l'archive pour cet instrument ne fait que le passer.
 
     try:
-        Table_obs = pd.read_csv(io.StringIO(rawTable.decode('utf-8')), header=0,
-                                quoting=1, quotechar='"',
-                                comment='#', index_col=False)
+        query = query_object(Object,obj_center,Sphere_Radius,"WFI")
+        Table_obs = cache.cached_get(tap_url, params=query,
+                                     parse=lambda raw:
+                                         parse_wdb(raw,SCIENCE_COLUMNS))
                             
                             
         #print Table_obs.keys()
@@ -383,64 +398,20 @@ def eso_search_images(Object,obj_center,Sphere_Radius,tap_url):
         #print Table_obs['MJD-OBS'][1]
         #print Table_obs
                             
-        for ij , j in enumerate(Table_obs['Dataset ID']):
-            for it, i in enumerate(Table_obs['Orig Name']):
-                if it == ij:
-                    Orig_Id[j] = i
-                            
-        # ------------ Recherche des images ayant pas de noms défini ----------
+        # Nom d'origine de chaque image, colonne contre colonne
+        Orig_Id.update(zip(Table_obs['Dataset ID'], Table_obs['Orig Name']))
                             
-        # Certaines images, récent ou pas, n'ont pas de noms propres (NaN). Ils
-        # peuvent être important à les étudier. Pour les intégrer dans la
-        # recherche, il faut leur changer de noms
-                            
-        logging.info("Searching for unnamed objects present in WFI")
-                            
-        null_columns = Table_obs.columns[Table_obs.isnull().any()]
-        # On recherche dans le tableau, les colonnes où il y a des éléments vides
-        # et on fait le compte
-                                                   
-        counter = 0
-        for f in Table_obs['OBJECT'].isnull():
-            if f ==True:
-                counter +=1
-                            
-        #print counter
-        #print Table_obs
-        #sys.exit("test 2.2")
-                            
-        if counter != 0:
-            logging.info("There are "+str(counter)+" unnamed images found")
-            c = 0
-            # On fait le changement
-            N = len(Table_obs['OBJECT'])
-            for it, i in enumerate(Table_obs['OBJECT']):
-                update_process(N,it)
-                for ft, f in enumerate(Table_obs['OBJECT'].isnull()):
-                    if f ==True:
-                        if it == ft:
-                            c +=1
-                            Table_obs.loc[it, 'OBJECT'] = "unnamed_obj_"+str(c)
-            # La dernière ligne permet de changer les valeurs d'un tableau
-            # en évitant l'erreur SettingWithCopyWarning.
-            logging.info(str(c)+" unnamed images have been named")
-        else:
-            logging.info("No unnamed image has been found")
-
-        # Maintenant on regarde s'il existe des erreurs concernant le format pour
-        # les filtres utilises.
-
-        gi = 0
-        for it, i in enumerate(Table_obs['Filter']):
-	    if 'filter_name' in i:
-		# print i
-		(w1,w2,w3,w4) = i.split('=')
-		(y1,y2,y3) = w4.split('"')
-		(x1,x2) = y2.split('<')
-		u = '{},{}'.format(x1,w4[-5:-1])
-		# print u
-		Table_obs.loc[it, 'Filter'] = u
-		gi +=1
+        # ------------------ Images sans nom --------------------------------
+
+        # Les images sans nom (NaN) sont renommées unnamed_obj_N
+
+        results.normalize_results(Table_obs,"WFI",'OBJECT')
+
+        # Maintenant on regarde s'il existe des erreurs concernant le format
+        # pour les filtres utilises (voir repair_filters).
+
+        (filters, gi) = repair_filters(Table_obs['Filter'])
+        Table_obs['Filter'] = filters
         logging.info(str(gi)+" Errors in filter name has been found and corrected")
                                                         
         if len(Table_obs) != 0:
@@ -462,6 +433,7 @@ def eso_search_images(Object,obj_center,Sphere_Radius,tap_url):
             orig_id_wfi = []
 
     except Exception as e:
+        logging.warning("No WFI image read ("+str(e)+")")
         N_wfi = 0
         planeURI_wfi = []
         dates_wfi = []
@@ -482,20 +454,14 @@ def eso_search_images(Object,obj_center,Sphere_Radius,tap_url):
     # fournir ces arguments sous forme de dictionnaire, en utilisant l’argument
     # params.
 
-    r = requests.get(tap_url, params=query_object(Object,obj_center,
-                                                  Sphere_Radius,"VIRCAM"))
-    #print r.url
-    rawTable = r.content
-    #with open('query2.csv', 'wb') as f:
-    #    f.write(rawTable)
-
-
     # On récupère les données sous forme de tableau en utilisant le module pandas
+    # Une erreur de l'archive pour cet instrument ne fait que le passer.
 
     try:
-        Table_obs = pd.read_csv(io.StringIO(rawTable.decode('utf-8')), header=0,
-                                quoting=1, quotechar='"',
-                                comment='#', index_col=False)
+        query = query_object(Object,obj_center,Sphere_Radius,"VIRCAM")
+        Table_obs = cache.cached_get(tap_url, params=query,
+                                     parse=lambda raw:
+                                         parse_wdb(raw,SCIENCE_COLUMNS))
                             
                             
         #print Table_obs.keys()
@@ -504,64 +470,20 @@ def eso_search_images(Object,obj_center,Sphere_Radius,tap_url):
         #print Table_obs['MJD-OBS'][1]
         #print Table_obs
                             
-        for ij , j in enumerate(Table_obs['Dataset ID']):
-            for it, i in enumerate(Table_obs['Orig Name']):
-                if it == ij:
-                    Orig_Id[j] = i
+        # Nom d'origine de chaque image, colonne contre colonne
+        Orig_Id.update(zip(Table_obs['Dataset ID'], Table_obs['Orig Name']))
                             
-        # -------------- Recherche des images ayant pas de noms défini ---------------
-                            
-        # Certaines images, récent ou pas, n'ont pas de noms propres (NaN). Ils
-        # peuvent être important à les étudier. Pour les intégrer dans la recherche,
-        # il faut leur changer de noms
-                            
-        logging.info("Searching for unnamed objects present in VIRCAM")
-                            
-        null_columns = Table_obs.columns[Table_obs.isnull().any()]
-        # On recherche dans le tableau, les colonnes où il y a des éléments vides
-        # et on fait le compte
-                                            
-        counter = 0
-        for f in Table_obs['OBJECT'].isnull():
-            if f ==True:
-                counter +=1
-                            
-        #print counter
-        #print Table_obs
-        #sys.exit("test 2.2")
-                            
-        if counter != 0:
-            logging.info("There are "+str(counter)+" unnamed images found")
-            c = 0
-            # On fait le changement
-            N = len(Table_obs['OBJECT'])
-            for it, i in enumerate(Table_obs['OBJECT']):
-                update_process(N,it)
-                for ft, f in enumerate(Table_obs['OBJECT'].isnull()):
-                    if f ==True:
-                        if it == ft:
-                            c +=1
-                            Table_obs.loc[it, 'OBJECT'] = "unnamed_obj_"+str(c)
-            # La dernière ligne permet de changer les valeurs d'un tableau
-            # en évitant l'erreur SettingWithCopyWarning.
-            logging.info(str(c)+" unnamed images have been named")
-        else:
-            logging.info("No unnamed image has been found")
-
-        # Maintenant on regarde s'il existe des erreurs concernant le format pour
-        # les filtres utilises.
-
-        gi = 0
-        for it, i in enumerate(Table_obs['Filter']):
-	    if 'filter_name' in i:
-		# print i
-		(w1,w2,w3,w4) = i.split('=')
-		(y1,y2,y3) = w4.split('"')
-		(x1,x2) = y2.split('<')
-		u = '{},{}'.format(x1,w4[-5:-1])
-		# print u
-		Table_obs.loc[it, 'Filter'] = u
-		gi +=1
+        # ------------------ Images sans nom --------------------------------
+
+        # Les images sans nom (NaN) sont renommées unnamed_obj_N
+
+        results.normalize_results(Table_obs,"VIRCAM",'OBJECT')
+
+        # Maintenant on regarde s'il existe des erreurs concernant le format
+        # pour les filtres utilises (voir repair_filters).
+
+        (filters, gi) = repair_filters(Table_obs['Filter'])
+        Table_obs['Filter'] = filters
         logging.info(str(gi)+" Errors in filter name has been found and corrected")
                             
         if len(Table_obs) != 0:
@@ -583,6 +505,7 @@ def eso_search_images(Object,obj_center,Sphere_Radius,tap_url):
             orig_id_vircam = []
 
     except Exception as e:
+        logging.warning("No VIRCAM image read ("+str(e)+")")
         N_vircam = 0
         planeURI_vircam = []
         dates_vircam = []
@@ -601,20 +524,14 @@ def eso_search_images(Object,obj_center,Sphere_Radius,tap_url):
     # fournir ces arguments sous forme de dictionnaire, en utilisant l’argument
     # params.
 
-    r = requests.get(tap_url, params=query_object(Object,obj_center,
-                                                  Sphere_Radius,"OmegaCAM"))
-    #print r.url
-    rawTable = r.content
-    #with open('query2.csv', 'wb') as f:
-    #    f.write(rawTable)
-
-
     # On récupère les données sous forme de tableau en utilisant le module pandas
+    # Une erreur de l'archive pour cet instrument ne fait que le passer.
 
     try:
-        Table_obs = pd.read_csv(io.StringIO(rawTable.decode('utf-8')), header=0,
-                                quoting=1, quotechar='"',
-                                comment='#', index_col=False)
+        query = query_object(Object,obj_center,Sphere_Radius,"OmegaCAM")
+        Table_obs = cache.cached_get(tap_url, params=query,
+                                     parse=lambda raw:
+                                         parse_wdb(raw,SCIENCE_COLUMNS))
                             
                             
         #print Table_obs.keys()
@@ -623,64 +540,20 @@ def eso_search_images(Object,obj_center,Sphere_Radius,tap_url):
         #print Table_obs['MJD-OBS'][1]
         #print Table_obs
                             
-        for ij , j in enumerate(Table_obs['Dataset ID']):
-            for it, i in enumerate(Table_obs['Orig Name']):
-                if it == ij:
-                    Orig_Id[j] = i
+        # Nom d'origine de chaque image, colonne contre colonne
+        Orig_Id.update(zip(Table_obs['Dataset ID'], Table_obs['Orig Name']))
                             
-        # ------------- Recherche des images ayant pas de noms défini -----------
-                            
-        # Certaines images, récent ou pas, n'ont pas de noms propres (NaN). Ils
-        # peuvent être important à les étudier. Pour les intégrer dans la
-        # recherche, il faut leur changer de noms
-                            
-        logging.info("Searching for unnamed objects present in OmegaCAM")
-                            
-        null_columns = Table_obs.columns[Table_obs.isnull().any()]
-        # On recherche dans le tableau, les colonnes où il y a des éléments vides
-        # et on fait le compte
-                                            
-        counter = 0
-        for f in Table_obs['OBJECT'].isnull():
-            if f ==True:
-                counter +=1
-                            
-        #print counter
-        #print Table_obs
-        #sys.exit("test 2.2")
-                            
-        if counter != 0:
-            logging.info("There are "+str(counter)+" unnamed images found")
-            c = 0
-            # On fait le changement
-            N = len(Table_obs['OBJECT'])
-            for it, i in enumerate(Table_obs['OBJECT']):
-                update_process(N,it)
-                for ft, f in enumerate(Table_obs['OBJECT'].isnull()):
-                    if f ==True:
-                        if it == ft:
-                            c +=1
-                            Table_obs.loc[it, 'OBJECT'] = "unnamed_obj_"+str(c)
-            # La dernière ligne permet de changer les valeurs d'un tableau
-            # en évitant l'erreur SettingWithCopyWarning.
-            logging.info(str(c)+" unnamed images have been named")
-        else:
-            logging.info("No unnamed image has been found")
-
-        # Maintenant on regarde s'il existe des erreurs concernant le format pour
-        # les filtres utilises.
-
-        gi = 0
-        for it, i in enumerate(Table_obs['Filter']):
-	    if 'filter_name' in i:
-		# print i
-		(w1,w2,w3,w4) = i.split('=')
-		(y1,y2,y3) = w4.split('"')
-		(x1,x2) = y2.split('<')
-		u = '{},{}'.format(x1,w4[-5:-1])
-		# print u
-		Table_obs.loc[it, 'Filter'] = u
-		gi +=1
+        # ------------------ Images sans nom --------------------------------
+
+        # Les images sans nom (NaN) sont renommées unnamed_obj_N
+
+        results.normalize_results(Table_obs,"OmegaCAM",'OBJECT')
+
+        # Maintenant on regarde s'il existe des erreurs concernant le format
+        # pour les filtres utilises (voir repair_filters).
+
+        (filters, gi) = repair_filters(Table_obs['Filter'])
+        Table_obs['Filter'] = filters
         logging.info(str(gi)+" Errors in filter name has been found and corrected")
                             
         if len(Table_obs) != 0:
@@ -702,6 +575,7 @@ def eso_search_images(Object,obj_center,Sphere_Radius,tap_url):
             orig_id_omegacam = []
 
     except Exception as e:
+        logging.warning("No OmegaCAM image read ("+str(e)+")")
         N_omegacam = 0
         planeURI_omegacam =[]
         dates_omegacam = []
@@ -722,20 +596,14 @@ def eso_search_images(Object,obj_center,Sphere_Radius,tap_url):
     # fournir ces arguments sous forme de dictionnaire, en utilisant l’argument
     # params.
 
-    r = requests.get(tap_url, params=query_object(Object,obj_center,
-                                                  Sphere_Radius,"VIMOS"))
-    #print r.url
-    rawTable = r.content
-    #with open('query2.csv', 'wb') as f:
-    #    f.write(rawTable)
-
-
     # On récupère les données sous forme de tableau en utilisant le module pandas
+    # Une erreur de l'archive pour cet instrument ne fait que le passer.
 
     try:
-        Table_obs = pd.read_csv(io.StringIO(rawTable.decode('utf-8')), header=0,
-                                quoting=1, quotechar='"',
-                                comment='#', index_col=False)
+        query = query_object(Object,obj_center,Sphere_Radius,"VIMOS")
+        Table_obs = cache.cached_get(tap_url, params=query,
+                                     parse=lambda raw:
+                                         parse_wdb(raw,SCIENCE_COLUMNS))
                             
                             
         #print Table_obs.keys()
@@ -744,65 +612,20 @@ def eso_search_images(Object,obj_center,Sphere_Radius,tap_url):
         #print Table_obs['MJD-OBS'][1]
         #print Table_obs
                             
-        for ij , j in enumerate(Table_obs['Dataset ID']):
-            for it, i in enumerate(Table_obs['Orig Name']):
-                if it == ij:
-                    Orig_Id[j] = i
-                            
-        # ----------- Recherche des images ayant pas de noms défini ------------
-                            
-        # Certaines images, récent ou pas, n'ont pas de noms propres (NaN). Ils
-        # peuvent être important à les étudier. Pour les intégrer dans la
-        # recherche, il faut leur changer de noms
-                            
-        logging.info("Searching for unnamed objects present in VIMOS")
-                            
-        null_columns = Table_obs.columns[Table_obs.isnull().any()]
-        # On recherche dans le tableau, les colonnes où il y a des éléments vides
-        # et on fait le compte
-                            
+        # Nom d'origine de chaque image, colonne contre colonne
+        Orig_Id.update(zip(Table_obs['Dataset ID'], Table_obs['Orig Name']))
                             
-        counter = 0
-        for f in Table_obs['OBJECT'].isnull():
-            if f ==True:
-                counter +=1
-                            
-        #print counter
-        #print Table_obs
-        #sys.exit("test 2.2")
-                            
-        if counter != 0:
-            logging.info("There are "+str(counter)+" unnamed images found")
-            c = 0
-            # On fait le changement
-            N = len(Table_obs['OBJECT'])
-            for it, i in enumerate(Table_obs['OBJECT']):
-                update_process(N,it)
-                for ft, f in enumerate(Table_obs['OBJECT'].isnull()):
-                    if f ==True:
-                        if it == ft:
-                            c +=1
-                            Table_obs.loc[it, 'OBJECT'] = "unnamed_obj_"+str(c)
-            # La dernière ligne permet de changer les valeurs d'un tableau
-            # en évitant l'erreur SettingWithCopyWarning.
-            logging.info(str(c)+" unnamed images have been named")
-        else:
-            logging.info("No unnamed image has been found")
-
-        # Maintenant on regarde s'il existe des erreurs concernant le format pour
-        # les filtres utilises.
-
-        gi = 0
-        for it, i in enumerate(Table_obs['Filter']):
-	    if 'filter_name' in i:
-		# print i
-		(w1,w2,w3,w4) = i.split('=')
-		(y1,y2,y3) = w4.split('"')
-		(x1,x2) = y2.split('<')
-		u = '{},{}'.format(x1,w4[-5:-1])
-		# print u
-		Table_obs.loc[it, 'Filter'] = u
-		gi +=1
+        # ------------------ Images sans nom --------------------------------
+
+        # Les images sans nom (NaN) sont renommées unnamed_obj_N
+
+        results.normalize_results(Table_obs,"VIMOS",'OBJECT')
+
+        # Maintenant on regarde s'il existe des erreurs concernant le format
+        # pour les filtres utilises (voir repair_filters).
+
+        (filters, gi) = repair_filters(Table_obs['Filter'])
+        Table_obs['Filter'] = filters
         logging.info(str(gi)+" Errors in filter name has been found and corrected")
                             
         if len(Table_obs) != 0:
@@ -824,6 +647,7 @@ def eso_search_images(Object,obj_center,Sphere_Radius,tap_url):
             orig_id_vimos = []
 
     except Exception as e:
+        logging.warning("No VIMOS image read ("+str(e)+")")
         N_vimos = 0
         planeURI_vimos = []
         dates_vimos = []
@@ -842,20 +666,14 @@ def eso_search_images(Object,obj_center,Sphere_Radius,tap_url):
     # fournir ces arguments sous forme de dictionnaire, en utilisant l’argument
     # params.
 
-    r = requests.get(tap_url, params=query_object(Object,obj_center,
-                                                  Sphere_Radius,"FORS1"))
-    #print r.url
-    rawTable = r.content
-    #with open('query2.csv', 'wb') as f:
-    #    f.write(rawTable)
-
-
     # On récupère les données sous forme de tableau en utilisant le module pandas
+    # Une erreur de l'archive pour cet instrument ne fait que le passer.
 
     try:
-        Table_obs = pd.read_csv(io.StringIO(rawTable.decode('utf-8')), header=0,
-                                quoting=1, quotechar='"',
-                                comment='#', index_col=False)
+        query = query_object(Object,obj_center,Sphere_Radius,"FORS1")
+        Table_obs = cache.cached_get(tap_url, params=query,
+                                     parse=lambda raw:
+                                         parse_wdb(raw,SCIENCE_COLUMNS))
                             
                             
         #print Table_obs.keys()
@@ -865,65 +683,20 @@ def eso_search_images(Object,obj_center,Sphere_Radius,tap_url):
         #print Table_obs['MJD-OBS'][1]
         #print Table_obs
                             
-        for ij , j in enumerate(Table_obs['Dataset ID']):
-            for it, i in enumerate(Table_obs['Orig Name']):
-                if it == ij:
-                    Orig_Id[j] = i
-                            
-        # ----------- Recherche des images ayant pas de noms défini -------------
-                            
-        # Certaines images, récent ou pas, n'ont pas de noms propres (NaN). Ils
-        # peuvent être important à les étudier. Pour les intégrer dans la
-        # recherche, il faut leur changer de noms
-                            
-        logging.info("Searching for unnamed objects present in FORS1")
+        # Nom d'origine de chaque image, colonne contre colonne
+        Orig_Id.update(zip(Table_obs['Dataset ID'], Table_obs['Orig Name']))
                             
-        null_columns = Table_obs.columns[Table_obs.isnull().any()]
-        # On recherche dans le tableau, les colonnes où il y a des éléments vides
-        # et on fait le compte
-                            
-                            
-        counter = 0
-        for f in Table_obs['OBJECT'].isnull():
-            if f ==True:
-                counter +=1
-                            
-        #print counter
-        #print Table_obs
-        #sys.exit("test 2.2")
-                            
-        if counter != 0:
-            logging.info("There are "+str(counter)+" unnamed images found")
-            c = 0
-            # On fait le changement
-            N = len(Table_obs['OBJECT'])
-            for it, i in enumerate(Table_obs['OBJECT']):
-                update_process(N,it)
-                for ft, f in enumerate(Table_obs['OBJECT'].isnull()):
-                    if f ==True:
-                        if it == ft:
-                            c +=1
-                            Table_obs.loc[it, 'OBJECT'] = "unnamed_obj_"+str(c)
-            # La dernière ligne permet de changer les valeurs d'un tableau
-            # en évitant l'erreur SettingWithCopyWarning.
-            logging.info(str(c)+" unnamed images have been named")
-        else:
-            logging.info("No unnamed image has been found")
-
-        # Maintenant on regarde s'il existe des erreurs concernant le format pour
-        # les filtres utilises.
-
-        gi = 0
-        for it, i in enumerate(Table_obs['Filter']):
-	    if 'filter_name' in i:
-		# print i
-		(w1,w2,w3,w4) = i.split('=')
-		(y1,y2,y3) = w4.split('"')
-		(x1,x2) = y2.split('<')
-		u = '{},{}'.format(x1,w4[-5:-1])
-		# print u
-		Table_obs.loc[it, 'Filter'] = u
-		gi +=1
+        # ------------------ Images sans nom --------------------------------
+
+        # Les images sans nom (NaN) sont renommées unnamed_obj_N
+
+        results.normalize_results(Table_obs,"FORS1",'OBJECT')
+
+        # Maintenant on regarde s'il existe des erreurs concernant le format
+        # pour les filtres utilises (voir repair_filters).
+
+        (filters, gi) = repair_filters(Table_obs['Filter'])
+        Table_obs['Filter'] = filters
         logging.info(str(gi)+" Errors in filter name has been found and corrected")
                           
         if len(Table_obs) != 0:
@@ -945,6 +718,7 @@ def eso_search_images(Object,obj_center,Sphere_Radius,tap_url):
             orig_id_fors1 = []
 
     except Exception as e:
+        logging.warning("No FORS1 image read ("+str(e)+")")
         N_fors1 = 0
         planeURI_fors1 = []
         dates_fors1 = []
@@ -963,20 +737,14 @@ def eso_search_images(Object,obj_center,Sphere_Radius,tap_url):
     # fournir ces arguments sous forme de dictionnaire, en utilisant l’argument
     # params.
 
-    r = requests.get(tap_url, params=query_object(Object,obj_center,
-                                                  Sphere_Radius,"FORS2"))
-    #print r.url
-    rawTable = r.content
-    #with open('query2.csv', 'wb') as f:
-    #    f.write(rawTable)
-
-
     # On récupère les données sous forme de tableau en utilisant le module pandas
+    # Une erreur de l'archive pour cet instrument ne fait que le passer.
 
     try:
-        Table_obs = pd.read_csv(io.StringIO(rawTable.decode('utf-8')), header=0,
-                                quoting=1, quotechar='"',
-                                comment='#', index_col=False)
+        query = query_object(Object,obj_center,Sphere_Radius,"FORS2")
+        Table_obs = cache.cached_get(tap_url, params=query,
+                                     parse=lambda raw:
+                                         parse_wdb(raw,SCIENCE_COLUMNS))
                             
                             
         #print Table_obs.keys()
@@ -985,64 +753,20 @@ def eso_search_images(Object,obj_center,Sphere_Radius,tap_url):
         #print Table_obs['Filter'][1]
         #print Table_obs['MJD-OBS'][1]
                             
-        for ij , j in enumerate(Table_obs['Dataset ID']):
-            for it, i in enumerate(Table_obs['Orig Name']):
-                if it == ij:
-                    Orig_Id[j] = i
+        # Nom d'origine de chaque image, colonne contre colonne
+        Orig_Id.update(zip(Table_obs['Dataset ID'], Table_obs['Orig Name']))
                             
-        # ----------- Recherche des images ayant pas de noms défini -------------
-                            
-        # Certaines images, récent ou pas, n'ont pas de noms propres (NaN). Ils
-        # peuvent être important à les étudier. Pour les intégrer dans la
-        # recherche, il faut leur changer de noms
-                            
-        logging.info("Searching for unnamed objects present in FORS2")
-                            
-        null_columns = Table_obs.columns[Table_obs.isnull().any()]
-        # On recherche dans le tableau, les colonnes où il y a des éléments vides
-        # et on fait le compte
-                                                   
-        counter = 0
-        for f in Table_obs['OBJECT'].isnull():
-            if f ==True:
-                counter +=1
-                            
-        #print counter
-        #print Table_obs
-        #sys.exit("test 2.2")
-                            
-        if counter != 0:
-            logging.info("There are "+str(counter)+" unnamed images found")
-            c = 0
-            # On fait le changement
-            N = len(Table_obs['OBJECT'])
-            for it, i in enumerate(Table_obs['OBJECT']):
-                update_process(N,it)
-                for ft, f in enumerate(Table_obs['OBJECT'].isnull()):
-                    if f ==True:
-                        if it == ft:
-                            c +=1
-                            Table_obs.loc[it, 'OBJECT'] = "unnamed_obj_"+str(c)
-            # La dernière ligne permet de changer les valeurs d'un tableau
-            # en évitant l'erreur SettingWithCopyWarning.
-            logging.info(str(c)+" unnamed images have been named")
-        else:
-            logging.info("No unnamed image has been found")
-
-        # Maintenant on regarde s'il existe des erreurs concernant le format pour
-        # les filtres utilises.
-
-        gi = 0
-        for it, i in enumerate(Table_obs['Filter']):
-	    if 'filter_name' in i:
-		# print i
-		(w1,w2,w3,w4) = i.split('=')
-		(y1,y2,y3) = w4.split('"')
-		(x1,x2) = y2.split('<')
-		u = '{},{}'.format(x1,w4[-5:-1])
-		# print u
-		Table_obs.loc[it, 'Filter'] = u
-		gi +=1
+        # ------------------ Images sans nom --------------------------------
+
+        # Les images sans nom (NaN) sont renommées unnamed_obj_N
+
+        results.normalize_results(Table_obs,"FORS2",'OBJECT')
+
+        # Maintenant on regarde s'il existe des erreurs concernant le format
+        # pour les filtres utilises (voir repair_filters).
+
+        (filters, gi) = repair_filters(Table_obs['Filter'])
+        Table_obs['Filter'] = filters
         logging.info(str(gi)+" Errors in filter name has been found and corrected")
                             
         if len(Table_obs) != 0:
@@ -1064,6 +788,7 @@ def eso_search_images(Object,obj_center,Sphere_Radius,tap_url):
             orig_id_fors2 = []
 
     except Exception as e:
+        logging.warning("No FORS2 image read ("+str(e)+")")
         N_fors2 = 0
         planeURI_fors2 = []
         dates_fors2 = []
@@ -1082,20 +807,14 @@ def eso_search_images(Object,obj_center,Sphere_Radius,tap_url):
     # fournir ces arguments sous forme de dictionnaire, en utilisant l’argument
     # params.
 
-    r = requests.get(tap_url, params=query_object(Object,obj_center,
-                                                  Sphere_Radius,"HAWKI"))
-    #print r.url
-    rawTable = r.content
-    #with open('query2.csv', 'wb') as f:
-    #    f.write(rawTable)
-
-
     # On récupère les données sous forme de tableau en utilisant le module pandas
+    # Une erreur de l'archive pour cet instrument ne fait que le passer.
 
     try:
-        Table_obs = pd.read_csv(io.StringIO(rawTable.decode('utf-8')), header=0,
-                                quoting=1, quotechar='"',
-                                comment='#', index_col=False)
+        query = query_object(Object,obj_center,Sphere_Radius,"HAWKI")
+        Table_obs = cache.cached_get(tap_url, params=query,
+                                     parse=lambda raw:
+                                         parse_wdb(raw,SCIENCE_COLUMNS))
                             
                             
         #print Table_obs.keys()
@@ -1104,64 +823,20 @@ def eso_search_images(Object,obj_center,Sphere_Radius,tap_url):
         #print Table_obs['MJD-OBS'][1]
         #print Table_obs
                             
-        for ij , j in enumerate(Table_obs['Dataset ID']):
-            for it, i in enumerate(Table_obs['Orig Name']):
-                if it == ij:
-                    Orig_Id[j] = i
+        # Nom d'origine de chaque image, colonne contre colonne
+        Orig_Id.update(zip(Table_obs['Dataset ID'], Table_obs['Orig Name']))
                             
-        # ----------- Recherche des images ayant pas de noms défini ------------
-                            
-        # Certaines images, récent ou pas, n'ont pas de noms propres (NaN). Ils
-        # peuvent être important à les étudier. Pour les intégrer dans la
-        # recherche, il faut leur changer de noms
-                            
-        logging.info("Searching for unnamed objects present in HAWKI")
-                            
-        null_columns = Table_obs.columns[Table_obs.isnull().any()]
-        # On recherche dans le tableau, les colonnes où il y a des éléments vides
-        # et on fait le compte
-                                            
-        counter = 0
-        for f in Table_obs['OBJECT'].isnull():
-            if f ==True:
-                counter +=1
-                            
-        #print counter
-        #print Table_obs
-        #sys.exit("test 2.2")
-                            
-        if counter != 0:
-            logging.info("There are "+str(counter)+" unnamed images found")
-            c = 0
-            # On fait le changement
-            N = len(Table_obs['OBJECT'])
-            for it, i in enumerate(Table_obs['OBJECT']):
-                update_process(N,it)
-                for ft, f in enumerate(Table_obs['OBJECT'].isnull()):
-                    if f ==True:
-                        if it == ft:
-                            c +=1
-                            Table_obs.loc[it, 'OBJECT'] = "unnamed_obj_"+str(c)
-            # La dernière ligne permet de changer les valeurs d'un tableau
-            # en évitant l'erreur SettingWithCopyWarning.
-            logging.info(str(c)+" unnamed images have been named")
-        else:
-            logging.info("No unnamed image has been found")
-
-        # Maintenant on regarde s'il existe des erreurs concernant le format pour
-        # les filtres utilises.
-
-        gi = 0
-        for it, i in enumerate(Table_obs['Filter']):
-	    if 'filter_name' in i:
-		# print i
-		(w1,w2,w3,w4) = i.split('=')
-		(y1,y2,y3) = w4.split('"')
-		(x1,x2) = y2.split('<')
-		u = '{},{}'.format(x1,w4[-5:-1])
-		# print u
-		Table_obs.loc[it, 'Filter'] = u
-		gi +=1
+        # ------------------ Images sans nom --------------------------------
+
+        # Les images sans nom (NaN) sont renommées unnamed_obj_N
+
+        results.normalize_results(Table_obs,"HAWKI",'OBJECT')
+
+        # Maintenant on regarde s'il existe des erreurs concernant le format
+        # pour les filtres utilises (voir repair_filters).
+
+        (filters, gi) = repair_filters(Table_obs['Filter'])
+        Table_obs['Filter'] = filters
         logging.info(str(gi)+" Errors in filter name has been found and corrected")
                             
         if len(Table_obs) != 0:
@@ -1183,6 +858,7 @@ def eso_search_images(Object,obj_center,Sphere_Radius,tap_url):
             orig_id_hawki = []
 
     except Exception as e:
+        logging.warning("No HAWKI image read ("+str(e)+")")
         N_hawki = 0
         planeURI_hawki = []
         dates_hawki = []
@@ -1217,21 +893,14 @@ def eso_search_images_2(Object,obj_center,Ra_box,DEC_box,tap_url):
     # params.
         
 
-    r = requests.get(tap_url, params=query_object_2(Object,obj_center,
-                                                    Ra_box,DEC_box,"SOFI"))
-
-    #print r.url
-    rawTable = r.content
-    #with open('query2.csv', 'wb') as f:
-    #    f.write(rawTable)
-
-
     # On récupère les données sous forme de tableau en utilisant le module pandas
+    # Une erreur de l'archive pour cet instrument ne fait que le passer.
 
     try:
-        Table_obs = pd.read_csv(io.StringIO(rawTable.decode('utf-8')), header=0,
-                                quoting=3, escapechar='>', quotechar='"',
-                                comment='#', index_col=False)
+        query = query_object_2(Object,obj_center,Ra_box,DEC_box,"SOFI")
+        Table_obs = cache.cached_get(tap_url, params=query,
+                                     parse=lambda raw:
+                                         parse_wdb(raw,SCIENCE_COLUMNS,True))
 
 
         #print Table_obs.keys()
@@ -1240,65 +909,20 @@ def eso_search_images_2(Object,obj_center,Ra_box,DEC_box,tap_url):
         #print Table_obs['MJD-OBS'][1]
         #print Table_obs
     
-        for ij , j in enumerate(Table_obs['Dataset ID']):
-            for it, i in enumerate(Table_obs['Orig Name']):
-                if it == ij:
-                    Orig_Id[j] = i
-
-        # ------------ Recherche des images ayant pas de noms défini -----------
-
-        # Certaines images, récent ou pas, n'ont pas de noms propres (NaN). Ils
-        # peuvent être important à les étudier. Pour les intégrer dans la
-        # recherche, il faut leur changer de noms
-
-        logging.info("Searching for unnamed objects present in SOFI")
+        # Nom d'origine de chaque image, colonne contre colonne
+        Orig_Id.update(zip(Table_obs['Dataset ID'], Table_obs['Orig Name']))
 
-        null_columns = Table_obs.columns[Table_obs.isnull().any()]
-        # On recherche dans le tableau, les colonnes où il y a des éléments vides
-        # et on fait le compte
+        # ------------------ Images sans nom --------------------------------
 
+        # Les images sans nom (NaN) sont renommées unnamed_obj_N
 
-        counter = 0
-        for f in Table_obs['OBJECT'].isnull():
-            if f ==True:
-                counter +=1
-
-        #print counter
-        #print Table_obs
-        #sys.exit("test 2.2")
-
-        if counter != 0:
-            logging.info("There are "+str(counter)+" unnamed images found")
-            c = 0
-            # On fait le changement
-            N = len(Table_obs['OBJECT'])
-            for it, i in enumerate(Table_obs['OBJECT']):
-                update_process(N,it)
-                for ft, f in enumerate(Table_obs['OBJECT'].isnull()):
-                    if f ==True:
-                        if it == ft:
-                            c +=1
-                            Table_obs.loc[it, 'OBJECT'] = "unnamed_obj_"+str(c)
-                    # La dernière ligne permet de changer les valeurs d'un tableau
-                    # en évitant l'erreur SettingWithCopyWarning.
-            logging.info(str(c)+" unnamed images have been named")
-        else:
-            logging.info("No unnamed image has been found")
+        results.normalize_results(Table_obs,"SOFI",'OBJECT')
 
         # Maintenant on regarde s'il existe des erreurs concernant le format
-        # pour les filtres utilises.
-
-        gi = 0
-        for it, i in enumerate(Table_obs['Filter']):
-	    if 'filter_name' in i:
-		# print i
-		(w1,w2,w3,w4) = i.split('=')
-		(y1,y2,y3) = w4.split('"')
-		(x1,x2) = y2.split('<')
-		u = '{},{}'.format(x1,w4[-5:-1])
-		# print u
-		Table_obs.loc[it, 'Filter'] = u
-		gi +=1
+        # pour les filtres utilises (voir repair_filters).
+
+        (filters, gi) = repair_filters(Table_obs['Filter'])
+        Table_obs['Filter'] = filters
         logging.info(str(gi)+" Errors in filter name has been found and corrected")
 
         if len(Table_obs) != 0:
@@ -1320,6 +944,7 @@ def eso_search_images_2(Object,obj_center,Ra_box,DEC_box,tap_url):
             orig_id_sofi = []
 
     except Exception as e:
+        logging.warning("No SOFI image read ("+str(e)+")")
         N_sofi = 0
         planeURI_sofi = []
         dates_sofi = []
@@ -1340,20 +965,14 @@ def eso_search_images_2(Object,obj_center,Ra_box,DEC_box,tap_url):
     # fournir ces arguments sous forme de dictionnaire, en utilisant l’argument
     # params.
 
-    r = requests.get(tap_url, params=query_object_2(Object,obj_center,
-                                                    Ra_box,DEC_box,"WFI"))
-    #print r.url
-    rawTable = r.content
-    #with open('query2.csv', 'wb') as f:
-    #    f.write(rawTable)
-
-
     # On récupère les données sous forme de tableau en utilisant le module pandas
+    # Une erreur de l'archive pour cet instrument ne fait que le passer.
 
     try:
-        Table_obs = pd.read_csv(io.StringIO(rawTable.decode('utf-8')), header=0,
-                                quoting=1, quotechar='"',
-                                comment='#', index_col=False)
+        query = query_object_2(Object,obj_center,Ra_box,DEC_box,"WFI")
+        Table_obs = cache.cached_get(tap_url, params=query,
+                                     parse=lambda raw:
+                                         parse_wdb(raw,SCIENCE_COLUMNS))
                             
                             
         #print Table_obs.keys()
@@ -1362,64 +981,20 @@ def eso_search_images_2(Object,obj_center,Ra_box,DEC_box,tap_url):
         #print Table_obs['MJD-OBS'][1]
         #print Table_obs
                             
-        for ij , j in enumerate(Table_obs['Dataset ID']):
-            for it, i in enumerate(Table_obs['Orig Name']):
-                if it == ij:
-                    Orig_Id[j] = i
-                            
-        # ------------ Recherche des images ayant pas de noms défini ----------
-                            
-        # Certaines images, récent ou pas, n'ont pas de noms propres (NaN). Ils
-        # peuvent être important à les étudier. Pour les intégrer dans la
-        # recherche, il faut leur changer de noms
-                            
-        logging.info("Searching for unnamed objects present in WFI")
+        # Nom d'origine de chaque image, colonne contre colonne
+        Orig_Id.update(zip(Table_obs['Dataset ID'], Table_obs['Orig Name']))
                             
-        null_columns = Table_obs.columns[Table_obs.isnull().any()]
-        # On recherche dans le tableau, les colonnes où il y a des éléments vides
-        # et on fait le compte
-                                                   
-        counter = 0
-        for f in Table_obs['OBJECT'].isnull():
-            if f ==True:
-                counter +=1
-                            
-        #print counter
-        #print Table_obs
-        #sys.exit("test 2.2")
-                            
-        if counter != 0:
-            logging.info("There are "+str(counter)+" unnamed images found")
-            c = 0
-            # On fait le changement
-            N = len(Table_obs['OBJECT'])
-            for it, i in enumerate(Table_obs['OBJECT']):
-                update_process(N,it)
-                for ft, f in enumerate(Table_obs['OBJECT'].isnull()):
-                    if f ==True:
-                        if it == ft:
-                            c +=1
-                            Table_obs.loc[it, 'OBJECT'] = "unnamed_obj_"+str(c)
-            # La dernière ligne permet de changer les valeurs d'un tableau
-            # en évitant l'erreur SettingWithCopyWarning.
-            logging.info(str(c)+" unnamed images have been named")
-        else:
-            logging.info("No unnamed image has been found")
-
-        # Maintenant on regarde s'il existe des erreurs concernant le format pour
-        # les filtres utilises.
-
-        gi = 0
-        for it, i in enumerate(Table_obs['Filter']):
-	    if 'filter_name' in i:
-		# print i
-		(w1,w2,w3,w4) = i.split('=')
-		(y1,y2,y3) = w4.split('"')
-		(x1,x2) = y2.split('<')
-		u = '{},{}'.format(x1,w4[-5:-1])
-		# print u
-		Table_obs.loc[it, 'Filter'] = u
-		gi +=1
+        # ------------------ Images sans nom --------------------------------
+
+        # Les images sans nom (NaN) sont renommées unnamed_obj_N
+
+        results.normalize_results(Table_obs,"WFI",'OBJECT')
+
+        # Maintenant on regarde s'il existe des erreurs concernant le format
+        # pour les filtres utilises (voir repair_filters).
+
+        (filters, gi) = repair_filters(Table_obs['Filter'])
+        Table_obs['Filter'] = filters
         logging.info(str(gi)+" Errors in filter name has been found and corrected")
                                                         
         if len(Table_obs) != 0:
@@ -1441,6 +1016,7 @@ def eso_search_images_2(Object,obj_center,Ra_box,DEC_box,tap_url):
             orig_id_wfi = []
 
     except Exception as e:
+        logging.warning("No WFI image read ("+str(e)+")")
         N_wfi = 0
         planeURI_wfi = []
         dates_wfi = []
@@ -1461,20 +1037,14 @@ def eso_search_images_2(Object,obj_center,Ra_box,DEC_box,tap_url):
     # fournir ces arguments sous forme de dictionnaire, en utilisant l’argument
     # params.
 
-    r = requests.get(tap_url, params=query_object_2(Object,obj_center,
-                                                    Ra_box,DEC_box,"VIRCAM"))
-    #print r.url
-    rawTable = r.content
-    #with open('query2.csv', 'wb') as f:
-    #    f.write(rawTable)
-
-
     # On récupère les données sous forme de tableau en utilisant le module pandas
+    # Une erreur de l'archive pour cet instrument ne fait que le passer.
 
     try:
-        Table_obs = pd.read_csv(io.StringIO(rawTable.decode('utf-8')), header=0,
-                                quoting=1, quotechar='"',
-                                comment='#', index_col=False)
+        query = query_object_2(Object,obj_center,Ra_box,DEC_box,"VIRCAM")
+        Table_obs = cache.cached_get(tap_url, params=query,
+                                     parse=lambda raw:
+                                         parse_wdb(raw,SCIENCE_COLUMNS))
                             
                             
         #print Table_obs.keys()
@@ -1483,64 +1053,20 @@ def eso_search_images_2(Object,obj_center,Ra_box,DEC_box,tap_url):
         #print Table_obs['MJD-OBS'][1]
         #print Table_obs
                             
-        for ij , j in enumerate(Table_obs['Dataset ID']):
-            for it, i in enumerate(Table_obs['Orig Name']):
-                if it == ij:
-                    Orig_Id[j] = i
-                            
-        # -------------- Recherche des images ayant pas de noms défini ---------------
-                            
-        # Certaines images, récent ou pas, n'ont pas de noms propres (NaN). Ils
-        # peuvent être important à les étudier. Pour les intégrer dans la recherche,
-        # il faut leur changer de noms
+        # Nom d'origine de chaque image, colonne contre colonne
+        Orig_Id.update(zip(Table_obs['Dataset ID'], Table_obs['Orig Name']))
                             
-        logging.info("Searching for unnamed objects present in VIRCAM")
-                            
-        null_columns = Table_obs.columns[Table_obs.isnull().any()]
-        # On recherche dans le tableau, les colonnes où il y a des éléments vides
-        # et on fait le compte
-                                            
-        counter = 0
-        for f in Table_obs['OBJECT'].isnull():
-            if f ==True:
-                counter +=1
-                            
-        #print counter
-        #print Table_obs
-        #sys.exit("test 2.2")
-                            
-        if counter != 0:
-            logging.info("There are "+str(counter)+" unnamed images found")
-            c = 0
-            # On fait le changement
-            N = len(Table_obs['OBJECT'])
-            for it, i in enumerate(Table_obs['OBJECT']):
-                update_process(N,it)
-                for ft, f in enumerate(Table_obs['OBJECT'].isnull()):
-                    if f ==True:
-                        if it == ft:
-                            c +=1
-                            Table_obs.loc[it, 'OBJECT'] = "unnamed_obj_"+str(c)
-            # La dernière ligne permet de changer les valeurs d'un tableau
-            # en évitant l'erreur SettingWithCopyWarning.
-            logging.info(str(c)+" unnamed images have been named")
-        else:
-            logging.info("No unnamed image has been found")
-
-        # Maintenant on regarde s'il existe des erreurs concernant le format pour
-        # les filtres utilises.
-
-        gi = 0
-        for it, i in enumerate(Table_obs['Filter']):
-	    if 'filter_name' in i:
-		# print i
-		(w1,w2,w3,w4) = i.split('=')
-		(y1,y2,y3) = w4.split('"')
-		(x1,x2) = y2.split('<')
-		u = '{},{}'.format(x1,w4[-5:-1])
-		# print u
-		Table_obs.loc[it, 'Filter'] = u
-		gi +=1
+        # ------------------ Images sans nom --------------------------------
+
+        # Les images sans nom (NaN) sont renommées unnamed_obj_N
+
+        results.normalize_results(Table_obs,"VIRCAM",'OBJECT')
+
+        # Maintenant on regarde s'il existe des erreurs concernant le format
+        # pour les filtres utilises (voir repair_filters).
+
+        (filters, gi) = repair_filters(Table_obs['Filter'])
+        Table_obs['Filter'] = filters
         logging.info(str(gi)+" Errors in filter name has been found and corrected")
                             
         if len(Table_obs) != 0:
@@ -1562,6 +1088,7 @@ def eso_search_images_2(Object,obj_center,Ra_box,DEC_box,tap_url):
             orig_id_vircam = []
 
     except Exception as e:
+        logging.warning("No VIRCAM image read ("+str(e)+")")
         N_vircam = 0
         planeURI_vircam = []
         dates_vircam = []
@@ -1580,20 +1107,14 @@ def eso_search_images_2(Object,obj_center,Ra_box,DEC_box,tap_url):
     # fournir ces arguments sous forme de dictionnaire, en utilisant l’argument
     # params.
 
-    r = requests.get(tap_url, params=query_object_2(Object,obj_center,
-                                                    Ra_box,DEC_box,"OmegaCAM"))
-    #print r.url
-    rawTable = r.content
-    #with open('query2.csv', 'wb') as f:
-    #    f.write(rawTable)
-
-
     # On récupère les données sous forme de tableau en utilisant le module pandas
+    # Une erreur de l'archive pour cet instrument ne fait que le passer.
 
     try:
-        Table_obs = pd.read_csv(io.StringIO(rawTable.decode('utf-8')), header=0,
-                                quoting=1, quotechar='"',
-                                comment='#', index_col=False)
+        query = query_object_2(Object,obj_center,Ra_box,DEC_box,"OmegaCAM")
+        Table_obs = cache.cached_get(tap_url, params=query,
+                                     parse=lambda raw:
+                                         parse_wdb(raw,SCIENCE_COLUMNS))
                             
                             
         #print Table_obs.keys()
@@ -1602,64 +1123,20 @@ def eso_search_images_2(Object,obj_center,Ra_box,DEC_box,tap_url):
         #print Table_obs['MJD-OBS'][1]
         #print Table_obs
                             
-        for ij , j in enumerate(Table_obs['Dataset ID']):
-            for it, i in enumerate(Table_obs['Orig Name']):
-                if it == ij:
-                    Orig_Id[j] = i
-                            
-        # ------------- Recherche des images ayant pas de noms défini -----------
-                            
-        # Certaines images, récent ou pas, n'ont pas de noms propres (NaN). Ils
-        # peuvent être important à les étudier. Pour les intégrer dans la
-        # recherche, il faut leur changer de noms
+        # Nom d'origine de chaque image, colonne contre colonne
+        Orig_Id.update(zip(Table_obs['Dataset ID'], Table_obs['Orig Name']))
                             
-        logging.info("Searching for unnamed objects present in OmegaCAM")
-                            
-        null_columns = Table_obs.columns[Table_obs.isnull().any()]
-        # On recherche dans le tableau, les colonnes où il y a des éléments vides
-        # et on fait le compte
-                                            
-        counter = 0
-        for f in Table_obs['OBJECT'].isnull():
-            if f ==True:
-                counter +=1
-                            
-        #print counter
-        #print Table_obs
-        #sys.exit("test 2.2")
-                            
-        if counter != 0:
-            logging.info("There are "+str(counter)+" unnamed images found")
-            c = 0
-            # On fait le changement
-            N = len(Table_obs['OBJECT'])
-            for it, i in enumerate(Table_obs['OBJECT']):
-                update_process(N,it)
-                for ft, f in enumerate(Table_obs['OBJECT'].isnull()):
-                    if f ==True:
-                        if it == ft:
-                            c +=1
-                            Table_obs.loc[it, 'OBJECT'] = "unnamed_obj_"+str(c)
-            # La dernière ligne permet de changer les valeurs d'un tableau
-            # en évitant l'erreur SettingWithCopyWarning.
-            logging.info(str(c)+" unnamed images have been named")
-        else:
-            logging.info("No unnamed image has been found")
-
-        # Maintenant on regarde s'il existe des erreurs concernant le format pour
-        # les filtres utilises.
-
-        gi = 0
-        for it, i in enumerate(Table_obs['Filter']):
-	    if 'filter_name' in i:
-		# print i
-		(w1,w2,w3,w4) = i.split('=')
-		(y1,y2,y3) = w4.split('"')
-		(x1,x2) = y2.split('<')
-		u = '{},{}'.format(x1,w4[-5:-1])
-		# print u
-		Table_obs.loc[it, 'Filter'] = u
-		gi +=1
+        # ------------------ Images sans nom --------------------------------
+
+        # Les images sans nom (NaN) sont renommées unnamed_obj_N
+
+        results.normalize_results(Table_obs,"OmegaCAM",'OBJECT')
+
+        # Maintenant on regarde s'il existe des erreurs concernant le format
+        # pour les filtres utilises (voir repair_filters).
+
+        (filters, gi) = repair_filters(Table_obs['Filter'])
+        Table_obs['Filter'] = filters
         logging.info(str(gi)+" Errors in filter name has been found and corrected")
                             
         if len(Table_obs) != 0:
@@ -1681,6 +1158,7 @@ def eso_search_images_2(Object,obj_center,Ra_box,DEC_box,tap_url):
             orig_id_omegacam = []
 
     except Exception as e:
+        logging.warning("No OmegaCAM image read ("+str(e)+")")
         N_omegacam = 0
         planeURI_omegacam =[]
         dates_omegacam = []
@@ -1701,20 +1179,14 @@ def eso_search_images_2(Object,obj_center,Ra_box,DEC_box,tap_url):
     # fournir ces arguments sous forme de dictionnaire, en utilisant l’argument
     # params.
 
-    r = requests.get(tap_url, params=query_object_2(Object,obj_center,
-                                                    Ra_box,DEC_box,"VIMOS"))
-    #print r.url
-    rawTable = r.content
-    #with open('query2.csv', 'wb') as f:
-    #    f.write(rawTable)
-
-
     # On récupère les données sous forme de tableau en utilisant le module pandas
+    # Une erreur de l'archive pour cet instrument ne fait que le passer.
 
     try:
-        Table_obs = pd.read_csv(io.StringIO(rawTable.decode('utf-8')), header=0,
-                                quoting=1, quotechar='"',
-                                comment='#', index_col=False)
+        query = query_object_2(Object,obj_center,Ra_box,DEC_box,"VIMOS")
+        Table_obs = cache.cached_get(tap_url, params=query,
+                                     parse=lambda raw:
+                                         parse_wdb(raw,SCIENCE_COLUMNS))
                             
                             
         #print Table_obs.keys()
@@ -1723,65 +1195,20 @@ def eso_search_images_2(Object,obj_center,Ra_box,DEC_box,tap_url):
         #print Table_obs['MJD-OBS'][1]
         #print Table_obs
                             
-        for ij , j in enumerate(Table_obs['Dataset ID']):
-            for it, i in enumerate(Table_obs['Orig Name']):
-                if it == ij:
-                    Orig_Id[j] = i
-                            
-        # ----------- Recherche des images ayant pas de noms défini ------------
+        # Nom d'origine de chaque image, colonne contre colonne
+        Orig_Id.update(zip(Table_obs['Dataset ID'], Table_obs['Orig Name']))
                             
-        # Certaines images, récent ou pas, n'ont pas de noms propres (NaN). Ils
-        # peuvent être important à les étudier. Pour les intégrer dans la
-        # recherche, il faut leur changer de noms
-                            
-        logging.info("Searching for unnamed objects present in VIMOS")
-                            
-        null_columns = Table_obs.columns[Table_obs.isnull().any()]
-        # On recherche dans le tableau, les colonnes où il y a des éléments vides
-        # et on fait le compte
-                            
-                            
-        counter = 0
-        for f in Table_obs['OBJECT'].isnull():
-            if f ==True:
-                counter +=1
-                            
-        #print counter
-        #print Table_obs
-        #sys.exit("test 2.2")
-                            
-        if counter != 0:
-            logging.info("There are "+str(counter)+" unnamed images found")
-            c = 0
-            # On fait le changement
-            N = len(Table_obs['OBJECT'])
-            for it, i in enumerate(Table_obs['OBJECT']):
-                update_process(N,it)
-                for ft, f in enumerate(Table_obs['OBJECT'].isnull()):
-                    if f ==True:
-                        if it == ft:
-                            c +=1
-                            Table_obs.loc[it, 'OBJECT'] = "unnamed_obj_"+str(c)
-            # La dernière ligne permet de changer les valeurs d'un tableau
-            # en évitant l'erreur SettingWithCopyWarning.
-            logging.info(str(c)+" unnamed images have been named")
-        else:
-            logging.info("No unnamed image has been found")
-
-        # Maintenant on regarde s'il existe des erreurs concernant le format pour
-        # les filtres utilises.
-
-        gi = 0
-        for it, i in enumerate(Table_obs['Filter']):
-	    if 'filter_name' in i:
-		# print i
-		(w1,w2,w3,w4) = i.split('=')
-		(y1,y2,y3) = w4.split('"')
-		(x1,x2) = y2.split('<')
-		u = '{},{}'.format(x1,w4[-5:-1])
-		# print u
-		Table_obs.loc[it, 'Filter'] = u
-		gi +=1
+        # ------------------ Images sans nom --------------------------------
+
+        # Les images sans nom (NaN) sont renommées unnamed_obj_N
+
+        results.normalize_results(Table_obs,"VIMOS",'OBJECT')
+
+        # Maintenant on regarde s'il existe des erreurs concernant le format
+        # pour les filtres utilises (voir repair_filters).
+
+        (filters, gi) = repair_filters(Table_obs['Filter'])
+        Table_obs['Filter'] = filters
         logging.info(str(gi)+" Errors in filter name has been found and corrected")
                             
         if len(Table_obs) != 0:
@@ -1803,6 +1230,7 @@ def eso_search_images_2(Object,obj_center,Ra_box,DEC_box,tap_url):
             orig_id_vimos = []
 
     except Exception as e:
+        logging.warning("No VIMOS image read ("+str(e)+")")
         N_vimos = 0
         planeURI_vimos = []
         dates_vimos = []
@@ -1821,20 +1249,14 @@ def eso_search_images_2(Object,obj_center,Ra_box,DEC_box,tap_url):
     # fournir ces arguments sous forme de dictionnaire, en utilisant l’argument
     # params.
 
-    r = requests.get(tap_url, params=query_object_2(Object,obj_center,
-                                                    Ra_box,DEC_box,"FORS1"))
-    #print r.url
-    rawTable = r.content
-    #with open('query2.csv', 'wb') as f:
-    #    f.write(rawTable)
-
-
     # On récupère les données sous forme de tableau en utilisant le module pandas
+    # Une erreur de l'archive pour cet instrument ne fait que le passer.
 
     try:
-        Table_obs = pd.read_csv(io.StringIO(rawTable.decode('utf-8')), header=0,
-                                quoting=1, quotechar='"',
-                                comment='#', index_col=False)
+        query = query_object_2(Object,obj_center,Ra_box,DEC_box,"FORS1")
+        Table_obs = cache.cached_get(tap_url, params=query,
+                                     parse=lambda raw:
+                                         parse_wdb(raw,SCIENCE_COLUMNS))
                             
                             
         #print Table_obs.keys()
@@ -1844,65 +1266,20 @@ def eso_search_images_2(Object,obj_center,Ra_box,DEC_box,tap_url):
         #print Table_obs['MJD-OBS'][1]
         #print Table_obs
                             
-        for ij , j in enumerate(Table_obs['Dataset ID']):
-            for it, i in enumerate(Table_obs['Orig Name']):
-                if it == ij:
-                    Orig_Id[j] = i
-                            
-        # ----------- Recherche des images ayant pas de noms défini -------------
-                            
-        # Certaines images, récent ou pas, n'ont pas de noms propres (NaN). Ils
-        # peuvent être important à les étudier. Pour les intégrer dans la
-        # recherche, il faut leur changer de noms
-                            
-        logging.info("Searching for unnamed objects present in FORS1")
-                            
-        null_columns = Table_obs.columns[Table_obs.isnull().any()]
-        # On recherche dans le tableau, les colonnes où il y a des éléments vides
-        # et on fait le compte
-                            
+        # Nom d'origine de chaque image, colonne contre colonne
+        Orig_Id.update(zip(Table_obs['Dataset ID'], Table_obs['Orig Name']))
                             
-        counter = 0
-        for f in Table_obs['OBJECT'].isnull():
-            if f ==True:
-                counter +=1
-                            
-        #print counter
-        #print Table_obs
-        #sys.exit("test 2.2")
-                            
-        if counter != 0:
-            logging.info("There are "+str(counter)+" unnamed images found")
-            c = 0
-            # On fait le changement
-            N = len(Table_obs['OBJECT'])
-            for it, i in enumerate(Table_obs['OBJECT']):
-                update_process(N,it)
-                for ft, f in enumerate(Table_obs['OBJECT'].isnull()):
-                    if f ==True:
-                        if it == ft:
-                            c +=1
-                            Table_obs.loc[it, 'OBJECT'] = "unnamed_obj_"+str(c)
-            # La dernière ligne permet de changer les valeurs d'un tableau
-            # en évitant l'erreur SettingWithCopyWarning.
-            logging.info(str(c)+" unnamed images have been named")
-        else:
-            logging.info("No unnamed image has been found")
-
-        # Maintenant on regarde s'il existe des erreurs concernant le format pour
-        # les filtres utilises.
-
-        gi = 0
-        for it, i in enumerate(Table_obs['Filter']):
-	    if 'filter_name' in i:
-		# print i
-		(w1,w2,w3,w4) = i.split('=')
-		(y1,y2,y3) = w4.split('"')
-		(x1,x2) = y2.split('<')
-		u = '{},{}'.format(x1,w4[-5:-1])
-		# print u
-		Table_obs.loc[it, 'Filter'] = u
-		gi +=1
+        # ------------------ Images sans nom --------------------------------
+
+        # Les images sans nom (NaN) sont renommées unnamed_obj_N
+
+        results.normalize_results(Table_obs,"FORS1",'OBJECT')
+
+        # Maintenant on regarde s'il existe des erreurs concernant le format
+        # pour les filtres utilises (voir repair_filters).
+
+        (filters, gi) = repair_filters(Table_obs['Filter'])
+        Table_obs['Filter'] = filters
         logging.info(str(gi)+" Errors in filter name has been found and corrected")
                           
         if len(Table_obs) != 0:
@@ -1924,6 +1301,7 @@ def eso_search_images_2(Object,obj_center,Ra_box,DEC_box,tap_url):
             orig_id_fors1 = []
 
     except Exception as e:
+        logging.warning("No FORS1 image read ("+str(e)+")")
         N_fors1 = 0
         planeURI_fors1 = []
         dates_fors1 = []
@@ -1942,20 +1320,14 @@ def eso_search_images_2(Object,obj_center,Ra_box,DEC_box,tap_url):
     # fournir ces arguments sous forme de dictionnaire, en utilisant l’argument
     # params.
 
-    r = requests.get(tap_url, params=query_object_2(Object,obj_center,
-                                                    Ra_box,DEC_box,"FORS2"))
-    #print r.url
-    rawTable = r.content
-    #with open('query2.csv', 'wb') as f:
-    #    f.write(rawTable)
-
-
     # On récupère les données sous forme de tableau en utilisant le module pandas
+    # Une erreur de l'archive pour cet instrument ne fait que le passer.
 
     try:
-        Table_obs = pd.read_csv(io.StringIO(rawTable.decode('utf-8')), header=0,
-                                quoting=1, quotechar='"',
-                                comment='#', index_col=False)
+        query = query_object_2(Object,obj_center,Ra_box,DEC_box,"FORS2")
+        Table_obs = cache.cached_get(tap_url, params=query,
+                                     parse=lambda raw:
+                                         parse_wdb(raw,SCIENCE_COLUMNS))
                             
                             
         #print Table_obs.keys()
@@ -1964,64 +1336,20 @@ def eso_search_images_2(Object,obj_center,Ra_box,DEC_box,tap_url):
         #print Table_obs['Filter'][1]
         #print Table_obs['MJD-OBS'][1]
                             
-        for ij , j in enumerate(Table_obs['Dataset ID']):
-            for it, i in enumerate(Table_obs['Orig Name']):
-                if it == ij:
-                    Orig_Id[j] = i
-                            
-        # ----------- Recherche des images ayant pas de noms défini -------------
-                            
-        # Certaines images, récent ou pas, n'ont pas de noms propres (NaN). Ils
-        # peuvent être important à les étudier. Pour les intégrer dans la
-        # recherche, il faut leur changer de noms
-                            
-        logging.info("Searching for unnamed objects present in FORS2")
+        # Nom d'origine de chaque image, colonne contre colonne
+        Orig_Id.update(zip(Table_obs['Dataset ID'], Table_obs['Orig Name']))
                             
-        null_columns = Table_obs.columns[Table_obs.isnull().any()]
-        # On recherche dans le tableau, les colonnes où il y a des éléments vides
-        # et on fait le compte
-                                                   
-        counter = 0
-        for f in Table_obs['OBJECT'].isnull():
-            if f ==True:
-                counter +=1
-                            
-        #print counter
-        #print Table_obs
-        #sys.exit("test 2.2")
-                            
-        if counter != 0:
-            logging.info("There are "+str(counter)+" unnamed images found")
-            c = 0
-            # On fait le changement
-            N = len(Table_obs['OBJECT'])
-            for it, i in enumerate(Table_obs['OBJECT']):
-                update_process(N,it)
-                for ft, f in enumerate(Table_obs['OBJECT'].isnull()):
-                    if f ==True:
-                        if it == ft:
-                            c +=1
-                            Table_obs.loc[it, 'OBJECT'] = "unnamed_obj_"+str(c)
-            # La dernière ligne permet de changer les valeurs d'un tableau
-            # en évitant l'erreur SettingWithCopyWarning.
-            logging.info(str(c)+" unnamed images have been named")
-        else:
-            logging.info("No unnamed image has been found")
-
-        # Maintenant on regarde s'il existe des erreurs concernant le format pour
-        # les filtres utilises.
-
-        gi = 0
-        for it, i in enumerate(Table_obs['Filter']):
-	    if 'filter_name' in i:
-		# print i
-		(w1,w2,w3,w4) = i.split('=')
-		(y1,y2,y3) = w4.split('"')
-		(x1,x2) = y2.split('<')
-		u = '{},{}'.format(x1,w4[-5:-1])
-		# print u
-		Table_obs.loc[it, 'Filter'] = u
-		gi +=1
+        # ------------------ Images sans nom --------------------------------
+
+        # Les images sans nom (NaN) sont renommées unnamed_obj_N
+
+        results.normalize_results(Table_obs,"FORS2",'OBJECT')
+
+        # Maintenant on regarde s'il existe des erreurs concernant le format
+        # pour les filtres utilises (voir repair_filters).
+
+        (filters, gi) = repair_filters(Table_obs['Filter'])
+        Table_obs['Filter'] = filters
         logging.info(str(gi)+" Errors in filter name has been found and corrected")
                             
         if len(Table_obs) != 0:
@@ -2043,6 +1371,7 @@ def eso_search_images_2(Object,obj_center,Ra_box,DEC_box,tap_url):
             orig_id_fors2 = []
 
     except Exception as e:
+        logging.warning("No FORS2 image read ("+str(e)+")")
         N_fors2 = 0
         planeURI_fors2 = []
         dates_fors2 = []
@@ -2061,20 +1390,14 @@ def eso_search_images_2(Object,obj_center,Ra_box,DEC_box,tap_url):
     # fournir ces arguments sous forme de dictionnaire, en utilisant l’argument
     # params.
 
-    r = requests.get(tap_url, params=query_object_2(Object,obj_center,
-                                                    Ra_box,DEC_box,"HAWKI"))
-    #print r.url
-    rawTable = r.content
-    #with open('query2.csv', 'wb') as f:
-    #    f.write(rawTable)
-
-
     # On récupère les données sous forme de tableau en utilisant le module pandas
+    # Une erreur de l'archive pour cet instrument ne fait que le passer.
 
     try:
-        Table_obs = pd.read_csv(io.StringIO(rawTable.decode('utf-8')), header=0,
-                                quoting=1, quotechar='"',
-                                comment='#', index_col=False)
+        query = query_object_2(Object,obj_center,Ra_box,DEC_box,"HAWKI")
+        Table_obs = cache.cached_get(tap_url, params=query,
+                                     parse=lambda raw:
+                                         parse_wdb(raw,SCIENCE_COLUMNS))
                             
                             
         #print Table_obs.keys()
@@ -2083,64 +1406,20 @@ def eso_search_images_2(Object,obj_center,Ra_box,DEC_box,tap_url):
         #print Table_obs['MJD-OBS'][1]
         #print Table_obs
                             
-        for ij , j in enumerate(Table_obs['Dataset ID']):
-            for it, i in enumerate(Table_obs['Orig Name']):
-                if it == ij:
-                    Orig_Id[j] = i
-                            
-        # ----------- Recherche des images ayant pas de noms défini ------------
-                            
-        # Certaines images, récent ou pas, n'ont pas de noms propres (NaN). Ils
-        # peuvent être important à les étudier. Pour les intégrer dans la
-        # recherche, il faut leur changer de noms
-                            
-        logging.info("Searching for unnamed objects present in HAWKI")
+        # Nom d'origine de chaque image, colonne contre colonne
+        Orig_Id.update(zip(Table_obs['Dataset ID'], Table_obs['Orig Name']))
                             
-        null_columns = Table_obs.columns[Table_obs.isnull().any()]
-        # On recherche dans le tableau, les colonnes où il y a des éléments vides
-        # et on fait le compte
-                                            
-        counter = 0
-        for f in Table_obs['OBJECT'].isnull():
-            if f ==True:
-                counter +=1
-                            
-        #print counter
-        #print Table_obs
-        #sys.exit("test 2.2")
-                            
-        if counter != 0:
-            logging.info("There are "+str(counter)+" unnamed images found")
-            c = 0
-            # On fait le changement
-            N = len(Table_obs['OBJECT'])
-            for it, i in enumerate(Table_obs['OBJECT']):
-                update_process(N,it)
-                for ft, f in enumerate(Table_obs['OBJECT'].isnull()):
-                    if f ==True:
-                        if it == ft:
-                            c +=1
-                            Table_obs.loc[it, 'OBJECT'] = "unnamed_obj_"+str(c)
-            # La dernière ligne permet de changer les valeurs d'un tableau
-            # en évitant l'erreur SettingWithCopyWarning.
-            logging.info(str(c)+" unnamed images have been named")
-        else:
-            logging.info("No unnamed image has been found")
-
-        # Maintenant on regarde s'il existe des erreurs concernant le format pour
-        # les filtres utilises.
-
-        gi = 0
-        for it, i in enumerate(Table_obs['Filter']):
-	    if 'filter_name' in i:
-		# print i
-		(w1,w2,w3,w4) = i.split('=')
-		(y1,y2,y3) = w4.split('"')
-		(x1,x2) = y2.split('<')
-		u = '{},{}'.format(x1,w4[-5:-1])
-		# print u
-		Table_obs.loc[it, 'Filter'] = u
-		gi +=1
+        # ------------------ Images sans nom --------------------------------
+
+        # Les images sans nom (NaN) sont renommées unnamed_obj_N
+
+        results.normalize_results(Table_obs,"HAWKI",'OBJECT')
+
+        # Maintenant on regarde s'il existe des erreurs concernant le format
+        # pour les filtres utilises (voir repair_filters).
+
+        (filters, gi) = repair_filters(Table_obs['Filter'])
+        Table_obs['Filter'] = filters
         logging.info(str(gi)+" Errors in filter name has been found and corrected")
                             
         if len(Table_obs) != 0:
@@ -2162,6 +1441,7 @@ def eso_search_images_2(Object,obj_center,Ra_box,DEC_box,tap_url):
             orig_id_hawki = []
 
     except Exception as e:
+        logging.warning("No HAWKI image read ("+str(e)+")")
         N_hawki = 0
         planeURI_hawki = []
         dates_hawki = []
@@ -2273,7 +1553,111 @@ def query_flat(date,interval,Filter,inst):
 
     return query
 
-# Maintenant on va chercher ces dossiers pour les instruments CFHT
+# Comme pour CFHT, on ne fait plus 2 requêtes par image scientifique: les
+# fenêtres [date-interval/2, date+interval/2] qui se chevauchent sont fusionnées
+# (par filtre pour les flats). Les calibrations sont rangées par nuit dans
+# l'index local (calibration_module): seules les nuits encore absentes de
+# l'index sont demandées au WDB, une fois pour toutes les cibles. Une requête
+# qui atteint la limite de 20000 lignes est coupée en deux. Les 10
+# calibrations les plus proches de chaque image sont ensuite choisies
+# localement.
+
+FBD_MAX_SPAN = 730.0 # jours, longueur maximale d'une fenêtre fusionnée
+N_FBD = 10 # calibrations gardées par image et par type
+WDB_TOP = 20000 # lignes max renvoyées par une requête
+
+# Colonnes des tableaux de calibrations (dataset, nom, type, début, fin)
+FBD_COLUMNS = ['Dataset ID','Orig Name','Type','MJD-OBS',None]
+
+def merge_windows(dates,interval,max_span=FBD_MAX_SPAN):
+
+    windows = []
+    for date in np.sort(np.asarray(dates, dtype=float)):
+        lo = date - 0.5*interval
+        hi = date + 0.5*interval
+        if (windows and lo <= windows[-1][1] and
+            (max_span is None or hi - windows[-1][0] <= max_span)):
+            windows[-1][1] = hi
+        else:
+            windows.append([lo, hi])
+
+    return windows
+
+# Calibrations d'une fenêtre [lo, hi]. make_query(date, interval) renvoie les
+# paramètres de la requête. Une réponse illisible lève une exception. Renvoie
+# le tableau et la liste des fenêtres [lo, hi] encore tronquées (une nuit ou
+# moins, qui atteint toujours WDB_TOP lignes): leurs nuits sont incomplètes.
+
+def fetch_fbd_window(tap_url,lo,hi,make_query,sofi_flat=False):
+
+    table = cache.cached_get(tap_url, params=make_query(0.5*(lo+hi), hi-lo),
+                             parse=lambda raw:
+                                 parse_wdb(raw,FBD_COLUMNS,sofi_flat))
+    if len(table) < WDB_TOP:
+        return table, []
+
+    if hi - lo <= 1.0:
+        logging.warning("WDB response truncated to "+str(WDB_TOP)+" rows "
+                        "between MJD "+str(lo)+" and "+str(hi)
+                        +", these nights will be requested again")
+        return table, [(lo, hi)]
+
+    # Fenêtre tronquée: on la coupe en deux
+    mid = 0.5*(lo+hi)
+    table_lo, truncated_lo = fetch_fbd_window(tap_url,lo,mid,make_query,
+                                              sofi_flat)
+    table_hi, truncated_hi = fetch_fbd_window(tap_url,mid,hi,make_query,
+                                              sofi_flat)
+    table = pd.concat([table_lo, table_hi], ignore_index=True)
+    table = table.drop_duplicates('Dataset ID').reset_index(drop=True)
+
+    return table, truncated_lo+truncated_hi
+
+# Calibrations des fenêtres, lues dans l'index après avoir demandé au WDB les
+# nuits manquantes. key: ('ESO', instrument, type, filtre).
+
+def fetch_calibrations(tap_url,key,windows,make_query,sofi_flat=False):
+
+    db = calibration.open_index()
+    ranges = calibration.missing_ranges(db,key,windows,FBD_MAX_SPAN)
+    logging.info(str(len(ranges))+" WDB requests for the missing nights of "
+                 +" ".join(k for k in key[1:] if k != ""))
+
+    for first, last in ranges:
+        try:
+            table, truncated = fetch_fbd_window(tap_url,first,last+1,
+                                                make_query,sofi_flat)
+        except Exception as e:
+            logging.warning("No calibration read for "+str(key)+" between MJD "
+                            +str(first)+" and "+str(last+1)+" ("+str(e)+")")
+            continue
+
+        mjd = pd.to_numeric(table['MJD-OBS'], errors='coerce').values
+        rows = [(str(d), None if pd.isnull(n) else str(n), str(t), m, None)
+                for (d, n, t, m) in zip(table['Dataset ID'],
+                                        table['Orig Name'],table['Type'],mjd)
+                if not np.isnan(m)]
+        incomplete = set()
+        for lo, hi in truncated:
+            incomplete.update(calibration.window_nights(lo,hi))
+        calibration.add_nights(db,key,first,last,rows,incomplete)
+
+    return calibration.calibration_table(db,key,windows,FBD_COLUMNS)
+
+# Lignes des N_FBD calibrations les plus proches de date dans [date-interval/2,
+# date+interval/2], et leur écart en jours
+
+def nearest_fbd(table,date,interval):
+
+    mjd = pd.to_numeric(table['MJD-OBS'], errors='coerce').values
+    with np.errstate(invalid='ignore'):
+        inside = np.where(np.abs(mjd - date) <= 0.5*interval)[0]
+    dt = np.abs(mjd[inside] - date)
+    order = np.argsort(dt, kind='mergesort')[:N_FBD]
+
+    return inside[order], dt[order]
+
+# Maintenant on va chercher ces dossiers pour les instruments ESO
 
 def Search_FBD(dates,filters,orig_id,inst,Orig_Id,tap_url):
 
@@ -2284,163 +1668,108 @@ def Search_FBD(dates,filters,orig_id,inst,Orig_Id,tap_url):
     N = len(dates)
     logging.info("Searching BIAS, DARK and FLAT for "+inst+" observations")
 
+    dates = np.asarray(dates, dtype=float)
+    # Les filtres viennent en principe de la recherche, déjà corrigés
+    (filters, n) = repair_filters(list(filters))
+    filters = np.asarray(list(filters), dtype=object)
+    orig_id = list(orig_id)
+
+    # --------------------- Requêtes par fenêtres fusionnées -------------------
+    windows = merge_windows(dates,dt4bias)
+    temp_bds = fetch_calibrations(tap_url, ('ESO', inst, 'BIAS/DARK', ''),
+                                  windows,
+                                  lambda date, interval:
+                                      query_bias_dark(date,interval,inst))
+
+    # De plus on identifie les différent type d'objet; Bias ou Dark
+    temp_bias = temp_bds.loc[temp_bds['Type'] ==
+                             'BIAS'].reset_index(drop=True)
+
+    temp_dark = temp_bds.loc[temp_bds['Type'] ==
+                             'DARK'].reset_index(drop=True)
+    temp_bds = None
+
+    temp_flats = {}
+    for filt in set(filters):
+        windows = merge_windows(dates[filters == filt],dt4flat)
+        temp_flats[filt] = fetch_calibrations(tap_url,
+                                              ('ESO', inst, 'FLAT', str(filt)),
+                                              windows,
+                                              lambda date, interval:
+                                                  query_flat(date,interval,
+                                                             filt,inst),
+                                              inst == "SOFI")
+
     # La fonction np.empty renvoie un nouveau tableau de forme et de type donné,
     # avec des valeurs aléatoires. Dans ce cas N listes de 10 valeurs.
 
-    URIs_bias = np.empty((N,10), dtype=object)
-    URIs_dark = np.empty((N,10), dtype=object)
-    URIs_flat = np.empty((N,10), dtype=object)
+    URIs_bias = np.empty((N,N_FBD), dtype=object)
+    URIs_dark = np.empty((N,N_FBD), dtype=object)
+    URIs_flat = np.empty((N,N_FBD), dtype=object)
 
     for i,(date,filt,orID) in enumerate(zip(dates,filters,orig_id)):
         update_process(N,i)
 
-        #print date
-        #print filt
-        try:
-            # Idem que payload voir étapes précédents
-
-            r = requests.get(tap_url, params=query_bias_dark(date,dt4bias,inst))
-            rawTable = r.content
-
-            # On récupère les données sous forme de tableau en utilisant le
-            # module pandas
-            
-            temp_bds = pd.read_csv(io.StringIO(rawTable.decode('utf-8')),
-                                   header=0,quoting=1, quotechar='"',
-                                   comment='#', index_col=False)
-            # print temp_bds.keys()
-
-            # De plus on identifie les différent type d'objet; Bias ou Dark
-            temp_bias = temp_bds.loc[temp_bds['Type'] ==
-                                     'BIAS'].reset_index(drop=True)
-
-            temp_dark = temp_bds.loc[temp_bds['Type'] ==
-                                    'DARK'].reset_index(drop=True)
-
-        except Exception as e:
-            temp_bias = []
-            temp_dark = []
-
         #------------------------------- BIAS ----------------------------------
         URIs_bias[i,:] = None
-        if len(temp_bias) != 0:
-            # On ne garde que des recents objets
-            dt_bias = np.abs(temp_bias['MJD-OBS'] - date)
-            try:
-                bias_id = np.argsort(dt_bias)[:10]
-            except Exception as e:
-                logging.warning(str("Object ",orID," with less than 10 BIAS."))
-                bias_id = np.argsort(dt_bias)
-                pass
-
+        (bias_id, dt_bias) = nearest_fbd(temp_bias,date,dt4bias)
+        if len(bias_id) != 0:
             # En cas de durée très longue
-            if any(dt_bias[bias_id] > dt4bias):
+            if any(dt_bias > dt4bias):
                 logging.warning("Bias time span for object "+str(orID)+" :"
-                                +str(np.max(dt_bias[bias_id]))+" MJDs.")
+                                +str(np.max(dt_bias))+" MJDs.")
 
             # On ajoute ces fichiers dans leur tableau correspondant.
             URIs_bias[i,:len(bias_id)] = temp_bias['Dataset ID'].iloc[bias_id]
             
             # On garde aussi leur noms origines
-            for ij , j in enumerate(temp_bias['Dataset ID'].iloc[bias_id]):
-                for lt, l in enumerate(temp_bias['Orig Name'].iloc[bias_id]):
-                    if lt == ij:
-                        Orig_Id[j] = l
-                            
+            Orig_Id.update(zip(temp_bias['Dataset ID'].iloc[bias_id],
+                               temp_bias['Orig Name'].iloc[bias_id]))
 
         else:
             logging.warning("No BIAS file for object: "+str(orID))
 
         #------------------------------- DARK ----------------------------------
         URIs_dark[i,:] = None
-        if len(temp_dark) != 0:
-            # On ne garde que des recents objets
-            dt_dark = np.abs(temp_dark['MJD-OBS'] - date)
-            try:
-                dark_id = np.argsort(dt_dark)[:10]
-            except Exception as e:
-                logging.warning(str("Object ",orID," with less than 10 DARKS."))
-                dark_id = np.argsort(dt_dark)
-                pass
-    
+        (dark_id, dt_dark) = nearest_fbd(temp_dark,date,dt4bias)
+        if len(dark_id) != 0:
             # En cas de durée très longue
-            if any(dt_dark[dark_id] > dt4bias):
+            if any(dt_dark > dt4bias):
                 logging.warning("Dark time span for object "+str(orID)+" :"
-                                +str(np.max(dt_dark[dark_id]))+" MJDs.")
+                                +str(np.max(dt_dark))+" MJDs.")
     
             # On ajoute ces fichiers dans leur tableau correspondant.
             URIs_dark[i,:len(dark_id)] = temp_dark['Dataset ID'].iloc[dark_id]
 
             # On garde aussi leur noms origines
-            for ij , j in enumerate(temp_dark['Dataset ID'].iloc[dark_id]):
-                for lt, l in enumerate(temp_dark['Orig Name'].iloc[dark_id]):
-                    if lt == ij:
-                        Orig_Id[j] = l
-                            
+            Orig_Id.update(zip(temp_dark['Dataset ID'].iloc[dark_id],
+                               temp_dark['Orig Name'].iloc[dark_id]))
 
         else:
             logging.warning("No DARK file for object: "+str(orID))
 
-        temp_bds = None
-        temp_bias = []
-        temp_dark = []
-
 
         #------------------------------ FLAT ------------------------------------
-
-        try:
-            r = requests.get(tap_url, params=query_flat(date,dt4flat,filt,inst))
-            rawTable = r.content
-    
-            # On récupère les données sous forme de tableau en utilisant le
-            # module pandas
-
-            # Conditionnement sur sofi
-            if inst == "SOFI":
-                temp_flat = pd.read_csv(io.StringIO(rawTable.decode('utf-8')),
-                                        header=0,quoting=3, escapechar='>',
-                                        quotechar='"',comment='#',index_col=False)
-            else:
-                temp_flat = pd.read_csv(io.StringIO(rawTable.decode('utf-8')),
-                                        header=0,quoting=1, quotechar='"',
-                                        comment='#', index_col=False)
-
-            # print temp_flat
-
-        except Exception as e:
-            temp_flat = []
+        temp_flat = temp_flats[filt]
 
         URIs_flat[i,:] = None
-        if len(temp_flat) != 0:
-            # On ne garde que des recents objets
-            dt_flat = np.abs(temp_flat['MJD-OBS'] - date)
-            try:
-                flat_id = np.argsort(dt_flat)[:10]
-            except Exception as e:
-                logging.warning(str("Object ",orID," with less than 10 FLATS."))
-                flat_id = np.argsort(dt_flat)
-                pass
-    
+        (flat_id, dt_flat) = nearest_fbd(temp_flat,date,dt4flat)
+        if len(flat_id) != 0:
             # En cas de durée très longue
-            if any(dt_flat[flat_id] > dt4flat):
+            if any(dt_flat > dt4flat):
                 logging.warning("Flat time span for object "+str(orID)+" :"
-                                +str(np.max(dt_dark[dark_id]))+" MJDs.")
+                                +str(np.max(dt_flat))+" MJDs.")
     
             # On ajoute ces fichiers dans leur tableau correspondant.
             URIs_flat[i,:len(flat_id)] = temp_flat['Dataset ID'].iloc[flat_id]
 
             # On garde aussi leur noms origines
-            for ij , j in enumerate(temp_flat['Dataset ID'].iloc[flat_id]):
-                for lt, l in enumerate(temp_flat['Orig Name'].iloc[flat_id]):
-                    if lt == ij:
-                        Orig_Id[j] = l
-                            
+            Orig_Id.update(zip(temp_flat['Dataset ID'].iloc[flat_id],
+                               temp_flat['Orig Name'].iloc[flat_id]))
 
         else:
             logging.warning("No FLAT file for object: "+str(orID))
 
-        temp_flat = []
-
     # Création des listes planeURI des objets de type FBD
     planeURI_fbd = np.concatenate((URIs_bias.flatten(), URIs_dark.flatten(),
                                    URIs_flat.flatten()), axis=0)
@@ -2465,7 +1794,89 @@ def Search_FBD(dates,filters,orig_id,inst,Orig_Id,tap_url):
 
 # Avant de telecharger, il faut envoyer la requete des images sur le site de
 # ESO. Pour cela il faut une autorisation, soit un identifiant et un mot de
-# passe. On défini donc:
+# passe. Les requêtes passent par l'API du "request handler" d'ESO:
+#
+#   POST {request_url}{usr}/submission        -> numéro de la requête
+#   GET  {request_url}{usr}/{requête}/state   -> état (COMPLETE quand prête)
+#   GET  {request_url}{usr}/recentRequests    -> requêtes récentes
+
+reqlim = 10000 # seulement 10000 images par requete
+header = {'Accept': 'text/plain'}
+poll_min = 30. # secondes avant la 1re vérification de l'état d'une requête
+poll_max = 1800. # intervalle maximal entre 2 vérifications
+READY_STATES = ('COMPLETE',)
+FAILED_STATES = ('ERROR', 'ABORTED')
+
+# Images de tous les instruments: on additionne pour chacun les 2 listes
+# planeURI (images + calibrations) et on retire les doublures. instruments est
+# une liste de (instrument, planeURI, planeURI_fbd); renvoie une liste de
+# (instrument, Dataset ID).
+
+def eso_datasets(instruments):
+
+    datasets = []
+    seen = set()
+    for (inst, planeURI, planeURI_fbd) in instruments:
+        for plist in list(planeURI)+list(planeURI_fbd):
+            plist = str(plist)
+            if plist not in seen:
+                seen.add(plist)
+                datasets.append((inst, plist))
+
+    return datasets
+
+# Numéros des requêtes récentes de l'utilisateur: premier champ de chaque ligne
+
+def recent_requests(session,request_url,usr):
+
+    q = session.get(request_url+usr+'/recentRequests', headers=header,
+                    timeout=download.timeout)
+    q.raise_for_status()
+
+    rids = set()
+    for line in q.text.splitlines():
+        fields = re.split(r'[,\s]+', line.strip())
+        if fields[0].isdigit():
+            rids.add(fields[0])
+
+    return rids
+
+# Envoie une requête et renvoie son numéro. ESO le donne dans la réponse; sinon
+# on prend la nouvelle requête apparue dans recentRequests.
+
+def submit_eso_request(session,request_url,usr,datasets):
+
+    try:
+        before = recent_requests(session,request_url,usr)
+    except requests.exceptions.RequestException:
+        before = None
+
+    payload = {'dataset': ','.join(['SAF+{}'.format(j) for j in datasets])}
+    d = session.post(request_url+usr+'/submission', headers=header,
+                     data=payload, timeout=download.timeout)
+    d.raise_for_status()
+
+    rid = d.text.strip()
+    if rid.isdigit():
+        return rid
+
+    if before is not None:
+        new = recent_requests(session,request_url,usr) - before
+        if len(new) != 0:
+            return max(new, key=int)
+
+    raise IOError("ESO did not return a request number ("+d.text[:100]+")")
+
+def eso_request_state(session,request_url,usr,rid):
+
+    r = session.get(request_url+usr+'/'+rid+'/state', headers=header,
+                    timeout=download.timeout)
+    r.raise_for_status()
+
+    return r.text.strip().upper()
+
+# Envoie toutes les images par requêtes de reqlim images. Renvoie les listes
+# planeURI de chaque instrument sans doublures et dic = {requête: images}.
 
 def summitting_eso_images(usr,pss,request_url,request_url2,planeURI_sofi,
                           planeURI_sofi_fbd,planeURI_wfi,planeURI_wfi_fbd,
@@ -2475,178 +1886,161 @@ def summitting_eso_images(usr,pss,request_url,request_url2,planeURI_sofi,
                           planeURI_fors2,planeURI_fors2_fbd,planeURI_hawki,
                           planeURI_hawki_fbd):
 
-    # On doit additionner les 2 listes planeURI: images + calibrations.
-
-    planeURI_sofi = np.concatenate((planeURI_sofi,planeURI_sofi_fbd),axis=0)
-    planeURI_wfi = np.concatenate((planeURI_wfi,planeURI_wfi_fbd),axis=0)
-    planeURI_vircam = np.concatenate((planeURI_vircam,planeURI_vircam_fbd),axis=0)
-    planeURI_omegacam = np.concatenate((planeURI_omegacam,planeURI_omegacam_fbd),
-                                       axis=0)
-    planeURI_vimos = np.concatenate((planeURI_vimos,planeURI_vimos_fbd),axis=0)
-    planeURI_fors1 = np.concatenate((planeURI_fors1,planeURI_fors1_fbd),axis=0)
-    planeURI_fors2 = np.concatenate((planeURI_fors2,planeURI_fors2_fbd),axis=0)
-    planeURI_hawki = np.concatenate((planeURI_hawki,planeURI_hawki_fbd),axis=0)
-
-    # On retire les doublures.
-    planeURI_sofi = set(planeURI_sofi)
-    planeURI_wfi = set(planeURI_wfi)
-    planeURI_vircam = set(planeURI_vircam)
-    planeURI_omegacam = set(planeURI_omegacam)
-    planeURI_vimos = set(planeURI_vimos)
-    planeURI_fors1 = set(planeURI_fors1)
-    planeURI_fors2 = set(planeURI_fors2)
-    planeURI_hawki = set(planeURI_hawki)
-
-    reqlim = 10000 # seulement 10000 images par requete
-    header = {'Accept': 'text/plain'}
-
-    listrequest = (list(planeURI_sofi)+list(planeURI_wfi)+list(planeURI_vircam)+
-                   list(planeURI_omegacam)+list(planeURI_vimos)+
-                   list(planeURI_fors1)+list(planeURI_fors2)+list(planeURI_hawki))
-
-    #print type(listrequest)
-    #print listrequest
+    datasets = eso_datasets([("SOFI", planeURI_sofi, planeURI_sofi_fbd),
+                             ("WFI", planeURI_wfi, planeURI_wfi_fbd),
+                             ("VIRCAM", planeURI_vircam, planeURI_vircam_fbd),
+                             ("OmegaCAM", planeURI_omegacam,
+                              planeURI_omegacam_fbd),
+                             ("VIMOS", planeURI_vimos, planeURI_vimos_fbd),
+                             ("FORS1", planeURI_fors1, planeURI_fors1_fbd),
+                             ("FORS2", planeURI_fors2, planeURI_fors2_fbd),
+                             ("HAWKI", planeURI_hawki, planeURI_hawki_fbd)])
+
+    listrequest = [plist for (inst, plist) in datasets]
 
+    session = download.new_session(HTTPBasicAuth(usr, pss))
     dic = {}
-    l = len(listrequest)
-    a = 0
-
-    while l > reqlim:
-        a += 1
-        l -= reqlim
-
-    for i in range(a+1):
-        logging.info('submitting request {}'.format(i))
-        payload = {'dataset':','.join(['SAF+{}'.format(j)for j in
-                                       listrequest[i*reqlim:reqlim*(i+1)]])}
-        d = requests.post(request_url+usr+'/submission', headers=header,
-                          auth=HTTPBasicAuth(usr, pss), data=payload)
-        q = requests.get(request_url2+usr+'/recentRequests', headers=header,
-                         auth=HTTPBasicAuth(usr, pss))
-        with open('requestRecent.txt', 'wb') as f:
-            for line in q.content:
-                if line == ',':
-                    line = '\n'
-                    f.write(line)
-                else:
-                    f.write(line)
-                
-        f = open('requestRecent.txt', 'r')
-        for line in f:
-            mots = line.split()
-            dic[mots[0]] = listrequest[i*reqlim:reqlim*(i+1)]
+    for i in range(0, len(listrequest), reqlim):
+        logging.info('submitting request {}'.format(i // reqlim))
+        rid = submit_eso_request(session,request_url,usr,
+                                 listrequest[i:i+reqlim])
+        dic[rid] = listrequest[i:i+reqlim]
+    session.close()
+
+    def instrument(name):
+        return set(plist for (inst, plist) in datasets if inst == name)
 
-        return (planeURI_sofi,planeURI_wfi,planeURI_vircam,planeURI_omegacam,
-                planeURI_vimos,planeURI_fors1,planeURI_fors2,planeURI_hawki,dic)
+    return (instrument("SOFI"),instrument("WFI"),instrument("VIRCAM"),
+            instrument("OmegaCAM"),instrument("VIMOS"),instrument("FORS1"),
+            instrument("FORS2"),instrument("HAWKI"),dic)
 
 #print dic
 #sys.exit('Test 7')
 
-#################### Telechargement des images astronomiques ####################
+######################## Noms d'origine des images #############################
 
-# Lors de la telechargement sur le site de ESO, il faut une autorisation, soit un
-# identifiant et un mot de passe. Les images telechargEes ici sont sous forme
-# compressEes (A inclure dans le format du fichier).
+# Orig_Id = {Dataset ID: nom d'origine} donne le nom des fichiers téléchargés.
+# Il est gardé dans orig_id.csv du dossier ESO de l'objet: l'envoi des requêtes
+# et le téléchargement peuvent le relire sans refaire la recherche. Un fichier
+# existant est complété, pas remplacé.
 
-def download_eso_images(usr,pss,download_url,dic,Orig_Id,N_sofi,N_wfi,N_vircam,
-                        N_omegacam,N_vimos,N_fors1,N_fors2,N_hawki,planeURI_sofi,
-                        planeURI_wfi,planeURI_vircam,planeURI_omegacam,
-                        planeURI_vimos,planeURI_fors1,planeURI_fors2,
-                        planeURI_hawki,output_directory):
+def orig_id_path(output_directory):
+    return output_directory+'/orig_id.csv'
 
-    # ------------------- Téléchargement des images SOFI ------------------------
-    if N_sofi != 0:
-        logging.info("Downloading images from SOFI instrument")
-        out_dir = output_directory+"/SOFI/"
-        if not os.path.exists(out_dir):
-            os.makedirs(out_dir)
-            logging.info("The directory "+str(out_dir)+" have been created.")
+def read_orig_id(output_directory):
 
-        else:
-            logging.info("The directory "+str(out_dir)+" is already created.")
+    path = orig_id_path(output_directory)
+    if not os.path.exists(path):
+        return {}
 
+    table = pd.read_csv(path, dtype=str, encoding='utf-8')
 
-        for plist in tqdm(planeURI_sofi):
-            for k in dic.keys():
-                if plist in dic.get(k):
-                    link = (download_url+usr+'/'+k+'/SAF/{}/{}.fits.Z'
-                            .format(plist,plist))
-                    img = Orig_Id[plist]
-                    r = requests.get(link, auth=HTTPBasicAuth(usr, pss),
-                                     stream=True)
-                    if r.status_code == 200:
-                        total_length = int(r.headers.get('content-length', 0))
-                        block_length = 1024
-                        wrote = 0
+    return dict(zip(table['Dataset ID'], table['Orig Name']))
 
-                        with open(out_dir+"/{}.Z".format(img), 'wb') as f:
-                            for data in tqdm(r.iter_content(block_length),
-                                             total=math.ceil
-                                             (total_length//block_length),
-                                             unit='KB',unit_scale=True):
-                                wrote += len(data)
-                                f.write(data)
+def write_orig_id(output_directory,Orig_Id):
 
-                        if total_length != 0 and wrote != total_length:
-                            logging.error("Something went wrong")
+    names = read_orig_id(output_directory)
+    names.update(Orig_Id)
 
-                        logging.info("The image "+img+" have been downloaded.")
+    table = pd.DataFrame({'Dataset ID': list(names.keys()),
+                          'Orig Name': list(names.values())},
+                         columns=['Dataset ID','Orig Name'])
+    path = orig_id_path(output_directory)
+    table.to_csv(path+'.tmp', index=False, encoding='utf-8')
+    os.rename(path+'.tmp', path)
 
-                    else:
-                        logging.info("The image "+img+" cannot be downloaded.")
+    logging.info(str(len(names))+" original names saved in "+path)
 
-        logging.info("Download completed ")
-        logging.info("--------------------------------------------------------")
+#################### Telechargement des images astronomiques ####################
 
-    #sys.exit("test 8")
+# Lors de la telechargement sur le site de ESO, il faut une autorisation, soit un
+# identifiant et un mot de passe. Les images telechargEes ici sont sous forme
+# compressEes (A inclure dans le format du fichier). Elles sont téléchargées
+# par le moteur commun (download_module): en parallèle, avec reprise des
+# fichiers incomplets, nouvelles tentatives et journal des fichiers terminés.
 
-    # ------------------- Téléchargement des images WFI -------------------------
-    if N_wfi != 0:
-        logging.info("Downloading images from WFI instrument")
-        out_dir = output_directory+"/WFI/"
-        if not os.path.exists(out_dir):
-            os.makedirs(out_dir)
-            logging.info("The directory "+str(out_dir)+" have been created.")
+# dic donne les images de chaque requête: on l'inverse une seule fois en
+# {image: requête}
 
-        else:
-            logging.info("The directory "+str(out_dir)+" is already created.")
+def request_index(dic):
 
+    index = {}
+    for k, datasets in dic.items():
+        for plist in datasets:
+            index.setdefault(plist, k)
 
-        for plist in tqdm(planeURI_wfi):
-            for k in dic.keys():
-                if plist in dic.get(k):
-                    link = (download_url+usr+'/'+k+'/SAF/{}/{}.fits.Z'
-                            .format(plist,plist))
-                    img = Orig_Id[plist]
-                    r = requests.get(link, auth=HTTPBasicAuth(usr, pss),
-                                     stream=True)
-                    if r.status_code == 200:
-                        total_length = int(r.headers.get('content-length', 0))
-                        block_length = 1024
-                        wrote = 0
+    return index
 
-                        with open(out_dir+"/{}.Z".format(img), 'wb') as f:
-                            for data in tqdm(r.iter_content(block_length),
-                                             total=math.ceil
-                                             (total_length//block_length),
-                                             unit='KB',unit_scale=True):
-                                wrote += len(data)
-                                f.write(data)
+# Liste des (lien, fichier, Dataset ID) à télécharger pour une liste d'images.
+# Le Dataset ID sert de clé dans le dépôt commun des images (download_module).
 
-                        if total_length != 0 and wrote != total_length:
-                            logging.error("Something went wrong")
+def eso_link(usr,download_url,rid,plist):
+    return download_url+usr+'/'+rid+'/SAF/{}/{}.fits.Z'.format(plist,plist)
 
-                        logging.info("The image "+img+" have been downloaded.")
+def eso_jobs(usr,download_url,index,Orig_Id,planeURIs,out_dir):
 
-                    else:
-                        logging.info("The image "+img+" cannot be downloaded.")
+    jobs = []
+    for plist in planeURIs:
+        if plist not in index:
+            logging.info("The image "+str(plist)+" is not in any request.")
+            continue
 
-        logging.info("Download completed ")
-        logging.info("--------------------------------------------------------")
-    # ------------------- Téléchargement des images VIRCAM ----------------------
-    if N_vircam != 0:
-        logging.info("Downloading images from VIRCAM instrument")
-        out_dir = output_directory+"/VIRCAM/"
+        img = Orig_Id[plist]
+        jobs.append((eso_link(usr,download_url,index[plist],plist),
+                     out_dir+"/{}.Z".format(img), plist))
+
+    return jobs
+
+def download_eso_images(usr,pss,download_url,dic,Orig_Id,N_sofi,N_wfi,N_vircam,
+                        N_omegacam,N_vimos,N_fors1,N_fors2,N_hawki,planeURI_sofi,
+                        planeURI_wfi,planeURI_vircam,planeURI_omegacam,
+                        planeURI_vimos,planeURI_fors1,planeURI_fors2,
+                        planeURI_hawki,output_directory,
+                        n_workers=download.n_workers,db=None,session=None):
+
+    # Une session peut être partagée entre plusieurs cibles (mode batch)
+    own_session = session is None
+    if own_session:
+        session = download.new_session(HTTPBasicAuth(usr, pss), n_workers)
+    index = request_index(dic)
+    if Orig_Id is None:
+        Orig_Id = read_orig_id(output_directory)
+    journal = output_directory+'/download_journal.txt'
+
+    instruments = [("SOFI", N_sofi, planeURI_sofi),
+                   ("WFI", N_wfi, planeURI_wfi),
+                   ("VIRCAM", N_vircam, planeURI_vircam),
+                   ("OmegaCAM", N_omegacam, planeURI_omegacam),
+                   ("VIMOS", N_vimos, planeURI_vimos),
+                   ("FORS1", N_fors1, planeURI_fors1),
+                   ("FORS2", N_fors2, planeURI_fors2),
+                   ("HAWKI", N_hawki, planeURI_hawki)]
+
+    plans = []
+    for (inst, N, planeURIs) in instruments:
+        if N == 0:
+            continue
+
+        out_dir = output_directory+"/"+inst+"/"
+        plans.append((inst, out_dir,
+                      eso_jobs(usr,download_url,index,Orig_Id,planeURIs,
+                               out_dir)))
+
+    # Toutes les images prévues sont notées dans le manifeste, avec leur
+    # requête, avant le premier téléchargement: une reprise n'aura plus besoin
+    # d'interroger l'archive.
+    if db is not None:
+        manifest.add_datasets(db,"ESO",
+                              [(plist, inst, link, path, index[plist])
+                               for (inst, out_dir, jobs) in plans
+                               for (link, path, plist) in jobs])
+        manifest.set_archive_stage(db,"ESO",manifest.PLANNED)
+        done = manifest.done_paths(db,"ESO")
+
+    failed = 0
+    for (inst, out_dir, jobs) in plans:
+
+        logging.info("Downloading images from "+inst+" instrument")
         if not os.path.exists(out_dir):
             os.makedirs(out_dir)
             logging.info("The directory "+str(out_dir)+" have been created.")
@@ -2654,257 +2048,262 @@ def download_eso_images(usr,pss,download_url,dic,Orig_Id,N_sofi,N_wfi,N_vircam,
         else:
             logging.info("The directory "+str(out_dir)+" is already created.")
 
+            if db is None:
+                # Les fichiers corrompus d'un téléchargement précédent sont
+                # effacés et seront téléchargés de nouveau
+                download.verify_download_tree(out_dir,journal)
+            else:
+                # Le manifeste sait déjà quels fichiers sont terminés
+                jobs = [job for job in jobs if job[1] not in done]
 
-        for plist in tqdm(planeURI_vircam):
-            for k in dic.keys():
-                if plist in dic.get(k):
-                    link = (download_url+usr+'/'+k+'/SAF/{}/{}.fits.Z'
-                            .format(plist,plist))
-                    img = Orig_Id[plist]
-                    r = requests.get(link, auth=HTTPBasicAuth(usr, pss),
-                                     stream=True)
-                    if r.status_code == 200:
-                        total_length = int(r.headers.get('content-length', 0))
-                        block_length = 1024
-                        wrote = 0
+        counts = download.download_files(session,jobs,n_workers,journal,db)
+        failed += counts['failed']
 
-                        with open(out_dir+"/{}.Z".format(img), 'wb') as f:
-                            for data in tqdm(r.iter_content(block_length),
-                                             total=math.ceil
-                                             (total_length//block_length),
-                                             unit='KB',unit_scale=True):
-                                wrote += len(data)
-                                f.write(data)
+        logging.info("Download completed ")
+        logging.info("--------------------------------------------------------")
 
-                        if total_length != 0 and wrote != total_length:
-                            logging.error("Something went wrong")
+    if own_session:
+        session.close()
 
-                        logging.info("The image "+img+" have been downloaded.")
+    if db is not None and failed == 0:
+        manifest.set_archive_stage(db,"ESO",manifest.DONE)
 
-                    else:
-                        logging.info("The image "+img+" cannot be downloaded.")
+    logging.info("All ESO images downloaded")
 
-        logging.info("Download completed ")
-        logging.info("--------------------------------------------------------")
-    # ------------------- Téléchargement des images OmegaCAM -------------------
-    if N_omegacam != 0:
-        logging.info("Downloading images from OmegaCAM instrument")
-        out_dir = output_directory+"/OmegaCAM/"
-        if not os.path.exists(out_dir):
-            os.makedirs(out_dir)
-            logging.info("The directory "+str(out_dir)+" have been created.")
+    return
 
-        else:
-            logging.info("The directory "+str(out_dir)+" is already created.")
+# Reprise après un arrêt: les images à télécharger sont relues dans le manifeste,
+# sans nouvelle requête à l'archive. Elles sont regroupées par requête et
+# chaque requête n'est téléchargée qu'une fois déclarée prête par ESO (elle a pu
+# être encore en préparation au moment de l'arrêt).
+
+def resume_eso_downloads(usr,pss,output_directory,db,
+                         n_workers=download.n_workers,session=None,
+                         request_url=request_url):
+
+    # Une session peut être partagée entre plusieurs cibles (mode batch)
+    own_session = session is None
+    if own_session:
+        session = download.new_session(HTTPBasicAuth(usr, pss), n_workers)
+    journal = output_directory+'/download_journal.txt'
+
+    request_jobs = manifest.pending_requests(db,"ESO")
+    logging.info(str(sum(len(jobs) for jobs in request_jobs.values()))
+                 +" ESO images left to download in "+str(len(request_jobs))
+                 +" requests.")
+    for jobs in request_jobs.values():
+        for job in jobs:
+            out_dir = os.path.dirname(job[1])
+            if not os.path.exists(out_dir):
+                os.makedirs(out_dir)
 
+    try:
+        # Images sans requête connue: téléchargées directement
+        failed = 0
+        if None in request_jobs:
+            counts = download.download_files(session,request_jobs.pop(None),
+                                             n_workers,journal,db)
+            failed += counts['failed']
+        failed += follow_eso_requests(session,request_url,usr,request_jobs,
+                                      n_workers,journal,db)
+    finally:
+        if own_session:
+            session.close()
+
+    if failed == 0:
+        manifest.set_archive_stage(db,"ESO",manifest.DONE)
 
-        for plist in tqdm(planeURI_omegacam):
-            for k in dic.keys():
-                if plist in dic.get(k):
-                    link = (download_url+usr+'/'+k+'/SAF/{}/{}.fits.Z'
-                            .format(plist,plist))
-                    img = Orig_Id[plist]
-                    r = requests.get(link, auth=HTTPBasicAuth(usr, pss),
-                                     stream=True)
-                    if r.status_code == 200:
-                        total_length = int(r.headers.get('content-length', 0))
-                        block_length = 1024
-                        wrote = 0
+    logging.info("All ESO images downloaded")
 
-                        with open(out_dir+"/{}.Z".format(img), 'wb') as f:
-                            for data in tqdm(r.iter_content(block_length),
-                                             total=math.ceil
-                                             (total_length//block_length),
-                                             unit='KB',unit_scale=True):
-                                wrote += len(data)
-                                f.write(data)
+    return
 
-                        if total_length != 0 and wrote != total_length:
-                            logging.error("Something went wrong")
+################### Suivi de l'état des requêtes ################################
 
-                        logging.info("The image "+img+" have been downloaded.")
+# Chaque requête a son propre suivi: son dernier état connu et la date de sa
+# prochaine vérification. L'intervalle double à chaque vérification sans
+# changement (jusqu'à poll_max) et revient à poll_min dès que l'état change:
+# une requête qui avance est suivie de près, une requête en attente depuis des
+# heures n'est plus interrogée qu'une fois de temps en temps.
 
-                    else:
-                        logging.info("The image "+img+" cannot be downloaded.")
+def new_poll(rid):
+    return {'rid': rid, 'state': None, 'interval': poll_min,
+            'next': time.time()}
 
-        logging.info("Download completed ")
-        logging.info("--------------------------------------------------------")
-    # ------------------- Téléchargement des images VIMOS -----------------------
-    if N_vimos != 0:
-        logging.info("Downloading images from VIMOS instrument")
-        out_dir = output_directory+"/VIMOS/"
-        if not os.path.exists(out_dir):
-            os.makedirs(out_dir)
-            logging.info("The directory "+str(out_dir)+" have been created.")
+def check_request(session,request_url,usr,poll):
 
+    rid = poll['rid']
+    try:
+        state = eso_request_state(session,request_url,usr,rid)
+    except requests.exceptions.RequestException as e:
+        if download.transient(e):
+            # État inconnu pour l'instant: on attend plus longtemps
+            logging.warning("State of request "+rid+" unknown ("+str(e)+")")
+            state = poll['state']
         else:
-            logging.info("The directory "+str(out_dir)+" is already created.")
+            logging.error("Request "+rid+" cannot be followed ("+str(e)+")")
+            state = 'ERROR'
 
+    if state != poll['state']:
+        logging.info("Request "+rid+" is "+str(state))
+        poll['state'] = state
+        poll['interval'] = poll_min
+    else:
+        poll['interval'] = min(2*poll['interval'], poll_max)
+    poll['next'] = time.time()+poll['interval']
 
-        for plist in tqdm(planeURI_vimos):
-            for k in dic.keys():
-                if plist in dic.get(k):
-                    link = (download_url+usr+'/'+k+'/SAF/{}/{}.fits.Z'
-                            .format(plist,plist))
-                    img = Orig_Id[plist]
-                    r = requests.get(link, auth=HTTPBasicAuth(usr, pss),
-                                     stream=True)
-                    if r.status_code == 200:
-                        total_length = int(r.headers.get('content-length', 0))
-                        block_length = 1024
-                        wrote = 0
+    return state
 
-                        with open(out_dir+"/{}.Z".format(img), 'wb') as f:
-                            for data in tqdm(r.iter_content(block_length),
-                                             total=math.ceil
-                                             (total_length//block_length),
-                                             unit='KB',unit_scale=True):
-                                wrote += len(data)
-                                f.write(data)
+# Vérifie les requêtes dont la date de vérification est passée. ready(rid) est
+# appelée pour chaque requête prête, failed(rid, state) pour chaque requête
+# abandonnée par ESO. Renvoie les suivis des requêtes encore en préparation.
 
-                        if total_length != 0 and wrote != total_length:
-                            logging.error("Something went wrong")
+def poll_requests(session,request_url,usr,polls,ready,failed):
 
-                        logging.info("The image "+img+" have been downloaded.")
+    waiting = []
+    for poll in polls:
+        if poll['next'] > time.time():
+            waiting.append(poll)
+            continue
 
-                    else:
-                        logging.info("The image "+img+" cannot be downloaded.")
+        state = check_request(session,request_url,usr,poll)
+        if state in READY_STATES:
+            ready(poll['rid'])
+        elif state in FAILED_STATES:
+            failed(poll['rid'],state)
+        else:
+            waiting.append(poll)
 
-        logging.info("Download completed ")
-        logging.info("--------------------------------------------------------")
-    # ------------------- Téléchargement des images FORS1 -----------------------
-    if N_fors1 != 0:
-        logging.info("Downloading images from FORS1 instrument")
-        out_dir = output_directory+"/FORS1/"
-        if not os.path.exists(out_dir):
-            os.makedirs(out_dir)
-            logging.info("The directory "+str(out_dir)+" have been created.")
+    return waiting
 
-        else:
-            logging.info("The directory "+str(out_dir)+" is already created.")
+# Secondes à attendre avant la prochaine vérification
 
+def next_poll(polls):
+    return max(0., min(poll['next'] for poll in polls)-time.time())
 
-        for plist in tqdm(planeURI_fors1):
-            for k in dic.keys():
-                if plist in dic.get(k):
-                    link = (download_url+usr+'/'+k+'/SAF/{}/{}.fits.Z'
-                            .format(plist,plist))
-                    img = Orig_Id[plist]
-                    r = requests.get(link, auth=HTTPBasicAuth(usr, pss),
-                                     stream=True)
-                    if r.status_code == 200:
-                        total_length = int(r.headers.get('content-length', 0))
-                        block_length = 1024
-                        wrote = 0
+# Suit les requêtes et télécharge chacune dès qu'ESO la déclare prête.
+# request_jobs donne les (lien, fichier, Dataset ID) de chaque requête déjà
+# envoyée; submissions est un itérateur qui envoie une nouvelle requête à
+# chaque pas (il complète request_jobs et renvoie son numéro). Les requêtes
+# prêtes passent dans la file d'un thread de téléchargement, qui garde le nom
+# du thread appelant pour le log. Renvoie le nombre d'images ratées.
 
-                        with open(out_dir+"/{}.Z".format(img), 'wb') as f:
-                            for data in tqdm(r.iter_content(block_length),
-                                             total=math.ceil
-                                             (total_length//block_length),
-                                             unit='KB',unit_scale=True):
-                                wrote += len(data)
-                                f.write(data)
+def follow_eso_requests(session,request_url,usr,request_jobs,n_workers,journal,
+                        db=None,submissions=()):
 
-                        if total_length != 0 and wrote != total_length:
-                            logging.error("Something went wrong")
+    name = threading.current_thread().name
 
-                        logging.info("The image "+img+" have been downloaded.")
+    def fetch(rid):
+        threading.current_thread().name = name
+        logging.info("Downloading request "+rid)
+        return download.download_files(session,request_jobs[rid],n_workers,
+                                       journal,db)
 
-                    else:
-                        logging.info("The image "+img+" cannot be downloaded.")
+    loader = ThreadPool(1)
+    results = []
+    lost = []
 
-        logging.info("Download completed ")
-        logging.info("--------------------------------------------------------")
-    # ------------------- Téléchargement des images FORS2 -----------------------
-    if N_fors2 != 0:
-        logging.info("Downloading images from FORS2 instrument")
-        out_dir = output_directory+"/FORS2/"
-        if not os.path.exists(out_dir):
-            os.makedirs(out_dir)
-            logging.info("The directory "+str(out_dir)+" have been created.")
+    def ready(rid):
+        results.append(loader.apply_async(fetch, (rid,)))
 
-        else:
-            logging.info("The directory "+str(out_dir)+" is already created.")
+    def failed(rid,state):
+        logging.error("Request "+rid+" failed on the ESO side ("+state+")")
+        lost.append(len(request_jobs[rid]))
+
+    polls = [new_poll(rid) for rid in request_jobs]
+    submissions = iter(submissions)
+    submitting = True
+    try:
+        while submitting or len(polls) != 0:
 
+            # Une requête de plus à chaque tour
+            if submitting:
+                rid = next(submissions, None)
+                if rid is None:
+                    submitting = False
+                else:
+                    polls.append(new_poll(rid))
 
-        for plist in tqdm(planeURI_fors2):
-            for k in dic.keys():
-                if plist in dic.get(k):
-                    link = (download_url+usr+'/'+k+'/SAF/{}/{}.fits.Z'
-                            .format(plist,plist))
-                    img = Orig_Id[plist]
-                    r = requests.get(link, auth=HTTPBasicAuth(usr, pss),
-                                     stream=True)
-                    if r.status_code == 200:
-                        total_length = int(r.headers.get('content-length', 0))
-                        block_length = 1024
-                        wrote = 0
+            polls = poll_requests(session,request_url,usr,polls,ready,failed)
 
-                        with open(out_dir+"/{}.Z".format(img), 'wb') as f:
-                            for data in tqdm(r.iter_content(block_length),
-                                             total=math.ceil
-                                             (total_length//block_length),
-                                             unit='KB',unit_scale=True):
-                                wrote += len(data)
-                                f.write(data)
+            if not submitting and len(polls) != 0:
+                time.sleep(next_poll(polls))
 
-                        if total_length != 0 and wrote != total_length:
-                            logging.error("Something went wrong")
+        n_failed = sum(lost)
+        for result in results:
+            n_failed += result.get()['failed']
 
-                        logging.info("The image "+img+" have been downloaded.")
+    finally:
+        loader.close()
+        loader.join()
 
-                    else:
-                        logging.info("The image "+img+" cannot be downloaded.")
+    return n_failed
 
-        logging.info("Download completed ")
-        logging.info("--------------------------------------------------------")
-    # ------------------- Téléchargement des images HAWKI ----------------------
-    if N_hawki != 0:
-        logging.info("Downloading images from HAWKI instrument")
-        out_dir = output_directory+"/HAWKI/"
-        if not os.path.exists(out_dir):
-            os.makedirs(out_dir)
-            logging.info("The directory "+str(out_dir)+" have been created.")
+############### Envoi des requêtes et téléchargement en parallèle ###############
 
-        else:
-            logging.info("The directory "+str(out_dir)+" is already created.")
+# La préparation d'une requête par ESO peut prendre des heures. Plutôt que
+# d'attendre que toutes les requêtes soient prêtes, chaque requête est
+# téléchargée dès qu'ESO la déclare prête, pendant que les autres sont encore
+# envoyées ou préparées. datasets vient de eso_datasets; les images sont
+# rangées par instrument dans output_directory. Sans Orig_Id, les noms sont lus
+# dans orig_id.csv. Renvoie dic = {requête: images}.
 
+def eso_request_pipeline(usr,pss,request_url,download_url,datasets,Orig_Id,
+                         output_directory,n_workers=download.n_workers,db=None,
+                         session=None):
 
-        for plist in tqdm(planeURI_hawki):
-            for k in dic.keys():
-                if plist in dic.get(k):
-                    link = (download_url+usr+'/'+k+'/SAF/{}/{}.fits.Z'
-                            .format(plist,plist))
-                    img = Orig_Id[plist]
-                    r = requests.get(link, auth=HTTPBasicAuth(usr, pss),
-                                     stream=True)
-                    if r.status_code == 200:
-                        total_length = int(r.headers.get('content-length', 0))
-                        block_length = 1024
-                        wrote = 0
+    # Une session peut être partagée entre plusieurs cibles (mode batch)
+    own_session = session is None
+    if own_session:
+        session = download.new_session(HTTPBasicAuth(usr, pss), n_workers)
+    journal = output_directory+'/download_journal.txt'
 
-                        with open(out_dir+"/{}.Z".format(img), 'wb') as f:
-                            for data in tqdm(r.iter_content(block_length),
-                                             total=math.ceil
-                                             (total_length//block_length),
-                                             unit='KB',unit_scale=True):
-                                wrote += len(data)
-                                f.write(data)
+    # Noms d'origine gardés par une recherche précédente
+    if Orig_Id is None:
+        Orig_Id = read_orig_id(output_directory)
 
-                        if total_length != 0 and wrote != total_length:
-                            logging.error("Something went wrong")
+    for inst in set(inst for (inst, plist) in datasets):
+        out_dir = output_directory+"/"+inst+"/"
+        if not os.path.exists(out_dir):
+            os.makedirs(out_dir)
 
-                        logging.info("The image "+img+" have been downloaded.")
+    chunks = [datasets[i:i+reqlim] for i in range(0, len(datasets), reqlim)]
+    dic = {}
+    request_jobs = {}
+
+    def submissions():
+        for chunk in chunks:
+            rid = submit_eso_request(session,request_url,usr,
+                                     [plist for (inst, plist) in chunk])
+            logging.info("Request "+rid+" submitted ("+str(len(chunk))
+                         +" images)")
+            dic[rid] = [plist for (inst, plist) in chunk]
+            request_jobs[rid] = [(eso_link(usr,download_url,rid,plist),
+                                  output_directory+"/"+inst+"/"
+                                  +"{}.Z".format(Orig_Id[plist]), plist)
+                                 for (inst, plist) in chunk]
+            if db is not None:
+                manifest.add_datasets(db,"ESO",
+                                      [(plist, inst, link, path, rid)
+                                       for ((inst, plist), (link, path, key))
+                                       in zip(chunk,request_jobs[rid])])
+            yield rid
+
+        if db is not None:
+            manifest.set_archive_stage(db,"ESO",manifest.PLANNED)
 
-                    else:
-                        logging.info("The image "+img+" cannot be downloaded.")
+    try:
+        failed = follow_eso_requests(session,request_url,usr,request_jobs,
+                                     n_workers,journal,db,submissions())
+    finally:
+        if own_session:
+            session.close()
 
-        logging.info("Download completed ")
-        logging.info("--------------------------------------------------------")
+    if db is not None and failed == 0:
+        manifest.set_archive_stage(db,"ESO",manifest.DONE)
 
-    logging.info("All ESO images downloaded")
+    logging.info("All ESO requests downloaded ("+str(failed)+" images failed)")
 
-    return
+    return dic
 
 ################################################################################
 
@@ -2933,14 +2332,7 @@ if __name__ == "__main__":
         sys.exit("You should choose between r and b; circle or rectangle")
 
     # ----------- Coordonnées de l'objet en degrés ------------------
-    sd.reset_votable_fields()
-    sd.remove_votable_fields('coordinates')
-    sd.add_votable_fields('ra(d;A;ICRS)', 'dec(d;D;ICRS)')
-
-    table = sd.query_object(Object, wildcard=False)
-
-    RA_center_deg = table[0][1]
-    DEC_center_deg = table[0][2]
+    (RA_center_deg, DEC_center_deg) = simbad.object_center(Object)
 
     CENTRE = np.array([RA_center_deg, DEC_center_deg])
 
@@ -3049,30 +2441,21 @@ if __name__ == "__main__":
         planeURI_hawki_fbd = []
 
 
-    logging.info("Submitting Request")
+    logging.info("Submitting requests and downloading images")
 
-    (planeURI_sofi,planeURI_wfi,
-     planeURI_vircam,planeURI_omegacam,
-     planeURI_vimos,planeURI_fors1,
-     planeURI_fors2,planeURI_hawki,
-     dic) = summitting_eso_images(usr,pss,request_url,request_url2,planeURI_sofi,
-                                  planeURI_sofi_fbd,planeURI_wfi,planeURI_wfi_fbd,
-                                  planeURI_vircam,planeURI_vircam_fbd,
-                                  planeURI_omegacam,planeURI_omegacam_fbd,
-                                  planeURI_vimos,planeURI_vimos_fbd,
-                                  planeURI_fors1,planeURI_fors1_fbd,
-                                  planeURI_fors2,planeURI_fors2_fbd,
-                                  planeURI_hawki,planeURI_hawki_fbd)
+    datasets = eso_datasets([("SOFI", planeURI_sofi, planeURI_sofi_fbd),
+                             ("WFI", planeURI_wfi, planeURI_wfi_fbd),
+                             ("VIRCAM", planeURI_vircam, planeURI_vircam_fbd),
+                             ("OmegaCAM", planeURI_omegacam,
+                              planeURI_omegacam_fbd),
+                             ("VIMOS", planeURI_vimos, planeURI_vimos_fbd),
+                             ("FORS1", planeURI_fors1, planeURI_fors1_fbd),
+                             ("FORS2", planeURI_fors2, planeURI_fors2_fbd),
+                             ("HAWKI", planeURI_hawki, planeURI_hawki_fbd)])
+    write_orig_id(output_directory,Orig_Id)
 
-    
-
-    logging.info("Downloading images")
-
-    download_eso_images(usr,pss,download_url,dic,Orig_Id,N_sofi,N_wfi,N_vircam,
-                        N_omegacam,N_vimos,N_fors1,N_fors2,N_hawki,planeURI_sofi,
-                        planeURI_wfi,planeURI_vircam,planeURI_omegacam,
-                        planeURI_vimos,planeURI_fors1,planeURI_fors2,
-                        planeURI_hawki,output_directory)
+    eso_request_pipeline(usr,pss,request_url,download_url,datasets,Orig_Id,
+                         output_directory)
 
 
     logging.info("Done")
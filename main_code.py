@@ -4,6 +4,17 @@
 # Ce code principale va permettre de rechercher des images astronomiques venant de
 # plusieurs d'archivage des téléscopes en un seul requête.
 #
+# Sans argument, l'objet et la boîte de recherche sont demandés au clavier.
+# Avec --batch, ils sont lus dans un fichier (une cible par ligne, voir
+# read_targets): toutes les cibles sont résolues par une seule requête Simbad,
+# partagent les sessions HTTP et les catalogues locaux, et sont traitées en
+# parallèle.
+#
+# Pour chaque cible, les 3 archives (SMOKA, CFHT, ESO) sont interrogées en même
+# temps, chacune par un thread nommé "<objet>:<archive>": la durée totale est
+# celle de l'archive la plus lente (en général la préparation des requêtes ESO)
+# et chaque ligne du log indique le thread qui l'a écrite.
+#
 
 ################### On va importer les modules standards ########################
 
@@ -11,11 +22,15 @@ import sys
 import io
 import os
 import logging
+import time
+import argparse
+import threading
 import requests
 import numpy as np
 import pandas as pd
 from getpass import getpass
 from datetime import datetime
+from multiprocessing.pool import ThreadPool
 from tqdm import tqdm # bar de status
 from astropy.coordinates import SkyCoord as sk
 from astropy import units as u
@@ -23,7 +38,6 @@ from astropy.time import Time
 from astropy.io import fits
 from astropy.io import ascii
 from astropy.table import Table
-from astroquery.simbad import Simbad as sd
 from requests.auth import HTTPBasicAuth
 
 ###################### Importation des modules personnels ####################
@@ -31,31 +45,21 @@ from requests.auth import HTTPBasicAuth
 import cfht_archive_module as cfht
 import smoka_archive_module as smoka
 import eso_archive_module as eso
+import manifest_module as manifest
+import simbad_module as simbad
+import download_module as download
 
 ##################################################################################
 
 # Comme cette requête va télécharger des images de hautes qualités, cela risque de
 # prendre beaucoup de temps, voire plusieurs semaines. On peut améliorer les
-# recherches en utilisant plusieurs processeurs.
-
-########################## Création des processeurs multiples ####################
+# recherches en traitant plusieurs cibles à la fois.
 
-def start_pool(project_list):
-    if __name__ == '__main__':
-        p = Pool(processes=1) # On se limite à 10 processeurs max
-        p.map(common_function,project_list)
-        p.close()
-        p.join()
-        
-        print 'workers=',p.processes
+n_targets = 2 # cibles traitées en parallèle en mode batch
+ARCHIVES = ("SMOKA", "CFHT", "ESO") # interrogées en parallèle pour une cible
 
-# Création de la tache commune.
-
-def common_function(j):
-    f = open(j, 'r')
-    for ligne in f:
-        obj = wget.download(ligne)
-        print obj
+directory = os.getcwd() # retourne le répertoire de travail actuel
+                        # d'un processus
 
 ################################### Bar de status ###############################
 
@@ -78,10 +82,17 @@ def update_process(total,progress):
 ########################## Paramètres de départ #################################
 
 # Comme son nom indique, on va définir les paramètres de départ, soit le nom de
-# l'objet qu'on veux chercher, le rayon de la sphère céleste en degrés, les
-# instruments de SMOKA et les urls (site web) de SMOKA
+# l'objet qu'on veux chercher et la boîte de recherche: une sphère céleste
+# (Box_search = "r", rayon en degrés) ou un rectangle (Box_search = "b",
+# longueur et largeur en degrés). Une cible est un dictionnaire avec ces clés.
 
-if __name__ == "__main__":
+def new_target(Object,Box_search,Sphere_Radius=None,Ra_box=None,DEC_box=None):
+
+    return {'Object': Object, 'Box_search': Box_search,
+            'Sphere_Radius': Sphere_Radius, 'Ra_box': Ra_box,
+            'DEC_box': DEC_box}
+
+def read_parameters():
 
     Object = raw_input("Select an object : ")# Nom de l'objet sans (" ")
     nObj = len(Object)
@@ -89,364 +100,611 @@ if __name__ == "__main__":
         sys.exit("You must provide the target name")
     # On définit une limite minimale de caractères ou une erreur si absence de
     # caractères.
-    
+
     # On propose le choix de la recherche (sphère celeste ou blog rectangulaire)
-    
-    Box_search = raw_input('''Choose r for circular area or b for rectangular 
+
+    Box_search = raw_input('''Choose r for circular area or b for rectangular
                               area : ''')
-    
+
     if Box_search == "r":
         Sphere_Radius = float(input('''Select the sphere's radius in deg : '''))
+        return new_target(Object,Box_search,Sphere_Radius=Sphere_Radius)
     elif Box_search == "b":
         Ra_box = float(input("Select the length of the search box in deg : "))
         DEC_box = float(input("Select the width of the search box in deg : "))
+        return new_target(Object,Box_search,Ra_box=Ra_box,DEC_box=DEC_box)
     else:
         sys.exit("You should choose between r and b; circle or rectangle box")
 
+# Fichier de cibles pour le mode batch, une cible par ligne, champs séparés par
+# des virgules (le nom de l'objet peut contenir des espaces):
+#
+#     NGC 1333, r, 0.5
+#     IC 348, b, 0.4, 0.3
+#
+# Les lignes vides et celles qui commencent par # sont ignorées.
 
-directory = os.getcwd() # retourne le répertoire de travail actuel
-                        # d'un processus
+def read_targets(path):
 
-output_directory = directory+'/{}'.format(Object)
-if not os.path.exists(output_directory):
-    os.makedirs(output_directory)
+    targets = []
+    with open(path) as f:
+        for (n, line) in enumerate(f, 1):
+            line = line.strip()
+            if len(line) == 0 or line.startswith('#'):
+                continue
 
-# Les 2 dernières lignes sert à créer un dossier contenant les images
-# astronique de l'objet en question.
+            fields = [field.strip() for field in line.split(',')]
+            try:
+                if fields[1] == "r" and len(fields) == 3:
+                    targets.append(new_target(fields[0],"r",
+                                              Sphere_Radius=float(fields[2])))
+                    continue
+                if fields[1] == "b" and len(fields) == 4:
+                    targets.append(new_target(fields[0],"b",
+                                              Ra_box=float(fields[2]),
+                                              DEC_box=float(fields[3])))
+                    continue
+            except (IndexError, ValueError):
+                pass
+            sys.exit("Line "+str(n)+" of "+path+" should be 'object, r, radius'"
+                     " or 'object, b, length, width'")
 
+    return targets
 
-################################### LOG FILE #####################################
+# ----------------- Identifiant et mot de passe ------------------------------
 
-# Dans cette partie, on va configurer un logger qui va nous donner les info au fil
-# du temps.
+# Demandés une seule fois, même pour plusieurs cibles
 
-# Création de l'objet logger qui va nous servir à écrire dans les logs
-logger = logging.getLogger()
+def read_credentials():
 
-# On met le niveau du logger à DEBUG, comme ça il écrit tout
-logger.setLevel(logging.DEBUG)
+    cfht_usr = raw_input("Enter CFHT username : ")
+    cfht_pss = getpass("Enter CFHT password : ")
+    eso_usr = raw_input("Enter ESO username : ")
+    eso_pss = getpass("Enter ESO password : ")
 
+    return {'CFHT': (cfht_usr, cfht_pss), 'ESO': (eso_usr, eso_pss)}
 
-# On crée un formateur qui va ajouter le temps, le niveau de chaque message quand
-# on écrira un message dans le log
+# Une session de téléchargement par archive, partagée par toutes les cibles
 
-formatter = logging.Formatter('%(name)-12s: %(levelname)-8s %(message)s')
-fmt = logging.Formatter('%(asctime)s %(name)-12s %(levelname)-8s %(message)s',
-                        '%m-%d %H:%M')
-# Création d'un handler qui va écrire les messages du niveau INFO ou supérieur
-# dans le sys.stderr
+def archive_sessions(credentials,workers):
 
-console = logging.StreamHandler()
-console.setLevel(logging.INFO)
-console.setFormatter(formatter)
+    sessions = {}
+    for archive in ('CFHT', 'ESO'):
+        auth = HTTPBasicAuth(*credentials[archive])
+        sessions[archive] = download.new_session(auth,
+                                                 download.n_workers*workers)
 
-# On va crée un second handler qui va sauvegarder tous les messages dans un
-# ficher
+    return sessions
+
+################################### LOG FILE #####################################
+
+# Dans cette partie, on va configurer un logger qui va nous donner les info au fil
+# du temps.
 
-fh = logging.FileHandler(output_directory+"/Search.log")
-fh.setLevel(logging.DEBUG)
-fh.setFormatter(fmt)
+# On crée un formateur qui va ajouter le temps, le thread (cible et archive) et
+# le niveau de chaque message quand on écrira un message dans le log
 
-# Enfin on ajoute les handlers au logger principal
-logger.addHandler(console)
-logger.addHandler(fh)
+formatter = logging.Formatter('%(threadName)-16s: %(levelname)-8s %(message)s')
+fmt = logging.Formatter('%(asctime)s %(threadName)-16s %(levelname)-8s '
+                        '%(message)s', '%m-%d %H:%M')
 
-############################ Coordonnées de l'objet #############################
+def setup_logging():
 
-# On va utiliser le module Simbad pour récuperer les coordonées équatoriales de
-# l'objet qu'on veut trouver dans la sphère céleste.
+    # Création de l'objet logger qui va nous servir à écrire dans les logs
+    logger = logging.getLogger()
 
-sd.reset_votable_fields()
-sd.remove_votable_fields('coordinates')
-sd.add_votable_fields('ra(:;A;ICRS;J2000)', 'dec(:;D;ICRS;J2000)')
+    # On met le niveau du logger à DEBUG, comme ça il écrit tout
+    logger.setLevel(logging.DEBUG)
 
-table = sd.query_object(Object, wildcard=False)
+    # Création d'un handler qui va écrire les messages du niveau INFO ou
+    # supérieur dans le sys.stderr
+    console = logging.StreamHandler()
+    console.setLevel(logging.INFO)
+    console.setFormatter(formatter)
+    logger.addHandler(console)
 
-# print table.keys()
-a = table[0][1]
-b = table[0][2]
-# print a
-# print b
+    return logger
 
-r1 = a.split(':')
-d1 = b.split(':')
-# print len(d1)
+# En mode batch, plusieurs cibles écrivent en même temps: le Search.log d'une
+# cible ne garde que les messages du thread qui la traite et de ses threads
+# d'archive ("<objet>:SMOKA", "<objet>:CFHT:download", ...).
 
-# sys.exit("test 1")
+class ThreadFilter(logging.Filter):
 
-if len(d1) < 3:
-    t = []
-    for i in d1:
-        t.append(i.split('.'))
-    s = t[0]
-    o = t[1]
-    d1 = s + o
-    d1[2] = '00'
+    def __init__(self,thread_name):
+        logging.Filter.__init__(self)
+        self.thread_name = thread_name
 
-# print t
-# print len(t)
-# print d1[0]
+    def filter(self,record):
+        return (record.threadName == self.thread_name or
+                record.threadName.startswith(self.thread_name+':'))
 
-r = '{} {} {}'.format(r1[0],r1[1],r1[2])
-d = '{} {} {}'.format(d1[0],d1[1],d1[2])
+# On va crée un second handler qui va sauvegarder tous les messages dans un
+# ficher, dans le dossier de l'objet
 
-# print r
-# print d
+def target_log(output_directory,thread_name=None):
 
-logging.info("Object: "+str(Object))
-logging.info("Coordinates[ICRS]: RA, DEC = {}  {}".format(r,d))
+    fh = logging.FileHandler(output_directory+"/Search.log")
+    fh.setLevel(logging.DEBUG)
+    fh.setFormatter(fmt)
+    if thread_name is not None:
+        fh.addFilter(ThreadFilter(thread_name))
+    logging.getLogger().addHandler(fh)
 
-# ----------------- Cordonnées de l'objet en degrés ------------------
+    return fh
 
-sd.reset_votable_fields()
-sd.remove_votable_fields('coordinates')
-sd.add_votable_fields('ra(d;A;ICRS)', 'dec(d;D;ICRS)')
+############################ Coordonnées des objets #############################
 
-table = sd.query_object(Object, wildcard=False)
+# On va utiliser le module Simbad pour récuperer les coordonées équatoriales des
+# objets qu'on veut trouver dans la sphère céleste. Une seule requête donne les
+# coordonnées en sexagésimal et en degrés pour toutes les cibles; elles sont
+# gardées dans le cache de simbad_module pour les lancements suivants. Les
+# cibles inconnues de Simbad sont retirées.
 
-RA_center_deg = table[0][1]
-DEC_center_deg = table[0][2]
+def resolve_targets(targets):
 
-# print a
+    coords = simbad.resolve_objects([target['Object'] for target in targets])
 
-# sys.exit("test 2")
+    resolved = []
+    for target in targets:
+        if target['Object'] not in coords:
+            logging.error("Object "+target['Object']+" skipped")
+            continue
+        entry = coords[target['Object']]
+        target['ra_str'] = entry['ra_str']
+        target['dec_str'] = entry['dec_str']
+        target['CENTRE'] = np.array([entry['ra'], entry['dec']])
+        resolved.append(target)
 
-CENTRE = np.array([RA_center_deg, DEC_center_deg])
+    return resolved
 
-if __name__ == "__main__":
-  
-    # ----------------- Identifiant et mot de passe ------------------------------
-    
-    cfht_usr = raw_input("Enter CFHT username : ")
-    cfht_pss = getpass("Enter CFHT password : ")
-    eso_usr = raw_input("Enter ESO username : ")
-    eso_pss = getpass("Enter ESO password : ")
+################################### SMOKA ########################################
 
+def run_smoka(target,db):
+
+    Object = target['Object']
+    Box_search = target['Box_search']
+    Sphere_Radius = target['Sphere_Radius']
+    Ra_box = target['Ra_box']
+    DEC_box = target['DEC_box']
+    CENTRE = target['CENTRE']
 
-    # ------------------------------ SMOKA ---------------------------
     logging.info("Running SMOKA archive")
     output_directory = smoka.smoka_parameter_in(Object,Box_search,Sphere_Radius)
-    
-    logging.info("Searching images in Suprime-Cam")
-    if Box_search == "r":
-        smoka.SuprimeCam_Search(Object,CENTRE,Sphere_Radius,smoka.FOV_SUP,
-                                smoka.dt_bias,smoka.dt_flat,smoka.min_calib,
-                                output_directory)
-    elif Box_search == "b":
-        smoka.SuprimeCam_Search_2(Object,CENTRE,Ra_box,DEC_box,smoka.FOV_SUP,
-                                  smoka.dt_bias,smoka.dt_flat,smoka.min_calib,
-                                  output_directory)
-    logging.info("End SUP")
-    logging.info("---------------------------------------")
-    
-    logging.info("Searching images in HyperSuprime-Cam")
-    if Box_search == "r":
-        smoka.HyperSuprimeCam_Search(Object,CENTRE,Sphere_Radius,smoka.FOV_HSC,
-                                     smoka.dt_bias,smoka.dt_flat,smoka.dt_dark,
-                                     smoka.min_calib,output_directory)
-    elif Box_search == "b":
-        smoka.HyperSuprimeCam_Search_2(Object,CENTRE,Ra_box,DEC_box,smoka.FOV_HSC,
-                                       smoka.dt_bias,smoka.dt_flat,smoka.dt_dark,
-                                       smoka.min_calib,output_directory)
-    logging.info("End HSC")
-    logging.info("---------------------------------------")
 
-    logging.info("End SMOKA archive")
+    if manifest.archive_stage(db,"SMOKA") == manifest.DONE:
+        logging.info("SMOKA mails already written, see the manifest")
 
-    # -------------------------------- CFHT ------------------------------
-    logging.info("Running CFHT archive")
-    output_directory = cfht.cfht_parameter_in(Object)
+    else:
+        logging.info("Searching images in Suprime-Cam")
+        if Box_search == "r":
+            frames_sup = smoka.SuprimeCam_Search(Object,CENTRE,
+                                                 Sphere_Radius,
+                                                 smoka.FOV_SUP,smoka.dt_bias,
+                                                 smoka.dt_flat,smoka.min_calib,
+                                                 output_directory)
+        elif Box_search == "b":
+            frames_sup = smoka.SuprimeCam_Search_2(Object,CENTRE,
+                                                   Ra_box,DEC_box,
+                                                   smoka.FOV_SUP,smoka.dt_bias,
+                                                   smoka.dt_flat,
+                                                   smoka.min_calib,
+                                                   output_directory)
+        logging.info("End SUP")
+        logging.info("---------------------------------------")
+
+        logging.info("Searching images in HyperSuprime-Cam")
+        if Box_search == "r":
+            frames_hsc = smoka.HyperSuprimeCam_Search(Object,CENTRE,
+                                                      Sphere_Radius,
+                                                      smoka.FOV_HSC,
+                                                      smoka.dt_bias,
+                                                      smoka.dt_flat,
+                                                      smoka.dt_dark,
+                                                      smoka.min_calib,
+                                                      output_directory)
+        elif Box_search == "b":
+            frames_hsc = smoka.HyperSuprimeCam_Search_2(Object,CENTRE,
+                                                        Ra_box,DEC_box,
+                                                        smoka.FOV_HSC,
+                                                        smoka.dt_bias,
+                                                        smoka.dt_flat,
+                                                        smoka.dt_dark,
+                                                        smoka.min_calib,
+                                                        output_directory)
+        logging.info("End HSC")
+        logging.info("---------------------------------------")
+
+        # SMOKA envoie les images par mail: on note seulement les demandes
+        manifest.add_datasets(db,"SMOKA",
+                              [(frame, "SUP", None, None, None)
+                               for frame in frames_sup]
+                              +[(frame, "HSC", None, None, None)
+                                for frame in frames_hsc],
+                              manifest.REQUESTED)
+        manifest.set_archive_stage(db,"SMOKA",manifest.DONE)
 
-    logging.info("Searching Scientific images")
+    logging.info("End SMOKA archive")
 
-    if Box_search == "r":
-        (N_megaprime,planeURI_megaprime,
-         N_wircam,planeURI_wircam,N_cfh12,
-         planeURI_cfh12,dates_cfh12,
-         filters_cfh12,pIDs_cfh12,N_uh8k,
-         planeURI_uh8k,dates_uh8k,
-         filters_uh8k,pIDs_uh8k) = cfht.cfht_search_images(CENTRE,Sphere_Radius,
-                                                           cfht.tap_url)
+#################################### CFHT ########################################
 
-    elif Box_search == "b":
-        (N_megaprime,planeURI_megaprime,
-         N_wircam,planeURI_wircam,N_cfh12,
-         planeURI_cfh12,dates_cfh12,
-         filters_cfh12,pIDs_cfh12,N_uh8k,
-         planeURI_uh8k,dates_uh8k,
-         filters_uh8k,pIDs_uh8k) = cfht.cfht_search_images_2(CENTRE,Ra_box,
-                                                             DEC_box,
-                                                             cfht.tap_url)
+def run_cfht(target,credentials,session,db):
 
-    logging.info("Searching images calibrations")
+    Object = target['Object']
+    Box_search = target['Box_search']
+    Sphere_Radius = target['Sphere_Radius']
+    Ra_box = target['Ra_box']
+    DEC_box = target['DEC_box']
+    CENTRE = target['CENTRE']
+    (cfht_usr, cfht_pss) = credentials['CFHT']
 
-    # -- Recherche des BIAS, DARKS et FLATS dans les instruments CFH12K et UH8K --
+    logging.info("Running CFHT archive")
+    output_directory = cfht.cfht_parameter_in(Object)
 
-    # Maintenant on cherche les calibrations des images pour les instruments
-    # CFH12K et UH8K
+    cfht_stage = manifest.archive_stage(db,"CFHT")
+    if cfht_stage == manifest.DONE:
+        logging.info("CFHT images already downloaded, see the manifest")
 
-    if N_cfh12 != 0:
-        planeURI_cfh12_fbd = cfht.Search_FBD(dates_cfh12,filters_cfh12,
-                                             pIDs_cfh12,"CFH12K",cfht.tap_url)
+    elif cfht_stage == manifest.PLANNED:
+        logging.info("Resuming CFHT downloads from the manifest")
+        cfht.resume_cfht_downloads(cfht_usr,cfht_pss,output_directory,db,
+                                   session=session)
 
     else:
-        logging.info("No images calibrations was found in CFH12K")
-        planeURI_cfh12_fbd = []
+        logging.info("Searching Scientific images")
 
-    if N_uh8k != 0:
-        planeURI_uh8k_fbd = cfht.Search_FBD(dates_uh8k,filters_uh8k
-                                            ,pIDs_uh8k,"UH8K",cfht.tap_url)
+        if Box_search == "r":
+            (N_megaprime,planeURI_megaprime,
+             N_wircam,planeURI_wircam,N_cfh12,
+             planeURI_cfh12,dates_cfh12,
+             filters_cfh12,pIDs_cfh12,N_uh8k,
+             planeURI_uh8k,dates_uh8k,
+             filters_uh8k,pIDs_uh8k) = cfht.cfht_search_images(CENTRE,
+                                                               Sphere_Radius,
+                                                               cfht.tap_url)
 
-    else:
-        logging.info("No images calibrations was found in UH8K")
-        planeURI_uh8k_fbd = []
+        elif Box_search == "b":
+            (N_megaprime,planeURI_megaprime,
+             N_wircam,planeURI_wircam,N_cfh12,
+             planeURI_cfh12,dates_cfh12,
+             filters_cfh12,pIDs_cfh12,N_uh8k,
+             planeURI_uh8k,dates_uh8k,
+             filters_uh8k,pIDs_uh8k) = cfht.cfht_search_images_2(CENTRE,Ra_box,
+                                                                 DEC_box,
+                                                                 cfht.tap_url)
 
+        logging.info("Searching images calibrations")
 
-    logging.info("Downloading images")
+        # -- Recherche des BIAS, DARKS et FLATS dans CFH12K et UH8K --
 
-    cfht.download_cfht_images(cfht_usr,cfht_pss,cfht.download_url,N_megaprime,
-                              N_wircam,N_cfh12,N_uh8k,planeURI_megaprime,
-                              planeURI_wircam,planeURI_cfh12,planeURI_cfh12_fbd,
-                              planeURI_uh8k,planeURI_uh8k_fbd,output_directory)
+        # Maintenant on cherche les calibrations des images pour les instruments
+        # CFH12K et UH8K
 
-    logging.info("End CFHT archive")
+        if N_cfh12 != 0:
+            planeURI_cfh12_fbd = cfht.Search_FBD(dates_cfh12,filters_cfh12,
+                                                 pIDs_cfh12,"CFH12K",cfht.tap_url)
 
-    # ----------------------------- ESO ------------------------------------
-    logging.info("Running ESO archive")
-    output_directory = eso.eso_parameter_in(Object)
+        else:
+            logging.info("No images calibrations was found in CFH12K")
+            planeURI_cfh12_fbd = []
 
-    logging.info("Searching Scientific images")
+        if N_uh8k != 0:
+            planeURI_uh8k_fbd = cfht.Search_FBD(dates_uh8k,filters_uh8k
+                                                ,pIDs_uh8k,"UH8K",cfht.tap_url)
 
-    if Box_search == "r":
-        (N_sofi,planeURI_sofi,dates_sofi,
-         filters_sofi,orig_id_sofi,N_wfi,
-         planeURI_wfi,dates_wfi,filters_wfi,
-         orig_id_wfi,N_vircam,planeURI_vircam,
-         dates_vircam,filters_vircam,orig_id_vircam,
-         N_omegacam,planeURI_omegacam,dates_omegacam,
-         filters_omegacam,orig_id_omegacam,N_vimos,
-         planeURI_vimos,dates_vimos,filters_vimos,
-         orig_id_vimos,N_fors1,planeURI_fors1,
-         dates_fors1,filters_fors1,orig_id_fors1,
-         N_fors2,planeURI_fors2,dates_fors2,
-         filters_fors2,orig_id_fors2,N_hawki,
-         planeURI_hawki,dates_hawki,filters_hawki,
-         orig_id_hawki,Orig_Id) = eso.eso_search_images(Object,CENTRE,
-                                                        Sphere_Radius,
-                                                        eso.tap_url)
+        else:
+            logging.info("No images calibrations was found in UH8K")
+            planeURI_uh8k_fbd = []
 
-    elif Box_search == "b":
-        (N_sofi,planeURI_sofi,dates_sofi,
-         filters_sofi,orig_id_sofi,N_wfi,
-         planeURI_wfi,dates_wfi,filters_wfi,
-         orig_id_wfi,N_vircam,planeURI_vircam,
-         dates_vircam,filters_vircam,orig_id_vircam,
-         N_omegacam,planeURI_omegacam,dates_omegacam,
-         filters_omegacam,orig_id_omegacam,N_vimos,
-         planeURI_vimos,dates_vimos,filters_vimos,
-         orig_id_vimos,N_fors1,planeURI_fors1,
-         dates_fors1,filters_fors1,orig_id_fors1,
-         N_fors2,planeURI_fors2,dates_fors2,
-         filters_fors2,orig_id_fors2,N_hawki,
-         planeURI_hawki,dates_hawki,filters_hawki,
-         orig_id_hawki,Orig_Id) = eso.eso_search_images_2(Object,CENTRE,Ra_box,
-                                                          DEC_box,eso.tap_url)
-
-
-
-    logging.info("Searching images calibrations")
-
-    # --- Recherche des BIAS, DARKS et FLATS dans les instruments  ------
-
-    # Maintenant on cherche les calibrations des images pour les instruments
- 
-
-    if N_sofi != 0:
-        planeURI_sofi_fbd = eso.Search_FBD(dates_sofi,filters_sofi,
-                                           orig_id_sofi,"SOFI",Orig_Id,
-                                           eso.tap_url)
-    else:
-        planeURI_sofi_fbd = []
 
-    if N_wfi != 0:
-        planeURI_wfi_fbd = eso.Search_FBD(dates_wfi,filters_wfi,
-                                          orig_id_wfi,"WFI",Orig_Id,eso.tap_url)
-    else:
-        planeURI_wfi_fbd = []
+        logging.info("Downloading images")
 
-    if N_vircam != 0:
-        planeURI_vircam_fbd = eso.Search_FBD(dates_vircam,filters_vircam,
-                                             orig_id_vircam,"VIRCAM",Orig_Id,
-                                             eso.tap_url)
-    else:
-        planeURI_vircam_fbd = []
+        cfht.download_cfht_images(cfht_usr,cfht_pss,cfht.download_url,N_megaprime,
+                                  N_wircam,N_cfh12,N_uh8k,planeURI_megaprime,
+                                  planeURI_wircam,planeURI_cfh12,
+                                  planeURI_cfh12_fbd,
+                                  planeURI_uh8k,planeURI_uh8k_fbd,output_directory,
+                                  db=db,session=session)
 
-    if N_omegacam != 0:
-        planeURI_omegacam_fbd = eso.Search_FBD(dates_omegacam,filters_omegacam,
-                                               orig_id_omegacam,"OmegaCAM",
-                                               Orig_Id,eso.tap_url)
-    else:
-        planeURI_omegacam_fbd = []
+    logging.info("End CFHT archive")
 
-    if N_vimos != 0:
-        planeURI_vimos_fbd = eso.Search_FBD(dates_vimos,filters_vimos,
-                                            orig_id_vimos,"VIMOS",Orig_Id,
-                                            eso.tap_url)
-    else:
-        planeURI_vimos_fbd = []
+##################################### ESO ########################################
 
-    if N_fors1 != 0:
-        planeURI_fors1_fbd = eso.Search_FBD(dates_fors1,filters_fors1,
-                                            orig_id_fors1,"FORS1",Orig_Id,
-                                            eso.tap_url)
-    else:
-        planeURI_fors1_fbd = []
+def run_eso(target,credentials,session,db):
 
-    if N_fors2 != 0:
-        planeURI_fors2_fbd = eso.Search_FBD(dates_fors2,filters_fors2,
-                                            orig_id_fors2,"FORS2",Orig_Id,
-                                            eso.tap_url)
-    else:
-        planeURI_fors2_fbd = []
+    Object = target['Object']
+    Box_search = target['Box_search']
+    Sphere_Radius = target['Sphere_Radius']
+    Ra_box = target['Ra_box']
+    DEC_box = target['DEC_box']
+    CENTRE = target['CENTRE']
+    (eso_usr, eso_pss) = credentials['ESO']
 
-    if N_hawki != 0:
-        planeURI_hawki_fbd = eso.Search_FBD(dates_hawki,filters_hawki,
-                                            orig_id_hawki,"HAWKI",Orig_Id,
-                                            eso.tap_url)
-    else:
-        planeURI_hawki_fbd = []
+    logging.info("Running ESO archive")
+    output_directory = eso.eso_parameter_in(Object)
 
+    eso_stage = manifest.archive_stage(db,"ESO")
+    if eso_stage == manifest.DONE:
+        logging.info("ESO images already downloaded, see the manifest")
 
-    logging.info("Submitting Request")
+    elif eso_stage == manifest.PLANNED:
+        logging.info("Resuming ESO downloads from the manifest")
+        eso.resume_eso_downloads(eso_usr,eso_pss,output_directory,db,
+                                 session=session)
 
-    (planeURI_sofi,planeURI_wfi,
-     planeURI_vircam,planeURI_omegacam,
-     planeURI_vimos,planeURI_fors1,
-     planeURI_fors2,planeURI_hawki,
-     dic) = eso.summitting_eso_images(eso_usr,eso_pss,eso.request_url,
-                                      eso.request_url2,planeURI_sofi,
-                                      planeURI_sofi_fbd,planeURI_wfi,
-                                      planeURI_wfi_fbd,planeURI_vircam,
-                                      planeURI_vircam_fbd,planeURI_omegacam,
-                                      planeURI_omegacam_fbd,planeURI_vimos,
-                                      planeURI_vimos_fbd,planeURI_fors1,
-                                      planeURI_fors1_fbd,planeURI_fors2,
-                                      planeURI_fors2_fbd,planeURI_hawki,
-                                      planeURI_hawki_fbd)
+    else:
+        logging.info("Searching Scientific images")
+
+        if Box_search == "r":
+            (N_sofi,planeURI_sofi,dates_sofi,
+             filters_sofi,orig_id_sofi,N_wfi,
+             planeURI_wfi,dates_wfi,filters_wfi,
+             orig_id_wfi,N_vircam,planeURI_vircam,
+             dates_vircam,filters_vircam,orig_id_vircam,
+             N_omegacam,planeURI_omegacam,dates_omegacam,
+             filters_omegacam,orig_id_omegacam,N_vimos,
+             planeURI_vimos,dates_vimos,filters_vimos,
+             orig_id_vimos,N_fors1,planeURI_fors1,
+             dates_fors1,filters_fors1,orig_id_fors1,
+             N_fors2,planeURI_fors2,dates_fors2,
+             filters_fors2,orig_id_fors2,N_hawki,
+             planeURI_hawki,dates_hawki,filters_hawki,
+             orig_id_hawki,Orig_Id) = eso.eso_search_images(Object,CENTRE,
+                                                            Sphere_Radius,
+                                                            eso.tap_url)
+
+        elif Box_search == "b":
+            (N_sofi,planeURI_sofi,dates_sofi,
+             filters_sofi,orig_id_sofi,N_wfi,
+             planeURI_wfi,dates_wfi,filters_wfi,
+             orig_id_wfi,N_vircam,planeURI_vircam,
+             dates_vircam,filters_vircam,orig_id_vircam,
+             N_omegacam,planeURI_omegacam,dates_omegacam,
+             filters_omegacam,orig_id_omegacam,N_vimos,
+             planeURI_vimos,dates_vimos,filters_vimos,
+             orig_id_vimos,N_fors1,planeURI_fors1,
+             dates_fors1,filters_fors1,orig_id_fors1,
+             N_fors2,planeURI_fors2,dates_fors2,
+             filters_fors2,orig_id_fors2,N_hawki,
+             planeURI_hawki,dates_hawki,filters_hawki,
+             orig_id_hawki,Orig_Id) = eso.eso_search_images_2(Object,CENTRE,
+                                                              Ra_box,DEC_box,
+                                                              eso.tap_url)
+
+
+
+        logging.info("Searching images calibrations")
+
+        # --- Recherche des BIAS, DARKS et FLATS dans les instruments  ------
+
+        # Maintenant on cherche les calibrations des images pour les instruments
+
+
+        if N_sofi != 0:
+            planeURI_sofi_fbd = eso.Search_FBD(dates_sofi,filters_sofi,
+                                               orig_id_sofi,"SOFI",Orig_Id,
+                                               eso.tap_url)
+        else:
+            planeURI_sofi_fbd = []
+
+        if N_wfi != 0:
+            planeURI_wfi_fbd = eso.Search_FBD(dates_wfi,filters_wfi,
+                                              orig_id_wfi,"WFI",Orig_Id,
+                                              eso.tap_url)
+        else:
+            planeURI_wfi_fbd = []
+
+        if N_vircam != 0:
+            planeURI_vircam_fbd = eso.Search_FBD(dates_vircam,filters_vircam,
+                                                 orig_id_vircam,"VIRCAM",Orig_Id,
+                                                 eso.tap_url)
+        else:
+            planeURI_vircam_fbd = []
+
+        if N_omegacam != 0:
+            planeURI_omegacam_fbd = eso.Search_FBD(dates_omegacam,filters_omegacam,
+                                                   orig_id_omegacam,"OmegaCAM",
+                                                   Orig_Id,eso.tap_url)
+        else:
+            planeURI_omegacam_fbd = []
+
+        if N_vimos != 0:
+            planeURI_vimos_fbd = eso.Search_FBD(dates_vimos,filters_vimos,
+                                                orig_id_vimos,"VIMOS",Orig_Id,
+                                                eso.tap_url)
+        else:
+            planeURI_vimos_fbd = []
+
+        if N_fors1 != 0:
+            planeURI_fors1_fbd = eso.Search_FBD(dates_fors1,filters_fors1,
+                                                orig_id_fors1,"FORS1",Orig_Id,
+                                                eso.tap_url)
+        else:
+            planeURI_fors1_fbd = []
+
+        if N_fors2 != 0:
+            planeURI_fors2_fbd = eso.Search_FBD(dates_fors2,filters_fors2,
+                                                orig_id_fors2,"FORS2",Orig_Id,
+                                                eso.tap_url)
+        else:
+            planeURI_fors2_fbd = []
+
+        if N_hawki != 0:
+            planeURI_hawki_fbd = eso.Search_FBD(dates_hawki,filters_hawki,
+                                                orig_id_hawki,"HAWKI",Orig_Id,
+                                                eso.tap_url)
+        else:
+            planeURI_hawki_fbd = []
+
+
+        logging.info("Submitting requests and downloading images")
+
+        datasets = eso.eso_datasets([("SOFI", planeURI_sofi, planeURI_sofi_fbd),
+                                     ("WFI", planeURI_wfi, planeURI_wfi_fbd),
+                                     ("VIRCAM", planeURI_vircam,
+                                      planeURI_vircam_fbd),
+                                     ("OmegaCAM", planeURI_omegacam,
+                                      planeURI_omegacam_fbd),
+                                     ("VIMOS", planeURI_vimos,
+                                      planeURI_vimos_fbd),
+                                     ("FORS1", planeURI_fors1,
+                                      planeURI_fors1_fbd),
+                                     ("FORS2", planeURI_fors2,
+                                      planeURI_fors2_fbd),
+                                     ("HAWKI", planeURI_hawki,
+                                      planeURI_hawki_fbd)])
+
+        eso.write_orig_id(output_directory,Orig_Id)
+
+        eso.eso_request_pipeline(eso_usr,eso_pss,eso.request_url,
+                                 eso.download_url,datasets,Orig_Id,
+                                 output_directory,db=db,session=session)
 
-    
+    logging.info("End ESO archive")
 
-    logging.info("Downloading images")
+############################ Les archives en parallèle ##########################
+
+# Une archive pour une cible, dans un thread nommé "<objet>:<archive>". Renvoie
+# le nom de l'archive si elle a échoué: les autres archives continuent.
+
+def run_archive(archive,target,credentials,sessions,db):
+
+    threading.current_thread().name = target['Object']+':'+archive
+    start = time.time()
+    try:
+        if archive == "SMOKA":
+            run_smoka(target,db)
+        elif archive == "CFHT":
+            run_cfht(target,credentials,sessions['CFHT'],db)
+        elif archive == "ESO":
+            run_eso(target,credentials,sessions['ESO'],db)
+    except Exception:
+        logging.exception(archive+" archive failed")
+        return archive
+
+    logging.info(archive+" archive finished in %.0f s" %(time.time()-start))
+
+    return None
+
+def run_archives(target,credentials,sessions,db):
+
+    pool = ThreadPool(len(ARCHIVES))
+    try:
+        failed = [archive for archive in
+                  pool.map(lambda archive: run_archive(archive,target,
+                                                       credentials,sessions,
+                                                       db), ARCHIVES)
+                  if archive is not None]
+    finally:
+        pool.close()
+        pool.join()
+
+    if len(failed) != 0:
+        raise RuntimeError("Failed archives: "+", ".join(failed))
+
+################################## Une cible #####################################
+
+# Recherche et téléchargement d'une cible dans les 3 archives. Les images sont
+# rangées dans un dossier au nom de l'objet, avec son Search.log et son
+# manifeste: toutes les images prévues y sont notées et, après un arrêt, on
+# reprend là où la recherche s'était arrêtée sans refaire les requêtes aux
+# archives.
+
+def run_target(target,credentials,sessions,thread_name=None):
+
+    Object = target['Object']
+    output_directory = directory+'/{}'.format(Object)
+    if not os.path.exists(output_directory):
+        os.makedirs(output_directory)
+
+    fh = target_log(output_directory,thread_name)
+    db = manifest.open_manifest(manifest.manifest_path(output_directory))
+    try:
+        logging.info("Object: "+str(Object))
+        logging.info("Coordinates[ICRS]: RA, DEC = {}  {}"
+                     .format(target['ra_str'],target['dec_str']))
+        manifest.summary(db)
+
+        run_archives(target,credentials,sessions,db)
+
+        manifest.summary(db)
+        logging.info("Done")
+
+    except Exception:
+        logging.exception("Search of "+Object+" failed")
+        raise
+
+    finally:
+        db.close()
+        logging.getLogger().removeHandler(fh)
+        fh.close()
+
+# Plusieurs cibles à la fois: chaque cible est traitée par un thread qui porte
+# son nom. L'échec d'une cible n'arrête pas les autres; renvoie la liste des
+# cibles en échec.
+
+def run_targets(targets,credentials,workers=n_targets):
+
+    sessions = archive_sessions(credentials,workers)
+
+    def run(target):
+        thread = threading.current_thread()
+        thread.name = target['Object']
+        try:
+            run_target(target,credentials,sessions,thread.name)
+            return None
+        except Exception:
+            # Déjà noté dans le Search.log de la cible
+            return target['Object']
+
+    pool = ThreadPool(max(1, min(workers, len(targets))))
+    try:
+        failed = [Object for Object in pool.map(run, targets)
+                  if Object is not None]
+    finally:
+        pool.close()
+        pool.join()
+        for session in sessions.values():
+            session.close()
+
+    logging.info(str(len(targets)-len(failed))+" targets done, "
+                 +str(len(failed))+" failed")
+
+    return failed
 
-    eso.download_eso_images(eso_usr,eso_pss,eso.download_url,dic,Orig_Id,
-                            N_sofi,N_wfi,N_vircam,N_omegacam,N_vimos,
-                            N_fors1,N_fors2,N_hawki,planeURI_sofi,
-                            planeURI_wfi,planeURI_vircam,planeURI_omegacam,
-                            planeURI_vimos,planeURI_fors1,planeURI_fors2,
-                            planeURI_hawki,output_directory)
+##################################################################################
 
-    logging.info("End ESO archive")
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Search and download images '
+                                     'of an object in the SMOKA, CFHT and ESO '
+                                     'archives.')
+    parser.add_argument('--batch', metavar='FILE',
+                        help='file of targets, one "object, r, radius" or '
+                        '"object, b, length, width" per line')
+    parser.add_argument('--workers', type=int, default=n_targets,
+                        help='targets searched at the same time in batch mode')
+    args = parser.parse_args()
+
+    if args.batch is not None:
+        targets = read_targets(args.batch)
+    else:
+        targets = [read_parameters()]
 
-    logging.info("Done")
+    credentials = read_credentials()
 
+    setup_logging()
+    targets = resolve_targets(targets)
 
+    if args.batch is None:
+        # Une seule cible: tout le log va dans son Search.log
+        if len(targets) == 0:
+            sys.exit("Object not found in Simbad")
+        sessions = archive_sessions(credentials,1)
+        run_target(targets[0],credentials,sessions)
+        for session in sessions.values():
+            session.close()
+    else:
+        failed = run_targets(targets,credentials,args.workers)
+        if len(failed) != 0:
+            sys.exit("Failed targets: "+", ".join(failed))
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Ce module secondaire définit le manifeste des téléchargements: une petite base
+# SQLite (manifest.sqlite dans le dossier de l'objet) qui garde toutes les
+# images prévues pour SMOKA, CFHT et ESO avec leur statut, leur taille, leur
+# somme de contrôle, leur numéro de requête et le nombre de tentatives.
+#
+# Une recherche peut durer plusieurs semaines: si elle s'arrête, le code
+# principal relit le manifeste et reprend les téléchargements là où ils se sont
+# arrêtés, sans refaire les requêtes aux archives ni tester l'existence de
+# milliers de fichiers.
+
+################### On va importer les modules standards ########################
+
+import os
+import logging
+import sqlite3
+import threading
+
+########################## Paramètres de départ #################################
+
+# Statuts d'une image
+PLANNED = 'planned'     # à télécharger
+DONE = 'done'           # téléchargée et vérifiée
+FAILED = 'failed'       # dernière tentative ratée
+REQUESTED = 'requested' # demandée par mail (SMOKA), pas de téléchargement
+
+# Étapes d'une archive: PLANNED quand toutes ses images sont dans le manifeste,
+# DONE quand elles sont toutes téléchargées.
+
+_lock = threading.Lock() # une seule écriture à la fois, tous threads confondus
+
+############################## Base SQLite ######################################
+
+def manifest_path(output_directory):
+    return output_directory+'/manifest.sqlite'
+
+# La connexion est partagée par les threads de téléchargement: les accès sont
+# protégés par _lock.
+
+def open_manifest(path):
+
+    db = sqlite3.connect(path, check_same_thread=False)
+    with _lock:
+        db.execute('''CREATE TABLE IF NOT EXISTS datasets (
+                      archive TEXT NOT NULL,
+                      dataset TEXT NOT NULL,
+                      instrument TEXT,
+                      url TEXT,
+                      path TEXT,
+                      status TEXT NOT NULL,
+                      size INTEGER,
+                      checksum TEXT,
+                      request_id TEXT,
+                      attempts INTEGER NOT NULL DEFAULT 0,
+                      PRIMARY KEY (archive, dataset))''')
+        db.execute('''CREATE INDEX IF NOT EXISTS datasets_path
+                      ON datasets (path)''')
+        db.execute('''CREATE TABLE IF NOT EXISTS stages (
+                      archive TEXT PRIMARY KEY,
+                      stage TEXT NOT NULL)''')
+        db.commit()
+
+    return db
+
+############################## Étapes ###########################################
+
+def archive_stage(db,archive):
+
+    with _lock:
+        row = db.execute('SELECT stage FROM stages WHERE archive = ?',
+                         (archive,)).fetchone()
+
+    return row[0] if row is not None else None
+
+def set_archive_stage(db,archive,stage):
+
+    with _lock:
+        db.execute('INSERT OR REPLACE INTO stages (archive, stage) '
+                   'VALUES (?, ?)', (archive, stage))
+        db.commit()
+
+############################## Images ###########################################
+
+# rows: liste de (dataset, instrument, url, path, request_id). Une image déjà
+# connue garde son statut; son url et sa requête sont mises à jour.
+
+def add_datasets(db,archive,rows,status=PLANNED):
+
+    with _lock:
+        db.executemany('INSERT OR IGNORE INTO datasets (archive, dataset, '
+                       'instrument, url, path, status, request_id) '
+                       'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                       [(archive, dataset, inst, url, path, status, rid)
+                        for (dataset, inst, url, path, rid) in rows])
+        db.executemany('UPDATE datasets SET url = ?, path = ?, request_id = ? '
+                       'WHERE archive = ? AND dataset = ?',
+                       [(url, path, rid, archive, dataset)
+                        for (dataset, inst, url, path, rid) in rows])
+        db.commit()
+
+# Résultat d'une tentative de téléchargement, repéré par le fichier de sortie
+
+def record_download(db,path,status,size=None,checksum=None):
+
+    with _lock:
+        db.execute('UPDATE datasets SET status = ?, '
+                   'size = COALESCE(?, size), '
+                   'checksum = COALESCE(?, checksum), '
+                   'attempts = attempts + 1 WHERE path = ?',
+                   (status, size, checksum, path))
+        db.commit()
+
+# Images d'une archive qui restent à télécharger: (url, path, dataset), comme
+# les listes de download_module.download_files
+
+def pending_downloads(db,archive):
+
+    with _lock:
+        rows = db.execute('SELECT url, path, dataset FROM datasets '
+                          'WHERE archive = ? AND status IN (?, ?) '
+                          'AND url IS NOT NULL',
+                          (archive, PLANNED, FAILED)).fetchall()
+
+    return [(str(url), str(path), str(dataset))
+            for (url, path, dataset) in rows]
+
+# Les mêmes images rangées par requête: {requête: [(url, path, dataset)]}. Les
+# images sans numéro de requête sont sous la clé None.
+
+def pending_requests(db,archive):
+
+    with _lock:
+        rows = db.execute('SELECT request_id, url, path, dataset FROM datasets '
+                          'WHERE archive = ? AND status IN (?, ?) '
+                          'AND url IS NOT NULL',
+                          (archive, PLANNED, FAILED)).fetchall()
+
+    requests = {}
+    for (rid, url, path, dataset) in rows:
+        rid = str(rid) if rid is not None else None
+        requests.setdefault(rid, []).append((str(url), str(path),
+                                             str(dataset)))
+
+    return requests
+
+# Fichiers déjà téléchargés d'une archive
+
+def done_paths(db,archive):
+
+    with _lock:
+        rows = db.execute('SELECT path FROM datasets WHERE archive = ? '
+                          'AND status = ?', (archive, DONE)).fetchall()
+
+    return set(str(path) for (path,) in rows)
+
+def summary(db):
+
+    with _lock:
+        rows = db.execute('SELECT archive, status, COUNT(*) FROM datasets '
+                          'GROUP BY archive, status ORDER BY archive, '
+                          'status').fetchall()
+
+    for (archive, status, n) in rows:
+        logging.info("Manifest: "+str(archive)+" "+str(n)+" "+str(status))
+
+    return rows
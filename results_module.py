@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Ce module secondaire définit la normalisation des tableaux de résultats des
+# archives (un tableau pandas par instrument), commune à CFHT et ESO. Tout se
+# fait colonne par colonne, sans boucle sur les lignes: sur des tableaux de
+# dizaines de milliers de lignes, le traitement reste négligeable devant la
+# requête elle-même.
+
+################### On va importer les modules standards ########################
+
+import logging
+import numpy as np
+
+########################## Paramètres de départ #################################
+
+# Noms d'objet qui trahissent une image de calibration marquée comme OBJECT
+CALIBRATION_NAMES = r'BIAS|FLAT|DARK'
+
+######################### Images sans nom ######################################
+
+# Certaines images, récent ou pas, n'ont pas de noms propres (NaN). Elles
+# peuvent être importantes à étudier: elles sont renommées unnamed_obj_1,
+# unnamed_obj_2, ... dans l'ordre du tableau. Renvoie le nombre d'images
+# renommées.
+
+def name_unnamed(table,column):
+
+    null = table[column].isnull().values
+    n = int(null.sum())
+    if n == 0:
+        logging.info("No unnamed image has been found")
+        return 0
+
+    logging.info("There are "+str(n)+" unnamed images found")
+    table.loc[null, column] = ["unnamed_obj_"+str(c) for c in range(1, n+1)]
+    logging.info(str(n)+" unnamed images have been named")
+
+    return n
+
+############################ Filtres ###########################################
+
+# Colonne utilisable avec .str: une colonne lue comme numérique est convertie
+# en texte; une colonne de texte est gardée telle quelle (pas de conversion
+# des noms unicode).
+
+def text_values(values):
+
+    if values.dtype != object:
+        return values.astype(str)
+
+    return values
+
+# Lignes dont le nom d'objet contient BIAS, FLAT ou DARK
+
+def calibration_rows(table,column):
+    return text_values(table[column]).str.contains(CALIBRATION_NAMES,
+                                                   na=False).values
+
+# Lignes dont la colonne se termine par suffix (images calibrées de CFHT:
+# Product ID en *******p)
+
+def suffix_rows(table,column,suffix):
+    return text_values(table[column]).str.endswith(suffix).fillna(False).values
+
+# Traitement complet d'un tableau: noms manquants, puis, si demandé, retrait
+# des calibrations marquées OBJECT et des images dont suffix_column ne se
+# termine pas par suffix. Renvoie les indices (triés) des lignes gardées.
+
+def normalize_results(table,inst,name_column,drop_calibrations=False,
+                      suffix_column=None,suffix='p'):
+
+    logging.info("Searching for unnamed objects present in "+inst)
+    name_unnamed(table,name_column)
+
+    keep = np.ones(len(table), dtype=bool)
+    if len(table) != 0:
+        if drop_calibrations:
+            keep &= ~calibration_rows(table,name_column)
+        if suffix_column is not None:
+            keep &= suffix_rows(table,suffix_column,suffix)
+
+    return np.where(keep)[0]
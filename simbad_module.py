@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Ce module secondaire définit la résolution du nom de l'objet avec Simbad. Une
+# seule requête donne les coordonnées en degrés et en sexagésimal (une seule
+# requête aussi pour toute une liste d'objets en mode batch), et le résultat
+# est gardé dans un cache sur le disque (simbad_cache.json dans le
+# dossier de travail), indexé par le nom normalisé de l'objet. Tant qu'il n'a
+# pas expiré, les lancements suivants n'interrogent plus Simbad.
+
+################### On va importer les modules standards ########################
+
+import os
+import json
+import time
+import logging
+import threading
+from astroquery.simbad import Simbad
+
+########################## Paramètres de départ #################################
+
+directory = os.getcwd()
+cache_file = directory+'/simbad_cache.json'
+cache_ttl = 30*24*3600. # secondes avant de redemander les coordonnées
+
+_cache_lock = threading.Lock()
+
+# Instance propre au module: les champs ajoutés ne touchent pas l'objet Simbad
+# partagé par les autres modules. Colonnes: MAIN_ID, RA et DEC en degrés, RA et
+# DEC en sexagésimal, puis le nom demandé (TYPED_ID).
+_simbad = Simbad()
+_simbad.reset_votable_fields()
+_simbad.remove_votable_fields('coordinates')
+_simbad.add_votable_fields('ra(d;A;ICRS)', 'dec(d;D;ICRS)',
+                           'ra(:;A;ICRS;J2000)', 'dec(:;D;ICRS;J2000)',
+                           'typed_id')
+
+################################ Cache ##########################################
+
+# "ngc  1333" et "NGC 1333" désignent le même objet
+
+def normalize_name(Object):
+    return ' '.join(Object.split()).upper()
+
+def read_cache():
+
+    if not os.path.exists(cache_file):
+        return {}
+    try:
+        with open(cache_file) as f:
+            return json.load(f)
+    except ValueError:
+        logging.warning("Simbad cache "+cache_file+" is unreadable, ignored")
+        return {}
+
+# Écriture dans un fichier temporaire puis renommage: le cache n'est jamais
+# à moitié écrit.
+
+def write_cache(entries):
+
+    with _cache_lock:
+        cache = read_cache()
+        cache.update(entries)
+        with open(cache_file+'.tmp', 'w') as f:
+            json.dump(cache, f, indent=1, sort_keys=True)
+        os.rename(cache_file+'.tmp', cache_file)
+
+def cached(cache,key):
+
+    entry = cache.get(key)
+    if entry is None or time.time() - entry['time'] > cache_ttl:
+        return None
+    return entry
+
+########################### Coordonnées ########################################
+
+# Coordonnée sexagésimale "hh:mm:ss.s" -> "hh mm ss.s". Simbad donne parfois la
+# déclinaison sans les secondes ("dd:mm.m"): on écrit alors "dd mm 00".
+
+def sexagesimal(value):
+
+    parts = value.split(':')
+    if len(parts) < 3:
+        parts = (parts[:1] + [p.split('.')[0] for p in parts[1:]]
+                 + ['00', '00'])[:3]
+
+    return '{} {} {}'.format(parts[0],parts[1],parts[2])
+
+def table_entry(row):
+
+    return {'time': time.time(),
+            'ra': float(row[1]), 'dec': float(row[2]),
+            'ra_str': sexagesimal(str(row[3])),
+            'dec_str': sexagesimal(str(row[4]))}
+
+# Renvoie un dictionnaire: ra, dec en degrés et ra_str, dec_str en sexagésimal
+
+def resolve_object(Object):
+
+    key = normalize_name(Object)
+    entry = cached(read_cache(),key)
+    if entry is not None:
+        logging.info("Coordinates of "+Object+" read from the Simbad cache")
+        return entry
+
+    table = _simbad.query_object(Object, wildcard=False)
+    if table is None or len(table) == 0:
+        raise ValueError("Object "+Object+" not found in Simbad")
+
+    entry = table_entry(table[0])
+    write_cache({key: entry})
+
+    return entry
+
+# Résolution d'une liste d'objets: les objets absents du cache sont demandés
+# en une seule requête. Renvoie un dictionnaire nom -> coordonnées; un objet
+# inconnu de Simbad n'y figure pas.
+
+def resolve_objects(names):
+
+    cache = read_cache()
+    found = {}
+    missing = {}
+    for Object in names:
+        key = normalize_name(Object)
+        entry = cached(cache,key)
+        if entry is not None:
+            found[Object] = entry
+        else:
+            missing.setdefault(key, []).append(Object)
+
+    logging.info(str(len(found))+" objects read from the Simbad cache, "
+                 +str(len(missing))+" to resolve")
+    if len(missing) == 0:
+        return found
+
+    table = _simbad.query_objects([objs[0] for objs in missing.values()])
+    entries = {}
+    if table is not None:
+        for row in table:
+            key = normalize_name(str(row['TYPED_ID']))
+            if key in missing and key not in entries:
+                entries[key] = table_entry(row)
+
+    for key, objs in missing.items():
+        if key not in entries:
+            logging.warning("Object "+objs[0]+" not found in Simbad")
+            continue
+        for Object in objs:
+            found[Object] = entries[key]
+
+    if len(entries) != 0:
+        write_cache(entries)
+
+    return found
+
+# Centre de la recherche en degrés, comme attendu par les modules d'archive
+
+def object_center(Object):
+
+    entry = resolve_object(Object)
+
+    return (entry['ra'], entry['dec'])
@@ -19,7 +19,10 @@
 import sys
 import io
 import os
+import glob
+import json
 import logging
+import threading
 import requests
 import numpy as np
 import pandas as pd
@@ -31,9 +34,12 @@ from astropy.time import Time
 from astropy.io import fits
 from astropy.io import ascii
 from astropy.table import Table
-from astroquery.simbad import Simbad as sd
 from requests.auth import HTTPBasicAuth
 
+###################### Importation des modules personnels ####################
+
+import simbad_module as simbad
+
 ########################## Paramètres de départ #################################
 
 # Comme son nom indique, on va définir les paramètres de départ, soit le nom de
@@ -66,6 +72,16 @@ dt_dark = [5,15]
 
 min_calib = 5 # nombre min des images calibrées
 
+# Types de données (DATA_TYP) des images de calibration dans les obslogs
+BIAS_TYPES = ['BIAS','ZERO']
+FLAT_TYPES = ['FLAT','DOMEFLAT','SKYFLAT']
+DARK_TYPES = ['DARK']
+
+# Position des colonnes utiles dans les obslogs: FRAME_ID, DATE_OBS, FILTER,
+# RA2000, DEC2000, UT_STR, EXPTIME et DATA_TYP.
+SUP_COLUMNS = [0,1,4,5,6,14,15,17]
+HSC_COLUMNS = [0,1,3,4,5,13,14,16]
+
 # Field of view (http://smoka.nao.ac.jp/help/help.jsp)
 FOV_SUP_arcsec = 2000/2 * u.arcsec
 FOV_HSC_arcsec = 5400/2 * u.arcsec
@@ -141,407 +157,735 @@ sm_dir = directory+'/SMOKA/'
 if not os.path.exists(sm_dir):
     os.makedirs(sm_dir)
 
-def update_hsc_data(a):
-    Data = {}
-    logging.info("Searching for update for HSC data")
-    a = a.split('/')
-    d = a[-1].split('.')
-    e = d[0].split('_')
-    f = int(e[1])
-    
-    date = datetime.now()
-    year = date.year
-    s = 'https://smoka.nao.ac.jp/status/obslog/HSC_{}.txt'.format(year)
-    r = requests.head(s)
-    
+# Les obslogs sont publiés par année (HSC_2019.txt, ...). On garde chaque année
+# dans SMOKA/<instrument>/ avec son ETag, son Last-Modified et sa taille dans
+# sync.json. Une mise à jour ne télécharge que les nouvelles années et la
+# dernière année connue (la seule qui change encore), avec des requêtes
+# conditionnelles: une année inchangée répond 304 et n'est pas relue. Chaque
+# année donne un morceau de catalogue, les anciennes années ne sont jamais
+# réécrites.
+
+obslog_url = 'https://smoka.nao.ac.jp/status/obslog/{}_{}.txt'
+
+def obslog_dir(inst):
+    path = sm_dir+'/'+SMOKA_FILES[inst]+'/'
+    if not os.path.exists(path):
+        os.makedirs(path)
+    return path
+
+def obslog_path(inst,year):
+    return obslog_dir(inst)+'{}_{}.txt'.format(inst,year)
+
+def chunk_path(inst,year):
+    return obslog_dir(inst)+'{}_{}.fits'.format(inst,year)
+
+def read_sync_state(inst):
+    path = obslog_dir(inst)+'sync.json'
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+def write_sync_state(inst,state):
+    path = obslog_dir(inst)+'sync.json'
+    with open(path+'.tmp', 'w') as f:
+        json.dump(state, f, indent=1, sort_keys=True)
+    os.rename(path+'.tmp', path)
+
+# Télécharge une année si elle a changé. Renvoie True si l'année a été
+# (re)écrite.
+
+def fetch_obslog_year(session,inst,year,state):
+
+    url = obslog_url.format(inst,year)
+    known = state.get(str(year))
+    headers = {}
+    if known is not None and os.path.exists(chunk_path(inst,year)):
+        if known.get('etag'):
+            headers['If-None-Match'] = known['etag']
+        if known.get('last_modified'):
+            headers['If-Modified-Since'] = known['last_modified']
+    else:
+        known = None
+
+    r = session.get(url, headers=headers, stream=True, timeout=60)
+    try:
+        if r.status_code == 304 or r.status_code == 404:
+            return False
+        r.raise_for_status()
+
+        etag = r.headers.get('ETag')
+        last_modified = r.headers.get('Last-Modified')
+        size = r.headers.get('Content-Length')
+        size = int(size) if size is not None else None
+
+        # Serveur sans requêtes conditionnelles: on compare les métadonnées
+        if (known is not None and size is not None and size == known['size']
+            and ((etag and etag == known.get('etag')) or
+                 (last_modified and last_modified ==
+                  known.get('last_modified')))):
+            return False
+
+        # Le corps est lu par morceaux: copié dans le .txt et analysé au vol
+        with open(obslog_path(inst,year)+'.tmp', 'wb') as f:
+            chunks = r.iter_content(chunk_size=OBSLOG_CHUNK)
+            fields = parse_obslog(tee_chunks(chunks,f), SMOKA_COLUMNS[inst])
+        os.rename(obslog_path(inst,year)+'.tmp', obslog_path(inst,year))
+    finally:
+        r.close()
+
+    write_obslog_chunk(inst,year,fields)
+
+    if size is None:
+        size = os.path.getsize(obslog_path(inst,year))
+    state[str(year)] = {'etag': etag, 'last_modified': last_modified,
+                        'size': size}
+    write_sync_state(inst,state)
+    logging.info("New version for year "+str(year))
+
+    return True
+
+# Synchronisation des obslogs d'un instrument. Avec recheck_all=True, toutes
+# les années connues sont revérifiées (toujours par requêtes conditionnelles).
+
+def sync_obslogs(inst,recheck_all=False):
+
+    logging.info("Searching for update for "+inst+" data")
+    state = read_sync_state(inst)
+    known = sorted(int(y) for y in state)
+    session = requests.Session()
+
+    # Dernière année publiée
+    year = datetime.now().year
+    r = session.head(obslog_url.format(inst,year), timeout=60)
     while r.status_code != 200:
         year = year - 1
-        s = 'https://smoka.nao.ac.jp/status/obslog/HSC_{}.txt'.format(year)
-        r = requests.head(s)
-    
-    if year != f:
-        logging.info("A new version of HSC data is available")
-        logging.info("New version for year "+str(year))
-        counter = 0
-
-        # On doit d'abord suprimer l'ancien version
-        if os.path.exists(sm_dir+'/HSC.txt'):
-            os.remove(sm_dir+'/HSC.txt')
-        if os.path.exists(sm_dir+'/HSC.fits'):
-            os.remove(sm_dir+'/HSC.fits')
-        
-        while r.status_code == 200:
-            obj = requests.get(s)
-            if counter == 0:
-                with open (sm_dir+'/HSC.txt', 'a') as f:
-                    f.write(obj.content)
-            else:
-                with open (sm_dir+'/HSC.txt', 'a') as f:
-                    with open(sm_dir+'/hsc_dat.txt', 'w') as g:
-                        g.write(obj.content)
-                    
-                    g = open(sm_dir+'/hsc_dat.txt', 'r')
-                    for line in g:
-                        if not '#' in line:
-                            f.write(line)
-                    g.close()
-                    os.remove(sm_dir+'/hsc_dat.txt')
-            year = year - 1
-            s = 'https://smoka.nao.ac.jp/status/obslog/HSC_{}.txt'.format(year)
-            r = requests.head(s)
-            counter +=1
-        
-        g = open(sm_dir+'/HSC.txt', 'r')
-        for lines in g:
-            if '#' in lines:
-                header = lines.split()
-        for i in header:
-            Data[i] = []
-        
-        y = open(sm_dir+'/HSC.txt', 'r')
-        y.readline()
-        for line in y:
-            #print line
-            data = line.split()
-            for ij, j in enumerate(data):
-                for it, i in enumerate(header):
-                    if it == ij:
-                        Data[i].append(j)
-
-        g.close()
-        y.close()
-        
-        for i in Data.keys():
-            Data[i] = np.array(Data[i])
-        
-        #print Data.keys()
-        
-        ascii.write([Data[i] for i in header], sm_dir+'/HSC.ascii',
-                    names=header, overwrite=True)
-        table = Table.read(sm_dir+'/HSC.ascii', format='ascii')
-        table = np.array(table)
-        fits.writeto(sm_dir+'/HSC.fits',table)
-    
+        if year < (known[-1] if known else 1999):
+            break
+        r = session.head(obslog_url.format(inst,year), timeout=60)
+    newest = year
+
+    # Nouvelles années (toutes les années si rien n'est connu)
+    years = []
+    year = newest
+    while year > (known[-1] if known else 0):
+        if not known and year != newest:
+            r = session.head(obslog_url.format(inst,year), timeout=60)
+            if r.status_code != 200:
+                break
+        years.append(year)
+        year = year - 1
+
+    # Années déjà connues à revérifier
+    if recheck_all:
+        years.extend(reversed(known))
+    elif known:
+        years.append(known[-1])
+
+    changed = []
+    for year in tqdm(years):
+        if fetch_obslog_year(session,inst,year,state):
+            changed.append(year)
+    session.close()
+
+    if changed:
+        logging.info("A new version of "+inst+" data is available")
+        write_sky_index(inst, load_smoka_catalog(inst))
     else:
         logging.info("The data is up to date")
 
+    return changed
+
+def update_hsc_data(recheck_all=False):
+    return sync_obslogs('HSC',recheck_all)
+
 # On fait de même pour SuprimeCam même s'il est inopérationnel
 
-def update_sup_data(a):
-    Data = {}
-    logging.info("Searching for update for SUP data")
-    a = a.split('/')
-    d = a[-1].split('.')
-    e = d[0].split('_')
-    f = int(e[1])
-    
-    date = datetime.now()
-    year = date.year
-    s = 'https://smoka.nao.ac.jp/status/obslog/SUP_{}.txt'.format(year)
-    r = requests.head(s)
-    
-    while r.status_code != 200:
-        year = year - 1
-        s = 'https://smoka.nao.ac.jp/status/obslog/SUP_{}.txt'.format(year)
-        r = requests.head(s)
-    
-    if year != f:
-        logging.info("A new version of SUP data is available")
-        logging.info("New version for year "+str(year))
-        counter = 0
-
-        # On doit d'abord suprimer l'ancien version
-        if os.path.exists(sm_dir+'/SuprimeCam.txt'):
-            os.remove(sm_dir+'/SuprimeCam.txt')
-        if os.path.exists(sm_dir+'/SuprimeCam.fits'):
-            os.remove(sm_dir+'/SuprimeCam.fits')
-        
-        while r.status_code == 200:
-            obj = requests.get(s)
-            if counter == 0:
-                with open (sm_dir+'/SuprimeCam.txt', 'a') as f:
-                    f.write(obj.content)
-            else:
-                with open (sm_dir+'/SuprimeCam.txt', 'a') as f:
-                    with open(sm_dir+'/sup_dat.txt', 'w') as g:
-                        g.write(obj.content)
-                    
-                    g = open(sm_dir+'/sup_dat.txt', 'r')
-                    for line in g:
-                        if not '#' in line:
-                            f.write(line)
-                    g.close()
-                    os.remove(sm_dir+'/sup_dat.txt')
-            year = year - 1
-            s = 'https://smoka.nao.ac.jp/status/obslog/SUP_{}.txt'.format(year)
-            r = requests.head(s)
-            counter +=1
-        
-        g = open(sm_dir+'/SuprimeCam.txt', 'r')
-        for lines in g:
-            if '#' in lines:
-                header = lines.split()
-        for i in header:
-            Data[i] = []
-        
-        y = open(sm_dir+'/SuprimeCam.txt', 'r')
-        y.readline()
-        for line in y:
-            #print line
-            data = line.split()
-            for ij, j in enumerate(data):
-                for it, i in enumerate(header):
-                    if it == ij:
-                        Data[i].append(j)
-
-        g.close()
-        y.close()
-        
-        for i in Data.keys():
-            Data[i] = np.array(Data[i])
-        
-        #print Data.keys()
-        
-        ascii.write([Data[i] for i in header], sm_dir+'/SuprimeCam.ascii',
-                    names=header,overwrite=True)
-        table = Table.read(sm_dir+'/SuprimeCam.ascii', format='ascii')
-        table = np.array(table)
-        fits.writeto(sm_dir+'/SuprimeCam.fits',table)
-    
+def update_sup_data(recheck_all=False):
+    return sync_obslogs('SUP',recheck_all)
+
+
+######################## LECTURE VECTORISÉE DES OBSLOGS ##########################
+
+# Les obslogs de HSC contiennent des centaines de milliers de lignes. Au lieu de
+# créer un SkyCoord et un Time pour chaque observation, on convertit les
+# colonnes entières d'un coup.
+
+# Conversion d'une colonne sexagésimale ("hh:mm:ss.s" ou "dd:mm:ss.s") en
+# degrés. Les valeurs illisibles deviennent NaN au lieu de lever une exception.
+
+def sexagesimal_to_deg(values,hourangle=False):
+
+    s = pd.Series(np.asarray(values)).astype(str).str.strip()
+    parts = s.str.split(r'[:\s]+', n=2, expand=True).reindex(columns=range(3))
+
+    d = pd.to_numeric(parts[0], errors='coerce').values
+    m = pd.to_numeric(parts[1], errors='coerce').fillna(0).values
+    sec = pd.to_numeric(parts[2], errors='coerce').fillna(0).values
+
+    deg = np.abs(d) + m/60. + sec/3600.
+    # Le signe est lu sur la chaîne pour garder les cas "-00:12:34"
+    deg[s.str.startswith('-').values] *= -1
+
+    if hourangle:
+        deg = (deg*15.) % 360.
     else:
-        logging.info("The data is up to date")
+        with np.errstate(invalid='ignore'):
+            deg[np.abs(deg) > 90.] = np.nan
 
+    return deg
 
+# Conversion des colonnes DATE_OBS et UT_STR en jours juliens (UTC), comme
+# Time(DATE_OBS+'T'+UT_STR, format='isot', scale='utc').jd.
 
-############################# SUPRIME-CAM INSTRUMENT #############################
+def obslog_jd(dates,uts):
 
-# -------------------- Cas boîte de recherche sphérique --------------------
+    stamps = pd.to_datetime(pd.Series(np.asarray(dates)).astype(str).str.strip()
+                            + 'T' +
+                            pd.Series(np.asarray(uts)).astype(str).str.strip(),
+                            errors='coerce')
 
-def SuprimeCam_Search(Object,obj_center,Sphere_Radius,FOV,dt_bias,dt_flat,
-                      min_calib,output_directory):
-    
-    # ---------------------- Limites de la boite Recherche ------------
-    RA_min = obj_center[0] - Sphere_Radius
-    RA_max = obj_center[0] + Sphere_Radius
-    DEC_min = obj_center[1] - Sphere_Radius
-    DEC_max = obj_center[1] + Sphere_Radius
+    jd = stamps.values.astype('datetime64[ns]').astype(np.int64)/86400e9
+    jd = jd + 2440587.5 # JD de 1970-01-01T00:00:00
+    jd[stamps.isnull().values] = np.nan
 
-    # ----------- Limites de la boite + FOV
-    RA_min = RA_min - FOV
-    RA_max = RA_max + FOV
-    DEC_min = DEC_min - FOV
-    DEC_max = DEC_max + FOV
-    
-    # Input file
+    return jd
 
-    try:
-        f = open(sm_dir+'/SuprimeCam.txt')
-        f.readline()
-        f.readline()
-        first_line = f.readline()
-        data = first_line.split()
-        y = data[1].split('-')
-        year = int(y[0])
-        f.close()
-        b = 'https://smoka.nao.ac.jp/status/obslog/SUP_{}.txt'.format(year)
-        update_sup_data(b)
-        in_file = fits.open(sm_dir+'/SuprimeCam.fits')
-
-    except Exception as e:
-        logging.info("No SUP entry data")
-        logging.info("Creating or Updating new SUP data entries")
-        b = 'https://smoka.nao.ac.jp/status/obslog/SUP_2014.txt' # On met à une
-                                                               # date antérieur
-        update_sup_data(b)
-        in_file = fits.open(sm_dir+'/SuprimeCam.fits')
-
-    tbdata = in_file[1].data
+
+############################ CATALOGUE LOCAL SMOKA ###############################
+
+# À chaque mise à jour des obslogs, on enregistre un catalogue typé où les
+# coordonnées en degrés, les jours juliens et les types de données sont déjà
+# calculés. Les recherches n'ont plus qu'à charger et filtrer des tableaux.
+
+SMOKA_FILES = {'SUP': 'SuprimeCam', 'HSC': 'HSC'}
+SMOKA_COLUMNS = {'SUP': SUP_COLUMNS, 'HSC': HSC_COLUMNS}
+
+# Codes de la colonne catégorielle TYP_CODE
+SCIENCE_CODE = 0
+BIAS_CODE = 1
+FLAT_CODE = 2
+DARK_CODE = 3
+
+# Catalogues et index déjà chargés, par instrument: (fichiers, données). En
+# mode batch, les cibles traitées en parallèle partagent ces données; _data_lock
+# évite de mettre à jour ou de charger deux fois le même catalogue.
+_catalogs = {}
+_data_lock = threading.RLock()
+_updated = set() # instruments déjà mis à jour pendant ce lancement
+
+def catalog_path(inst):
+    return sm_dir+'/'+SMOKA_FILES[inst]+'_catalog.fits'
+
+# Construction du catalogue à partir des 8 colonnes utiles de l'obslog, dans
+# l'ordre FRAME_ID, DATE_OBS, FILTER, RA2000, DEC2000, UT_STR, EXPTIME, DATA_TYP
+
+def build_smoka_catalog(fields):
+
+    (frame,date,filt,ra,dec,ut,expo,typ) = [
+        np.char.strip(np.asarray(f).astype(str)) for f in fields]
+
+    typ_code = np.zeros(len(typ), dtype=np.int16)
+    typ_code[np.in1d(typ, BIAS_TYPES)] = BIAS_CODE
+    typ_code[np.in1d(typ, FLAT_TYPES)] = FLAT_CODE
+    typ_code[np.in1d(typ, DARK_TYPES)] = DARK_CODE
+
+    filter_names, filter_code = np.unique(filt, return_inverse=True)
+
+    catalog = Table([frame,date,filt,ra,dec,ut,
+                     pd.to_numeric(pd.Series(expo), errors='coerce').values,
+                     typ,
+                     sexagesimal_to_deg(ra, hourangle=True),
+                     sexagesimal_to_deg(dec),
+                     obslog_jd(date,ut),
+                     typ_code,filter_code.astype(np.int16)],
+                    names=['FRAME_ID','DATE_OBS','FILTER','RA2000','DEC2000',
+                           'UT_STR','EXPTIME','DATA_TYP','RA_DEG','DEC_DEG',
+                           'JD','TYP_CODE','FILTER_CODE'])
+
+    return catalog
+
+# Lecture en flux d'une année d'obslog. Les morceaux du corps de la réponse
+# sont découpés en lignes (les lignes d'en-tête contiennent '#') et seules les
+# 8 colonnes utiles sont rangées dans des tableaux typés préalloués, agrandis
+# par doublement. La mémoire ne dépend que du nombre d'observations gardées,
+# pas de la taille du texte.
+
+OBSLOG_CHUNK = 1024*1024 # octets lus à la fois
+
+# Largeur initiale des colonnes texte (élargies si besoin); None pour EXPTIME
+OBSLOG_WIDTHS = [16,10,16,16,16,16,None,16]
+
+def tee_chunks(chunks,f):
+    for chunk in chunks:
+        f.write(chunk)
+        yield chunk
+
+def parse_obslog(chunks,columns,n_max=4096):
+
+    buffers = [np.zeros(n_max, dtype=float) if w is None else
+               np.zeros(n_max, dtype='S%i' % w) for w in OBSLOG_WIDTHS]
+    n = 0
+    n_header = None
+
+    def add_line(line):
+        data = line.split()
+        if n_header is not None:
+            data = data[:n_header]
+        for k, i in enumerate(columns):
+            value = data[i] if i < len(data) else ''
+            b = buffers[k]
+            if b.dtype.kind == 'f':
+                try:
+                    b[n] = float(value)
+                except ValueError:
+                    b[n] = np.nan
+            else:
+                if len(value) > b.dtype.itemsize:
+                    b = buffers[k] = b.astype('S%i' % (2*len(value)))
+                b[n] = value
+
+    rest = ''
+    for chunk in chunks:
+        lines = (rest + chunk).split('\n')
+        rest = lines.pop()
+        for line in lines:
+            if '#' in line:
+                n_header = len(line.split())
+            elif line.strip():
+                if n == n_max:
+                    n_max = 2*n_max
+                    buffers = [np.concatenate([b, np.zeros_like(b)])
+                               for b in buffers]
+                add_line(line)
+                n += 1
+
+    if rest.strip() and not '#' in rest:
+        if n == n_max:
+            buffers = [np.concatenate([b, b[:1]]) for b in buffers]
+        add_line(rest)
+        n += 1
+
+    return [b[:n] for b in buffers]
+
+# Écrit le morceau de catalogue d'une année, à partir des colonnes déjà lues ou
+# du .txt enregistré.
+
+def write_obslog_chunk(inst,year,fields=None):
+
+    if fields is None:
+        with open(obslog_path(inst,year), 'rb') as f:
+            fields = parse_obslog(iter(lambda: f.read(OBSLOG_CHUNK), ''),
+                                  SMOKA_COLUMNS[inst])
+
+    catalog = build_smoka_catalog(fields)
+    catalog.write(chunk_path(inst,year), format='fits', overwrite=True)
+    logging.info("SMOKA catalog written for "+inst+" "+str(year)+" ("
+                 +str(len(catalog))+" observations)")
+
+# Ancienne installation: seul le FITS brut de tous les obslogs existe
+
+def write_smoka_catalog(inst):
+
+    in_file = fits.open(sm_dir+'/'+SMOKA_FILES[inst]+'.fits')
+    data = in_file[1].data
+    catalog = build_smoka_catalog([data.field(i) for i in SMOKA_COLUMNS[inst]])
     in_file.close()
-    
-    # Scientific images inside the search area
-    (bias_frames,bias_dates,bias_filters,
-     bias_ra,bias_dec,bias_ut,bias_t_expo,
-     bias_data_type,bias_jd) = ([] for i in range(9))
-     
-    (flats_frames,flats_dates,flats_filters,
-      flats_ra,flats_dec,flats_ut,flats_t_expo,
-      flats_data_type,flats_jd) = ([] for i in range(9))
-      
-    (frames,dates,filters,ra,dec,ut,exptime,typ,jd) = ([] for i in range(9))
-    t_expo = 0
-      
-      
-    # sys.exit("test 0")
-      
-    for observation in tqdm(tbdata): #[11510:11550]
-        #print observation[7]
-          
-        # Classify bias
-        if (observation[17] == 'BIAS' or observation[17] == 'ZERO'):
-            bias_frames.append(observation[0])
-            bias_dates.append(observation[1])
-            bias_filters.append(observation[4])
-            bias_ra.append(observation[5])
-            bias_dec.append(observation[6])
-            bias_ut.append(observation[14])
-            bias_t_expo.append(observation[15])
-            bias_data_type.append(observation[17])
-            bias_jd.append(Time(observation[1]+'T'+observation[14],
-                                format='isot',scale='utc').jd)
-            # sys.exit("test 1.1")
-        # sys.exit("test 1.2")
-        # print observation[7]
-          
-        # Classify flats
-        if (observation[17] == 'FLAT' or observation[17] == 'DOMEFLAT'
-            or observation[17] == 'SKYFLAT'):
-            flats_frames.append(observation[0])
-            flats_dates.append(observation[1])
-            flats_filters.append(observation[4])
-            flats_ra.append(observation[5])
-            flats_dec.append(observation[6])
-            flats_ut.append(observation[14])
-            flats_t_expo.append(observation[15])
-            flats_data_type.append(observation[17])
-            flats_jd.append(Time(observation[1]+'T'+observation[14],
-                                 format='isot',scale='utc').jd)
-            # sys.exit("test 1.3")
-        # sys.exit("test 1.4")
-          
-        # Search scientific images
-        if (observation[17] != 'FLAT' and observation[17] != 'DOMEFLAT' and
-            observation[17] != 'SKYFLAT' and observation[17] != 'BIAS' and
-            observation[17] != 'ZERO' and observation[17] != 'DARK'):
+
+    catalog.write(catalog_path(inst), format='fits', overwrite=True)
+    logging.info("SMOKA catalog written for "+inst+" ("+str(len(catalog))
+                 +" observations)")
+
+    # L'index du ciel est reconstruit avec le catalogue
+    write_sky_index(inst, catalog)
+
+# Morceaux du catalogue, de l'année la plus récente à la plus ancienne comme
+# dans les obslogs de SMOKA
+
+def catalog_files(inst):
+
+    chunks = glob.glob(obslog_dir(inst)+inst+'_*.fits')
+    if chunks:
+        return sorted(chunks, key=lambda p: int(p[:-5].split('_')[-1]),
+                      reverse=True)
+
+    path = catalog_path(inst)
+    if not os.path.exists(path):
+        write_smoka_catalog(inst)
+    return [path]
+
+def catalog_mtime(inst):
+    return max(os.path.getmtime(p) for p in catalog_files(inst))
+
+# Chargement du catalogue sous forme de dictionnaire de colonnes numpy. Le
+# catalogue est gardé en mémoire tant que ses fichiers n'ont pas changé.
+
+def load_smoka_catalog(inst):
+
+    files = catalog_files(inst)
+    key = tuple((p, os.path.getmtime(p)) for p in files)
+    if inst not in _catalogs or _catalogs[inst][0] != key:
+        parts = [fits.getdata(p, 1) for p in files]
+        catalog = {}
+        for name in parts[0].names:
+            column = np.concatenate([np.asarray(d.field(name)) for d in parts])
+            if column.dtype.kind in 'SU':
+                column = np.char.rstrip(column)
+            catalog[name] = column
+        # Les codes de filtre sont propres à chaque morceau
+        filter_names, filter_code = np.unique(catalog['FILTER'],
+                                              return_inverse=True)
+        catalog['FILTER_CODE'] = filter_code.astype(np.int16)
+        _catalogs[inst] = (key, catalog)
+
+    return _catalogs[inst][1]
+
+# Vérifie s'il existe une nouvelle version des obslogs (une fois par lancement)
+# puis renvoie le catalogue. Sans connexion, on garde les données locales.
+
+def smoka_catalog(inst):
+
+    if inst == 'SUP':
+        update = update_sup_data
+    else:
+        update = update_hsc_data
+
+    with _data_lock:
+        if inst not in _updated:
             try:
-                source_coord = sk(observation[5],observation[6],unit=
-                                  (u.hourangle,u.deg))
-            except:
-                #print('Error: no RA or DEC')
-                continue
-            RA2000 = source_coord.ra.deg
-            DEC2000 = source_coord.dec.deg
-            #print RA2000
-            #print RA_min
-            #print RA_max
-            #sys.exit("test 1.5")
-              
-            if (RA2000 >= RA_min and RA2000 <= RA_max and
-                DEC2000 >= DEC_min and DEC2000 <= DEC_max):
-                frames.append(observation[0])
-                # sys.exit("test 1.6")
-                dates.append(observation[1])
-                filters.append(observation[4])
-                ra.append(observation[5])
-                dec.append(observation[6])
-                ut.append(observation[14])
-                exptime.append(observation[15])
-                typ.append(observation[17])
-                jd.append(Time(observation[1]+'T'+observation[14],
-                               format='isot',scale='utc').jd)
-                print (observation[0],observation[1],observation[4],
-                       observation[15],observation[17])
-                t_expo += float(observation[15])
-                # sys.exit("test 1.7")
-        # sys.exit("test 1.8")
-      
-    # sys.exit("test 2")
+                update()
+            except requests.exceptions.RequestException as e:
+                logging.warning("Could not update "+inst+" data ("+str(e)
+                                +"), using the local data entries")
+            _updated.add(inst)
+
+        return load_smoka_catalog(inst)
+
+# Sélection des images de calibration (BIAS, FLATS, DARKS) par masques booléens
+# sur le catalogue et des images scientifiques trouvées par l'index du ciel
+# (voir sky_box_lookup et sky_cone_lookup). Chaque groupe est renvoyé sous forme
+# de 9 listes: frames, dates, filters, ra, dec, ut, exptime, typ et jd.
+
+def scan_catalog(catalog,science_rows):
+
+    code = catalog['TYP_CODE']
+
+    def select(rows):
+        return tuple(catalog[name][rows].tolist() for name in
+                     ('FRAME_ID','DATE_OBS','FILTER','RA2000','DEC2000',
+                      'UT_STR','EXPTIME','DATA_TYP','JD'))
+
+    return (select(science_rows),select(np.where(code == BIAS_CODE)[0]),
+            select(np.where(code == FLAT_CODE)[0]),
+            select(np.where(code == DARK_CODE)[0]))
+
+
+########################### INDEX DU CIEL (ZONES DEC) ############################
+
+# Pour ne pas parcourir tout le catalogue à chaque cible, les images
+# scientifiques sont rangées par zones de déclinaison de ZONE_HEIGHT degrés,
+# puis triées en RA dans chaque zone. Une recherche ne lit que les zones qui
+# touchent la boîte et, dans chacune, l'intervalle en RA trouvé par dichotomie.
+# L'index est enregistré à côté du catalogue (HSC_index.npz, ...).
+
+ZONE_HEIGHT = 0.5 # degrés
+N_ZONES = int(np.ceil(180./ZONE_HEIGHT)) + 1
+
+_indexes = {} # index déjà chargés, par instrument: (fichier, index)
+
+def index_path(inst):
+    return sm_dir+'/'+SMOKA_FILES[inst]+'_index.npz'
+
+def build_sky_index(catalog):
+
+    ra = np.asarray(catalog['RA_DEG'], dtype=float)
+    dec = np.asarray(catalog['DEC_DEG'], dtype=float)
+    rows = np.where((np.asarray(catalog['TYP_CODE']) == SCIENCE_CODE) &
+                    np.isfinite(ra) & np.isfinite(dec))[0]
+
+    zone = np.floor((dec[rows] + 90.)/ZONE_HEIGHT).astype(int)
+    order = np.lexsort((ra[rows], zone))
+    rows = rows[order]
+    zone = zone[order]
+
+    # starts[z]:starts[z+1] donne les lignes de la zone z
+    starts = np.searchsorted(zone, np.arange(N_ZONES+1))
+
+    return {'rows': rows, 'ra': ra[rows], 'dec': dec[rows], 'starts': starts,
+            'n_catalog': np.array(len(ra))}
+
+def write_sky_index(inst,catalog):
+
+    index = build_sky_index(catalog)
+    np.savez(index_path(inst), **index)
+    logging.info("Sky index written for "+inst+" ("+str(len(index['rows']))
+                 +" scientific observations)")
+
+    return index
+
+# Chargement de l'index du catalogue local. Il est reconstruit s'il manque ou
+# s'il est plus ancien que le catalogue.
+
+def smoka_sky_index(inst):
+
+    with _data_lock:
+        return load_sky_index(inst)
+
+def load_sky_index(inst):
+
+    catalog = load_smoka_catalog(inst)
+    path = index_path(inst)
+    key = (path, catalog_mtime(inst))
+
+    if inst not in _indexes or _indexes[inst][0] != key:
+        index = None
+        if (os.path.exists(path) and
+            os.path.getmtime(path) >= catalog_mtime(inst)):
+            data = np.load(path)
+            index = dict((k, data[k]) for k in data.files)
+            data.close()
+            if int(index['n_catalog']) != len(catalog['JD']):
+                index = None
+        if index is None:
+            index = write_sky_index(inst, catalog)
+        _indexes[inst] = (key, index)
+
+    return _indexes[inst][1]
+
+# Découpe l'intervalle en RA en morceaux compris dans [0, 360[
+
+def ra_intervals(RA_min,RA_max):
+
+    if RA_max - RA_min >= 360.:
+        return [(0., 360.)]
+
+    RA_min = RA_min % 360.
+    RA_max = RA_max % 360.
+    if RA_min <= RA_max:
+        return [(RA_min, RA_max)]
+    return [(RA_min, 360.), (0., RA_max)]
+
+# Positions dans l'index des images scientifiques dont le centre est dans la
+# boîte [RA_min, RA_max] x [DEC_min, DEC_max].
+
+def index_box_positions(index,RA_min,RA_max,DEC_min,DEC_max):
+
+    z0 = max(int(np.floor((DEC_min + 90.)/ZONE_HEIGHT)), 0)
+    z1 = min(int(np.floor((DEC_max + 90.)/ZONE_HEIGHT)), N_ZONES-1)
+
+    found = []
+    for z in range(z0, z1+1):
+        lo = index['starts'][z]
+        hi = index['starts'][z+1]
+        if lo == hi:
+            continue
+        ra = index['ra'][lo:hi]
+        for (a, b) in ra_intervals(RA_min, RA_max):
+            i0 = lo + np.searchsorted(ra, a, side='left')
+            i1 = lo + np.searchsorted(ra, b, side='right')
+            dec = index['dec'][i0:i1]
+            found.append(np.arange(i0, i1)[(dec >= DEC_min) &
+                                           (dec <= DEC_max)])
+
+    if len(found) == 0:
+        return np.array([], dtype=int)
+    return np.concatenate(found)
+
+# Lignes du catalogue (dans l'ordre du catalogue) des images scientifiques dont
+# le centre est dans la boîte de recherche.
+
+def sky_box_lookup(index,RA_min,RA_max,DEC_min,DEC_max):
+
+    pos = index_box_positions(index, RA_min, RA_max, DEC_min, DEC_max)
+
+    return np.sort(index['rows'][pos])
+
+# Lignes du catalogue des images scientifiques à moins de radius degrés de
+# center. On lit d'abord la boîte qui contient le cône, puis on garde la vraie
+# distance angulaire.
+
+def sky_cone_lookup(index,center,radius):
+
+    (ra0, dec0) = (float(center[0]), float(center[1]))
+    DEC_min = max(dec0 - radius, -90.)
+    DEC_max = min(dec0 + radius, 90.)
+
+    cos_dec = np.cos(np.radians(max(abs(DEC_min), abs(DEC_max))))
+    if DEC_min <= -90. or DEC_max >= 90. or radius >= 180.*cos_dec:
+        pos = index_box_positions(index, 0., 360., DEC_min, DEC_max)
+    else:
+        pos = index_box_positions(index, ra0 - radius/cos_dec,
+                                  ra0 + radius/cos_dec, DEC_min, DEC_max)
+
+    # Formule de haversine sur les candidats
+    ra = np.radians(index['ra'][pos])
+    dec = np.radians(index['dec'][pos])
+    h = (np.sin((dec - np.radians(dec0))/2.)**2 +
+         np.cos(dec)*np.cos(np.radians(dec0))*
+         np.sin((ra - np.radians(ra0))/2.)**2)
+    dist = np.degrees(2.*np.arcsin(np.sqrt(np.clip(h, 0., 1.))))
+
+    return np.sort(index['rows'][pos[dist <= radius]])
+
+
+################## ASSOCIATION DES CALIBRATIONS (BIAS, FLATS, DARKS) ##############
+
+# Les calibrations sont triées une seule fois par jour julien (et par filtre pour
+# les flats). Pour chaque nuit scientifique, la fenêtre de tolérance est trouvée
+# par dichotomie puis on avance deux pointeurs à partir de la date pour prendre
+# les calibrations les plus proches. Le coût passe de N_science x N_calib à
+# (N+M) log M. Ce code est commun à Suprime-Cam et à HSC.
+
+SMOKA_DIRS = {'SUP': 'SuprimeCam', 'HSC': 'HyperSuprimeCam'}
+
+# Tri des calibrations: {clé: (lignes triées, jours juliens triés)}
+
+def sorted_calibrations(jd,keys=None):
+
+    jd = np.asarray(jd, dtype=float)
+    if keys is None:
+        keys = [None]*len(jd)
+
+    groups = {}
+    for i, k in enumerate(keys):
+        groups.setdefault(k, []).append(i)
+
+    table = {}
+    for k, rows in groups.items():
+        rows = np.array(rows)
+        rows = rows[np.isfinite(jd[rows])]
+        rows = rows[np.argsort(jd[rows], kind='mergesort')]
+        table[k] = (rows, jd[rows])
+
+    return table
+
+# Les quota calibrations les plus proches de date avec |jd - date| < dt
+
+def nearest_calibrations(table,key,date,dt,quota):
+
+    if key not in table:
+        return []
+    (rows, times) = table[key]
+
+    lo = np.searchsorted(times, date - dt, side='right')
+    hi = np.searchsorted(times, date + dt, side='left')
+    j = np.searchsorted(times, date)
+    i = j - 1
+
+    picked = []
+    while len(picked) < quota and (i >= lo or j < hi):
+        if j >= hi or (i >= lo and date - times[i] <= times[j] - date):
+            picked.append(rows[i])
+            i -= 1
+        else:
+            picked.append(rows[j])
+            j += 1
+
+    return picked
+
+# Association pour toutes les nuits scientifiques. Les poses d'une même nuit
+# (et d'un même filtre pour les flats) partagent leurs calibrations, centrées sur
+# le jour julien médian de la nuit. dt contient les tolérances successives
+# (ex: [5,15]): on cherche d'abord dans la première puis, s'il en manque,
+# jusqu'à la dernière, ce qui revient à prendre les plus proches dans la
+# dernière.
+
+def match_calibrations(jd,dates,keys,table,dt,quota,min_calib,kind):
+
+    if keys is None:
+        keys = [None]*len(jd)
+
+    nights = {}
+    for date, night, key in zip(jd, dates, keys):
+        if np.isfinite(date):
+            nights.setdefault((night, key), []).append(date)
+
+    selected = set()
+    for (night, key) in sorted(nights):
+        date = np.median(nights[(night, key)])
+        picked = nearest_calibrations(table, key, date, max(dt), quota)
+        if len(picked) < min_calib:
+            logging.warning('Only %i %s around the night of the %s.' %
+                            (len(picked), kind, night))
+        selected.update(picked)
+
+    return sorted(selected)
+
+# Association des calibrations puis écriture des mails de requête et de la liste
+# des images pour un instrument ('SUP' ou 'HSC'). Pour Suprime-Cam, darks et
+# dt_dark valent None. Renvoie la liste des images demandées.
+
+def smoka_request(Object,inst,science,bias,flats,darks,dt_bias,dt_flat,dt_dark,
+                  min_calib,output_directory):
+
+    (frames,dates,filters,ra,dec,ut,exptime,typ,jd) = science
+    t_expo = np.sum(np.array(exptime,dtype=float))
     logging.info('%i scientific images with a total exp time of %.1f\n'
-                   %(len(frames),t_expo))
-                           
-    # Save output search of scientific images
-    out_frames = frames[:]
-    out_dates = dates[:]
-    out_filters = filters[:]
-    out_ra = ra[:]
-    out_dec = dec[:]
-    out_ut = ut[:]
-    out_exptime = exptime[:]
-    out_typ = typ[:]
-                           
+                 %(len(frames),t_expo))
+
+    # On garde au plus min_calib+1 calibrations par nuit, les plus proches
+    quota = min_calib + 1
+
     # Search calibrations for each date
-    old_date = 'first_date'
-    old_filter = 'first_filter'
-    logging.info("Searching BIAS, FLATS in SUP")
-    for date in tqdm(jd):
-        # Search BIAS
-        if (date != old_date):
-            for it in range(2):
-                n_bias = 0
-                for index, value in (enumerate(bias_jd)):
-                    if (abs(value - date) < dt_bias[it]):
-                        out_frames.append(bias_frames[index])
-                        out_dates.append(bias_dates[index])
-                        out_filters.append(bias_filters[index])
-                        out_ra.append(bias_ra[index])
-                        out_dec.append(bias_dec[index])
-                        out_ut.append(bias_ut[index])
-                        out_exptime.append(bias_t_expo[index])
-                        out_typ.append(bias_data_type[index])
-                        n_bias += 1
-                    if (n_bias > min_calib):
-                        break
-                if (n_bias < min_calib):
-                    logging.warning('''Only %i bias around the night of the %s.'''
-                                    %(n_bias,dates[jd.index(date)]))
-                               
-        # Search FLATS
-        if (date != old_date or filters[dates.index(date)] != old_filter):
-            for it in range(2):
-                n_flats = 0
-                for index, value in enumerate(flats_jd):
-                    if (flats_filters[index] == filters[jd.index(date)] and
-                        abs(value - date) < dt_flat[0]):
-                        out_frames.append(flats_frames[index])
-                        out_dates.append(flats_dates[index])
-                        out_filters.append(flats_filters[index])
-                        out_ra.append(flats_ra[index])
-                        out_dec.append(flats_dec[index])
-                        out_ut.append(flats_ut[index])
-                        out_exptime.append(flats_t_expo[index])
-                        out_typ.append(flats_data_type[index])
-                        n_flats += 1
-                    if (n_flats > min_calib):
-                        break
-                if (n_bias < min_calib):
-                    logging.warning('Only %i flats around the night of the %s.' %
-                                    (n_flats,dates[jd.index(date)]))
-                               
-        old_date = date
-                           
+    if darks is None:
+        logging.info("Searching BIAS, FLATS in "+inst)
+    else:
+        logging.info("Searching BIAS, FLATS & DARKS in "+inst)
+
+    selected = []
+    selected.append((bias, match_calibrations(jd,dates,None,
+                                              sorted_calibrations(bias[8]),
+                                              dt_bias,quota,min_calib,'bias')))
+    selected.append((flats, match_calibrations(jd,dates,filters,
+                                               sorted_calibrations(flats[8],
+                                                                   flats[2]),
+                                               dt_flat,quota,min_calib,
+                                               'flats')))
+    if darks is not None:
+        selected.append((darks, match_calibrations(jd,dates,None,
+                                                   sorted_calibrations(darks[8]),
+                                                   dt_dark,quota,min_calib,
+                                                   'darks')))
+
+    # Save output search of scientific images and calibrations
+    out = [list(column) for column in science[:8]]
+    for group, rows in selected:
+        for column, values in zip(out, group):
+            column.extend([values[i] for i in rows])
+
     # Remove duplicated files
-    out_frames_unique, indices = np.unique(out_frames, return_index=True)
-    out_frames = [out_frames[i] for i in indices]
-    out_dates = [out_dates[i] for i in indices]
-    out_filters = [out_filters[i] for i in indices]
-    out_ra = [out_ra[i] for i in indices]
-    out_dec = [out_dec[i] for i in indices]
-    out_ut = [out_ut[i] for i in indices]
-    out_exptime = [out_exptime[i] for i in indices]
-    out_typ = [out_typ[i] for i in indices]
-                           
+    out_frames_unique, indices = np.unique(out[0], return_index=True)
+    (out_frames,out_dates,out_filters,out_ra,out_dec,out_ut,out_exptime,
+     out_typ) = [[column[i] for i in indices] for column in out]
+
     n_bias_tot = out_typ.count('BIAS') + out_typ.count('ZERO')
     n_flats_tot = (out_typ.count('FLAT') + out_typ.count('DOMEFLAT')
                    + out_typ.count('SKYFLAT'))
-                           
-  
+
     logging.info('Total number of images BIAS = %i \n' %(n_bias_tot))
     logging.info('Total number of images FLATS = %i \n' %(n_flats_tot))
-    logging.info('Total number of images (scientific + BIAS + FLATS) = %i \n' %
-                   (len(out_frames)))
-                                          
+    if darks is None:
+        logging.info('Total number of images (scientific + BIAS + FLATS) = %i \n'
+                     %(len(out_frames)))
+    else:
+        n_darks_tot = out_typ.count('DARK')
+        logging.info('Total number of images DARKS = %i \n' %(n_darks_tot))
+        logging.info('''Total number of images (scientific + BIAS + FLATS + DARKS)
+                 = %i \n''' %(len(out_frames)))
+
     # Output file
-    logging.info("Writing mail for SUP instrument")
+    out_dir = output_directory+'/'+SMOKA_DIRS[inst]+'/'
+    logging.info("Writing mail for "+inst+" instrument")
     N_max = 1000 #Maximum number of images per mail
     a = 0
     b = N_max
     k = 1
     bool = True
     while bool == True:
-        if not os.path.exists(output_directory+'/SuprimeCam/'):
-            os.makedirs(output_directory+'/SuprimeCam/')
+        if not os.path.exists(out_dir):
+            os.makedirs(out_dir)
 
-        out_file = open(output_directory+'/SuprimeCam/'+Object+'_SUP_mail_'
-                        +str(k)+'.txt', 'w')
+        out_file = open(out_dir+Object+'_'+inst+'_mail_'+str(k)+'.txt', 'w')
         out_file.write('SMOKAID \t \n \n')
         out_file.write('PURPOSE \t Research(star formation)\n \n')
         ascii.write([out_frames[a:b],out_dates[a:b]], out_file,
@@ -553,17 +897,39 @@ def SuprimeCam_Search(Object,obj_center,Sphere_Radius,FOV,dt_bias,dt_flat,
             k += 1
         else:
             bool = False
-                                          
+
     # Output file
-    list_file = open(output_directory+'/SuprimeCam/'+Object+
-                     '_SUP_list.txt', 'w')
+    list_file = open(out_dir+Object+'_'+inst+'_list.txt', 'w')
     ascii.write([out_frames,out_dates,out_filters,out_ra,out_dec,out_ut,
-                 out_exptime,out_typ],list_file,names=
-                ['#FRAME_ID', 'DATE_OBS', 'FILTER', 'RA2000', 'DEC2000',
-                 'UT_STR', 'EXPTIME', 'DATA_TYP'])
+                 out_exptime,out_typ],list_file,
+                names=['#FRAME_ID', 'DATE_OBS', 'FILTER', 'RA2000', 'DEC2000',
+                       'UT_STR', 'EXPTIME', 'DATA_TYP'])
     list_file.close()
 
-    return
+    return out_frames
+
+
+############################# SUPRIME-CAM INSTRUMENT #############################
+
+# -------------------- Cas boîte de recherche sphérique --------------------
+
+def SuprimeCam_Search(Object,obj_center,Sphere_Radius,FOV,dt_bias,dt_flat,
+                      min_calib,output_directory):
+    
+    # Catalogue local (mis à jour si une nouvelle version existe)
+    catalog = smoka_catalog('SUP')
+
+    # Images scientifiques trouvées par l'index du ciel
+    index = smoka_sky_index('SUP')
+    rows = sky_cone_lookup(index,obj_center,Sphere_Radius+FOV)
+
+    # Classement des observations en une seule passe sur les colonnes du
+    # catalogue.
+    (science,bias,flats,darks) = scan_catalog(catalog,rows)
+
+    # Association des calibrations et écriture des mails
+    return smoka_request(Object,'SUP',science,bias,flats,None,dt_bias,
+                         dt_flat,None,min_calib,output_directory)
 
 # --------------------- Cas boîte de recherche rectangulaire ----------------
 
@@ -582,238 +948,20 @@ def SuprimeCam_Search_2(Object,obj_center,Ra_box,DEC_box,FOV,dt_bias,dt_flat,
     DEC_min = DEC_min - FOV
     DEC_max = DEC_max + FOV
     
-    # Input file
-    
-    try:
-        f = open(sm_dir+'/SuprimeCam.txt')
-        f.readline()
-        f.readline()
-        first_line = f.readline()
-        data = first_line.split()
-        y = data[1].split('-')
-        year = int(y[0])
-        f.close()
-        b = 'https://smoka.nao.ac.jp/status/obslog/SUP_{}.txt'.format(year)
-        update_sup_data(b)
-        in_file = fits.open(sm_dir+'/SuprimeCam.fits')
-    
-    except Exception as e:
-        logging.info("No SUP entry data")
-        logging.info("Creating or Updating new SUP data entries")
-        b = 'https://smoka.nao.ac.jp/status/obslog/SUP_2014.txt' # On met à une
-                                                               # date antérieur
-        update_sup_data(b)
-        in_file = fits.open(sm_dir+'/SuprimeCam.fits')
-    
-    tbdata = in_file[1].data
-    in_file.close()
-    
-    # Scientific images inside the search area
-    (bias_frames,bias_dates,bias_filters,
-     bias_ra,bias_dec,bias_ut,bias_t_expo,
-     bias_data_type,bias_jd) = ([] for i in range(9))
-     
-    (flats_frames,flats_dates,flats_filters,
-     flats_ra,flats_dec,flats_ut,flats_t_expo,
-     flats_data_type,flats_jd) = ([] for i in range(9))
-      
-    (frames,dates,filters,ra,dec,ut,exptime,typ,jd) = ([] for i in range(9))
-    t_expo = 0
-      
-      
-    # sys.exit("test 0")
-      
-    for observation in tqdm(tbdata): #[11510:11550]
-        #print observation[7]
-          
-        # Classify bias
-        if (observation[17] == 'BIAS' or observation[17] == 'ZERO'):
-            bias_frames.append(observation[0])
-            bias_dates.append(observation[1])
-            bias_filters.append(observation[4])
-            bias_ra.append(observation[5])
-            bias_dec.append(observation[6])
-            bias_ut.append(observation[14])
-            bias_t_expo.append(observation[15])
-            bias_data_type.append(observation[17])
-            bias_jd.append(Time(observation[1]+'T'+observation[14],
-                                format='isot', scale='utc').jd)
-            # sys.exit("test 1.1")
-        # sys.exit("test 1.2")
-        # print observation[7]
-          
-        # Classify flats
-        if (observation[17] == 'FLAT' or observation[17] == 'DOMEFLAT'
-            or observation[17] == 'SKYFLAT'):
-            flats_frames.append(observation[0])
-            flats_dates.append(observation[1])
-            flats_filters.append(observation[4])
-            flats_ra.append(observation[5])
-            flats_dec.append(observation[6])
-            flats_ut.append(observation[14])
-            flats_t_expo.append(observation[15])
-            flats_data_type.append(observation[17])
-            flats_jd.append(Time(observation[1]+'T'+observation[14],
-                                   format='isot',scale='utc').jd)
-            # sys.exit("test 1.3")
-        # sys.exit("test 1.4")
-          
-        # Search scientific images
-        if (observation[17] != 'FLAT' and observation[17] != 'DOMEFLAT' and
-            observation[17] != 'SKYFLAT' and observation[17] != 'BIAS' and
-            observation[17] != 'ZERO' and observation[17] != 'DARK'):
-            try:
-                source_coord = sk(observation[5],observation[6],
-                                  unit=(u.hourangle,u.deg))
-            except:
-                #print('Error: no RA or DEC')
-                continue
-            RA2000 = source_coord.ra.deg
-            DEC2000 = source_coord.dec.deg
-            #print RA2000
-            #print RA_min
-            #print RA_max
-            #sys.exit("test 1.5")
-              
-            if (RA2000 >= RA_min and RA2000 <= RA_max and
-                DEC2000 >= DEC_min and DEC2000 <= DEC_max):
-                frames.append(observation[0])
-                # sys.exit("test 1.6")
-                dates.append(observation[1])
-                filters.append(observation[4])
-                ra.append(observation[5])
-                dec.append(observation[6])
-                ut.append(observation[14])
-                exptime.append(observation[15])
-                typ.append(observation[17])
-                jd.append(Time(observation[1]+'T'+observation[14],
-                               format='isot',scale='utc').jd)
-                print (observation[0],observation[1],observation[4],
-                       observation[15],observation[17])
-                t_expo += float(observation[15])
-                # sys.exit("test 1.7")
-            # sys.exit("test 1.8")
-
-    # sys.exit("test 2")
-    logging.info('%i scientific images with a total exp time of %.1f\n'
-                   %(len(frames),t_expo))
-                   
-    # Save output search of scientific images
-    out_frames = frames[:]
-    out_dates = dates[:]
-    out_filters = filters[:]
-    out_ra = ra[:]
-    out_dec = dec[:]
-    out_ut = ut[:]
-    out_exptime = exptime[:]
-    out_typ = typ[:]
-                   
-    # Search calibrations for each date
-    old_date = 'first_date'
-    old_filter = 'first_filter'
-    logging.info("Searching BIAS, FLATS in SUP")
-    for date in tqdm(jd):
-        # Search BIAS
-        if (date != old_date):
-            for it in range(2):
-                n_bias = 0
-                for index, value in (enumerate(bias_jd)):
-                    if (abs(value - date) < dt_bias[it]):
-                        out_frames.append(bias_frames[index])
-                        out_dates.append(bias_dates[index])
-                        out_filters.append(bias_filters[index])
-                        out_ra.append(bias_ra[index])
-                        out_dec.append(bias_dec[index])
-                        out_ut.append(bias_ut[index])
-                        out_exptime.append(bias_t_expo[index])
-                        out_typ.append(bias_data_type[index])
-                        n_bias += 1
-                    if (n_bias > min_calib):
-                        break
-                if (n_bias < min_calib):
-                    logging.warning('''Only %i bias around the night of the %s.'''
-                                    %(n_bias,dates[jd.index(date)]))
-                       
-        # Search FLATS
-        if (date != old_date or filters[dates.index(date)] != old_filter):
-            for it in range(2):
-                n_flats = 0
-                for index, value in enumerate(flats_jd):
-                    if (flats_filters[index] == filters[jd.index(date)] and
-                        abs(value - date) < dt_flat[0]):
-                        out_frames.append(flats_frames[index])
-                        out_dates.append(flats_dates[index])
-                        out_filters.append(flats_filters[index])
-                        out_ra.append(flats_ra[index])
-                        out_dec.append(flats_dec[index])
-                        out_ut.append(flats_ut[index])
-                        out_exptime.append(flats_t_expo[index])
-                        out_typ.append(flats_data_type[index])
-                        n_flats += 1
-                    if (n_flats > min_calib):
-                        break
-                if (n_bias < min_calib):
-                    logging.warning('Only %i flats around the night of the %s.' %
-                                    (n_flats,dates[jd.index(date)]))
-                       
-        old_date = date
-                   
-    # Remove duplicated files
-    out_frames_unique, indices = np.unique(out_frames, return_index=True)
-    out_frames = [out_frames[i] for i in indices]
-    out_dates = [out_dates[i] for i in indices]
-    out_filters = [out_filters[i] for i in indices]
-    out_ra = [out_ra[i] for i in indices]
-    out_dec = [out_dec[i] for i in indices]
-    out_ut = [out_ut[i] for i in indices]
-    out_exptime = [out_exptime[i] for i in indices]
-    out_typ = [out_typ[i] for i in indices]
-                   
-    n_bias_tot = out_typ.count('BIAS') + out_typ.count('ZERO')
-    n_flats_tot = (out_typ.count('FLAT') + out_typ.count('DOMEFLAT')
-                   + out_typ.count('SKYFLAT'))
-                                  
-                                  
-    logging.info('Total number of images BIAS = %i \n' %(n_bias_tot))
-    logging.info('Total number of images FLATS = %i \n' %(n_flats_tot))
-    logging.info('Total number of images (scientific + BIAS + FLATS) = %i \n' %
-                 (len(out_frames)))
-                                               
-    # Output file
-    logging.info("Writing mail for SUP instrument")
-    N_max = 1000 #Maximum number of images per mail
-    a = 0
-    b = N_max
-    k = 1
-    bool = True
-    while bool == True:
-        if not os.path.exists(output_directory+'/SuprimeCam/'):
-            os.makedirs(output_directory+'/SuprimeCam/')
-                                                   
-        out_file = open(output_directory+'/SuprimeCam/'+Object+'_SUP_mail_'
-                        +str(k)+'.txt', 'w')
-        out_file.write('SMOKAID \t \n \n')
-        out_file.write('PURPOSE \t Research(star formation)\n \n')
-        ascii.write([out_frames[a:b],out_dates[a:b]], out_file,
-                    names=['#FRAME_ID', 'DATE_OBS'])
-        out_file.close()
-        if len(out_frames) > b:
-            a += N_max
-            b += N_max
-            k += 1
-        else:
-            bool = False
-                                               
-    # Output file
-    list_file = open(output_directory+'/SuprimeCam/'+Object+'_SUP_list.txt',
-                     'w')
-    ascii.write([out_frames,out_dates,out_filters,out_ra,out_dec,
-                 out_ut,out_exptime,out_typ],list_file,
-                names=['#FRAME_ID', 'DATE_OBS', 'FILTER', 'RA2000', 'DEC2000',
-                       'UT_STR', 'EXPTIME', 'DATA_TYP'])
-    list_file.close()
-                                                                             
-    return
+    # Catalogue local (mis à jour si une nouvelle version existe)
+    catalog = smoka_catalog('SUP')
+
+    # Images scientifiques trouvées par l'index du ciel
+    index = smoka_sky_index('SUP')
+    rows = sky_box_lookup(index,RA_min,RA_max,DEC_min,DEC_max)
+
+    # Classement des observations en une seule passe sur les colonnes du
+    # catalogue.
+    (science,bias,flats,darks) = scan_catalog(catalog,rows)
+
+    # Association des calibrations et écriture des mails
+    return smoka_request(Object,'SUP',science,bias,flats,None,dt_bias,
+                         dt_flat,None,min_calib,output_directory)
 
 
 ########################## HYPER SUPRIME-CAM INSTRUMENT ##########################
@@ -823,273 +971,20 @@ def SuprimeCam_Search_2(Object,obj_center,Ra_box,DEC_box,FOV,dt_bias,dt_flat,
 def HyperSuprimeCam_Search(Object,obj_center,Sphere_Radius,FOV,dt_bias,dt_flat,
                            dt_dark,min_calib,output_directory):
     
-    # ---------------------- Limites de la boite Recherche ------------
-    RA_min = obj_center[0] - Sphere_Radius
-    RA_max = obj_center[0] + Sphere_Radius
-    DEC_min = obj_center[1] - Sphere_Radius
-    DEC_max = obj_center[1] + Sphere_Radius
-   
-    # ----------- Limites de la boite + FOV
-    RA_min = RA_min - FOV
-    RA_max = RA_max + FOV
-    DEC_min = DEC_min - FOV
-    DEC_max = DEC_max + FOV
-    
-    # Input file
-    try:
-        f = open(sm_dir+'/HSC.txt')
-        f.readline()
-        f.readline()
-        first_line = f.readline()
-        data = first_line.split()
-        y = data[1].split('-')
-        year = int(y[0])
-        f.close()
-        b = 'https://smoka.nao.ac.jp/status/obslog/HSC_{}.txt'.format(year)
-        update_hsc_data(b)
-        in_file = fits.open(sm_dir+'/HSC.fits')
-
-    except Exception as e:
-        logging.info("No HSC entry data")
-        logging.info("Creating or Updating new HSC data entries")
-        b = 'https://smoka.nao.ac.jp/status/obslog/HSC_2014.txt' # On met à une
-                                                             # date antérieur
-        update_hsc_data(b)
-        in_file = fits.open(sm_dir+'/HSC.fits')
-
-
-    tbdata = in_file[1].data
-    in_file.close()
-    
-    # Scientific images inside the search area
-    (bias_frames,bias_dates,bias_filters,
-     bias_ra,bias_dec,bias_ut,bias_t_expo,
-     bias_data_type,bias_jd) = ([] for i in range(9))
-     
-    (flats_frames,flats_dates,flats_filters,
-     flats_ra,flats_dec,flats_ut,flats_t_expo,
-     flats_data_type,flats_jd) = ([] for i in range(9))
-      
-    (dark_frames,dark_dates,dark_filters,
-     dark_ra,dark_dec,dark_ut,dark_t_expo,
-     dark_data_type,dark_jd) = ([] for i in range(9))
-       
-    (frames,dates,filters,ra,dec,ut,exptime,typ,jd) = ([] for i in range(9))
-    t_expo = 0
-       
-    for observation in tqdm(tbdata): #
-           
-        # Classify bias
-        if (observation[16] == 'BIAS' or observation[16] == 'ZERO'):
-            bias_frames.append(observation[0])
-            bias_dates.append(observation[1])
-            bias_filters.append(observation[3])
-            bias_ra.append(observation[4])
-            bias_dec.append(observation[5])
-            bias_ut.append(observation[13])
-            bias_t_expo.append(observation[14])
-            bias_data_type.append(observation[16])
-            bias_jd.append(Time(observation[1]+'T'+observation[13],
-                                format='isot',scale='utc').jd)
-           
-        # Classify flats
-        if (observation[16] == 'FLAT' or observation[16] == 'DOMEFLAT'
-            or observation[16] == 'SKYFLAT'):
-            flats_frames.append(observation[0])
-            flats_dates.append(observation[1])
-            flats_filters.append(observation[3])
-            flats_ra.append(observation[4])
-            flats_dec.append(observation[5])
-            flats_ut.append(observation[13])
-            flats_t_expo.append(observation[14])
-            flats_data_type.append(observation[16])
-            flats_jd.append(Time(observation[1]+'T'+observation[13],
-                                    format='isot', scale='utc').jd)
-           
-        # Classify darks
-        if (observation[16] == 'DARK'):
-            dark_frames.append(observation[0])
-            dark_dates.append(observation[1])
-            dark_filters.append(observation[3])
-            dark_ra.append(observation[4])
-            dark_dec.append(observation[5])
-            dark_ut.append(observation[13])
-            dark_t_expo.append(observation[14])
-            dark_data_type.append(observation[16])
-            dark_jd.append(Time(observation[1]+'T'+observation[13],
-                                   format='isot', scale='utc').jd)
-           
-        # Search scientific images
-        if (observation[16] != 'FLAT' and observation[16] != 'DOMEFLAT' and
-            observation[16] != 'SKYFLAT' and observation[16] != 'BIAS' and
-            observation[16] != 'ZERO' and observation[16] != 'DARK'):
-            try:
-                source_coord = sk(observation[4],observation[5],
-                                  unit=(u.hourangle,u.deg))
-            except:
-                #print('Error: no RA or DEC')
-                continue
-            RA2000 = source_coord.ra.deg
-            DEC2000 = source_coord.dec.deg
-               
-            if (RA2000 >= RA_min and RA2000 <= RA_max and
-                DEC2000 >= DEC_min and DEC2000 <= DEC_max):
-                frames.append(observation[0])
-                dates.append(observation[1])
-                filters.append(observation[3])
-                ra.append(observation[4])
-                dec.append(observation[5])
-                ut.append(observation[13])
-                exptime.append(observation[14])
-                typ.append(observation[16])
-                jd.append(Time(observation[1]+'T'+observation[13],
-                               format='isot',scale='utc').jd)
-                print (observation[0],observation[1],observation[3],
-                       observation[14],observation[16])
-                t_expo += observation[14]
-       
-   
-    logging.info('%i scientific images with a total exp time of %.1f\n' %
-                 (len(frames),t_expo))
-                            
-    # Save output search of scientific images
-    out_frames = frames[:]
-    out_dates = dates[:]
-    out_filters = filters[:]
-    out_ra = ra[:]
-    out_dec = dec[:]
-    out_ut = ut[:]
-    out_exptime = exptime[:]
-    out_typ = typ[:]
-                            
-    # Search calibrations for each date
-    old_date = 'first_date'
-    old_filter = 'first_filter'
-    logging.info("Searching BIAS, FLATS & DARKS in HSC")
-    for date in tqdm(jd):
-        # Search BIAS
-        if (date != old_date):
-            for it in range(2):
-                n_bias = 0
-                for index, value in enumerate(bias_jd):
-                    if (abs(value - date) < dt_bias[it]):
-                        out_frames.append(bias_frames[index])
-                        out_dates.append(bias_dates[index])
-                        out_filters.append(bias_filters[index])
-                        out_ra.append(bias_ra[index])
-                        out_dec.append(bias_dec[index])
-                        out_ut.append(bias_ut[index])
-                        out_exptime.append(bias_t_expo[index])
-                        out_typ.append(bias_data_type[index])
-                        n_bias += 1
-                    if (n_bias > min_calib):
-                        break
-                if(n_bias < min_calib):
-                    logging.warning('Only %i bias around the night of the %s.'%
-                                    (n_bias,dates[jd.index(date)]))
-                                
-        # Search FLATS
-        if (date != old_date or filters[dates.index(date)] != old_filter):
-            for it in range(2):
-                n_flats = 0
-                for index, value in enumerate(flats_jd):
-                    if (flats_filters[index] == filters[jd.index(date)]
-                        and abs(value - date) < dt_flat[0]):
-                        out_frames.append(flats_frames[index])
-                        out_dates.append(flats_dates[index])
-                        out_filters.append(flats_filters[index])
-                        out_ra.append(flats_ra[index])
-                        out_dec.append(flats_dec[index])
-                        out_ut.append(flats_ut[index])
-                        out_exptime.append(flats_t_expo[index])
-                        out_typ.append(flats_data_type[index])
-                        n_flats += 1
-                    if (n_flats > min_calib):
-                        break
-                if (n_bias < min_calib):
-                    logging.warning('Only %i flats around the night of the %s.'%
-                                    (n_flats,dates[jd.index(date)]))
-                                
-        # Search DARKS
-        if (date != old_date):
-            for it in range(2):
-                n_dark = 0
-                for index, value in enumerate(dark_jd):
-                    if (abs(value - date) < dt_dark[it]):
-                        out_frames.append(dark_frames[index])
-                        out_dates.append(dark_dates[index])
-                        out_filters.append(dark_filters[index])
-                        out_ra.append(dark_ra[index])
-                        out_dec.append(dark_dec[index])
-                        out_ut.append(dark_ut[index])
-                        out_exptime.append(dark_t_expo[index])
-                        out_typ.append(dark_data_type[index])
-                        n_dark += 1
-                    if (n_dark > min_calib):
-                        break
-                if (n_dark < min_calib):
-                    logging.warning('Only %i darks around the night of the %s.' %
-                                    (n_dark,dates[jd.index(date)]))
-                                
-        old_date = date
-                            
-    # Remove duplicated files
-    out_frames_unique, indices = np.unique(out_frames, return_index=True)
-    out_frames = [out_frames[i] for i in indices]
-    out_dates = [out_dates[i] for i in indices]
-    out_filters = [out_filters[i] for i in indices]
-    out_ra = [out_ra[i] for i in indices]
-    out_dec = [out_dec[i] for i in indices]
-    out_ut = [out_ut[i] for i in indices]
-    out_exptime = [out_exptime[i] for i in indices]
-    out_typ = [out_typ[i] for i in indices]
-                            
-    n_bias_tot = out_typ.count('BIAS') + out_typ.count('ZERO')
-    n_flats_tot = (out_typ.count('FLAT') + out_typ.count('DOMEFLAT')
-                   + out_typ.count('SKYFLAT'))
-    n_darks_tot = out_typ.count('DARK')
-                            
-    logging.info('Total number of images BIAS = %i \n' %(n_bias_tot))
-    logging.info('Total number of images FLATS = %i \n' %(n_flats_tot))
-    logging.info('Total number of images DARKS = %i \n' %(n_darks_tot))
-    logging.info('''Total number of images (scientific + BIAS + FLATS + DARKS)
-                 = %i \n''' %(len(out_frames)))
-                                  
-    # Output file
-    logging.info("Writing mail for HSC instrument")
-    N_max = 1000 #Maximum number of images per mail
-    a = 0
-    b = N_max
-    k = 1
-    bool = True
-    while bool == True:
-        if not os.path.exists(output_directory+'/HyperSuprimeCam/'):
-            os.makedirs(output_directory+'/HyperSuprimeCam/')
+    # Catalogue local (mis à jour si une nouvelle version existe)
+    catalog = smoka_catalog('HSC')
 
-        out_file = open(output_directory+'/HyperSuprimeCam/'+Object+
-                        '_HSC_mail_'+str(k)+'.txt', 'w')
-        out_file.write('SMOKAID \t \n \n')
-        out_file.write('PURPOSE \t Research(star formation)\n \n')
-        ascii.write([out_frames[a:b],out_dates[a:b]], out_file,
-                    names=['#FRAME_ID', 'DATE_OBS'])
-        out_file.close()
-        if len(out_frames) > b:
-            a += N_max
-            b += N_max
-            k += 1
-        else:
-            bool = False
-                                  
-    # Output file
-    list_file = open(output_directory+'/HyperSuprimeCam/'+Object+
-                     '_HSC_list.txt', 'w')
-    ascii.write([out_frames,out_dates,out_filters,out_ra,out_dec,out_ut,
-                out_exptime,out_typ],list_file, names=
-                ['#FRAME_ID', 'DATE_OBS', 'FILTER', 'RA2000', 'DEC2000',
-                 'UT_STR', 'EXPTIME', 'DATA_TYP'])
-    list_file.close()
+    # Images scientifiques trouvées par l'index du ciel
+    index = smoka_sky_index('HSC')
+    rows = sky_cone_lookup(index,obj_center,Sphere_Radius+FOV)
 
-    return
+    # Classement des observations en une seule passe sur les colonnes du
+    # catalogue.
+    (science,bias,flats,darks) = scan_catalog(catalog,rows)
+
+    # Association des calibrations et écriture des mails
+    return smoka_request(Object,'HSC',science,bias,flats,darks,dt_bias,
+                         dt_flat,dt_dark,min_calib,output_directory)
 
 # ---------------------- Cas Rectangular search box ---------------------
 
@@ -1108,261 +1003,20 @@ def HyperSuprimeCam_Search_2(Object,obj_center,Ra_box,DEC_box,FOV,dt_bias,
     DEC_min = DEC_min - FOV
     DEC_max = DEC_max + FOV
     
-    # Input file
-    try:
-        f = open(sm_dir+'/HSC.txt')
-        f.readline()
-        f.readline()
-        first_line = f.readline()
-        data = first_line.split()
-        y = data[1].split('-')
-        year = int(y[0])
-        f.close()
-        b = 'https://smoka.nao.ac.jp/status/obslog/HSC_{}.txt'.format(year)
-        update_hsc_data(b)
-        in_file = fits.open(sm_dir+'/HSC.fits')
-    
-    except Exception as e:
-        logging.info("No HSC entry data")
-        logging.info("Creating or Updating new HSC data entries")
-        b = 'https://smoka.nao.ac.jp/status/obslog/HSC_2014.txt' # On met à une
-                                                               # date antérieur
-        update_hsc_data(b)
-        in_file = fits.open(sm_dir+'/HSC.fits')
-    
-    
-    tbdata = in_file[1].data
-    in_file.close()
-    
-    # Scientific images inside the search area
-    (bias_frames,bias_dates,bias_filters,
-     bias_ra,bias_dec,bias_ut,bias_t_expo,
-     bias_data_type,bias_jd) = ([] for i in range(9))
-     
-    (flats_frames,flats_dates,flats_filters,
-     flats_ra,flats_dec,flats_ut,flats_t_expo,
-     flats_data_type,flats_jd) = ([] for i in range(9))
-      
-    (dark_frames,dark_dates,dark_filters,
-     dark_ra,dark_dec,dark_ut,dark_t_expo,
-     dark_data_type,dark_jd) = ([] for i in range(9))
-       
-    (frames,dates,filters,ra,dec,ut,exptime,typ,jd) = ([] for i in range(9))
-    t_expo = 0
-       
-    for observation in tqdm(tbdata): #
-           
-        # Classify bias
-        if (observation[16] == 'BIAS' or observation[16] == 'ZERO'):
-            bias_frames.append(observation[0])
-            bias_dates.append(observation[1])
-            bias_filters.append(observation[3])
-            bias_ra.append(observation[4])
-            bias_dec.append(observation[5])
-            bias_ut.append(observation[13])
-            bias_t_expo.append(observation[14])
-            bias_data_type.append(observation[16])
-            bias_jd.append(Time(observation[1]+'T'+observation[13],
-                                format='isot',scale='utc').jd)
-           
-        # Classify flats
-        if (observation[16] == 'FLAT' or observation[16] == 'DOMEFLAT'
-            or observation[16] == 'SKYFLAT'):
-            flats_frames.append(observation[0])
-            flats_dates.append(observation[1])
-            flats_filters.append(observation[3])
-            flats_ra.append(observation[4])
-            flats_dec.append(observation[5])
-            flats_ut.append(observation[13])
-            flats_t_expo.append(observation[14])
-            flats_data_type.append(observation[16])
-            flats_jd.append(Time(observation[1]+'T'+observation[13],
-                                 format='isot',scale='utc').jd)
-           
-        # Classify darks
-        if (observation[16] == 'DARK'):
-            dark_frames.append(observation[0])
-            dark_dates.append(observation[1])
-            dark_filters.append(observation[3])
-            dark_ra.append(observation[4])
-            dark_dec.append(observation[5])
-            dark_ut.append(observation[13])
-            dark_t_expo.append(observation[14])
-            dark_data_type.append(observation[16])
-            dark_jd.append(Time(observation[1]+'T'+observation[13],
-                                format='isot',scale='utc').jd)
-           
-        # Search scientific images
-        if (observation[16] != 'FLAT' and observation[16] != 'DOMEFLAT' and
-            observation[16] != 'SKYFLAT' and observation[16] != 'BIAS' and
-            observation[16] != 'ZERO' and observation[16] != 'DARK'):
-            try:
-                source_coord = sk(observation[4],observation[5],
-                                  unit=(u.hourangle,u.deg))
-            except:
-                #print('Error: no RA or DEC')
-                continue
-            RA2000 = source_coord.ra.deg
-            DEC2000 = source_coord.dec.deg
-               
-            if (RA2000 >= RA_min and RA2000 <= RA_max and
-                DEC2000 >= DEC_min and DEC2000 <= DEC_max):
-                frames.append(observation[0])
-                dates.append(observation[1])
-                filters.append(observation[3])
-                ra.append(observation[4])
-                dec.append(observation[5])
-                ut.append(observation[13])
-                exptime.append(observation[14])
-                typ.append(observation[16])
-                jd.append(Time(observation[1]+'T'+observation[13],
-                               format='isot',scale='utc').jd)
-                print (observation[0],observation[1],observation[3],
-                       observation[14],observation[16])
-                t_expo += observation[14]
-       
-       
-    logging.info('%i scientific images with a total exp time of %.1f\n' %
-                 (len(frames),t_expo))
-                    
-    # Save output search of scientific images
-    out_frames = frames[:]
-    out_dates = dates[:]
-    out_filters = filters[:]
-    out_ra = ra[:]
-    out_dec = dec[:]
-    out_ut = ut[:]
-    out_exptime = exptime[:]
-    out_typ = typ[:]
-                    
-    # Search calibrations for each date
-    old_date = 'first_date'
-    old_filter = 'first_filter'
-    logging.info("Searching BIAS, FLATS & DARKS in HSC")
-    for date in tqdm(jd):
-        # Search BIAS
-        if (date != old_date):
-            for it in range(2):
-                n_bias = 0
-                for index, value in enumerate(bias_jd):
-                    if (abs(value - date) < dt_bias[it]):
-                        out_frames.append(bias_frames[index])
-                        out_dates.append(bias_dates[index])
-                        out_filters.append(bias_filters[index])
-                        out_ra.append(bias_ra[index])
-                        out_dec.append(bias_dec[index])
-                        out_ut.append(bias_ut[index])
-                        out_exptime.append(bias_t_expo[index])
-                        out_typ.append(bias_data_type[index])
-                        n_bias += 1
-                    if (n_bias > min_calib):
-                        break
-                if(n_bias < min_calib):
-                    logging.warning('Only %i bias around the night of the %s.'%
-                                    (n_bias,dates[jd.index(date)]))
-                        
-        # Search FLATS
-        if (date != old_date or filters[dates.index(date)] != old_filter):
-            for it in range(2):
-                n_flats = 0
-                for index, value in enumerate(flats_jd):
-                    if (flats_filters[index] == filters[jd.index(date)] and
-                        abs(value - date) < dt_flat[0]):
-                        out_frames.append(flats_frames[index])
-                        out_dates.append(flats_dates[index])
-                        out_filters.append(flats_filters[index])
-                        out_ra.append(flats_ra[index])
-                        out_dec.append(flats_dec[index])
-                        out_ut.append(flats_ut[index])
-                        out_exptime.append(flats_t_expo[index])
-                        out_typ.append(flats_data_type[index])
-                        n_flats += 1
-                    if (n_flats > min_calib):
-                        break
-                if (n_bias < min_calib):
-                    logging.warning('Only %i flats around the night of the %s.'%
-                                    (n_flats,dates[jd.index(date)]))
-                        
-        # Search DARKS
-        if (date != old_date):
-            for it in range(2):
-                n_dark = 0
-                for index, value in enumerate(dark_jd):
-                    if (abs(value - date) < dt_dark[it]):
-                        out_frames.append(dark_frames[index])
-                        out_dates.append(dark_dates[index])
-                        out_filters.append(dark_filters[index])
-                        out_ra.append(dark_ra[index])
-                        out_dec.append(dark_dec[index])
-                        out_ut.append(dark_ut[index])
-                        out_exptime.append(dark_t_expo[index])
-                        out_typ.append(dark_data_type[index])
-                        n_dark += 1
-                    if (n_dark > min_calib):
-                        break
-                if (n_dark < min_calib):
-                    logging.warning('Only %i darks around the night of the %s.' %
-                                    (n_dark,dates[jd.index(date)]))
-                        
-        old_date = date
-                    
-    # Remove duplicated files
-    out_frames_unique, indices = np.unique(out_frames, return_index=True)
-    out_frames = [out_frames[i] for i in indices]
-    out_dates = [out_dates[i] for i in indices]
-    out_filters = [out_filters[i] for i in indices]
-    out_ra = [out_ra[i] for i in indices]
-    out_dec = [out_dec[i] for i in indices]
-    out_ut = [out_ut[i] for i in indices]
-    out_exptime = [out_exptime[i] for i in indices]
-    out_typ = [out_typ[i] for i in indices]
-                    
-    n_bias_tot = out_typ.count('BIAS') + out_typ.count('ZERO')
-    n_flats_tot = (out_typ.count('FLAT') + out_typ.count('DOMEFLAT')
-                   + out_typ.count('SKYFLAT'))
-    n_darks_tot = out_typ.count('DARK')
-                                   
-    logging.info('Total number of images BIAS = %i \n' %(n_bias_tot))
-    logging.info('Total number of images FLATS = %i \n' %(n_flats_tot))
-    logging.info('Total number of images DARKS = %i \n' %(n_darks_tot))
-    logging.info('''Total number of images (scientific + BIAS + FLATS + DARKS)
-                 = %i \n''' %(len(out_frames)))
-                                   
-    # Output file
-    logging.info("Writing mail for HSC instrument")
-    N_max = 1000 #Maximum number of images per mail
-    a = 0
-    b = N_max
-    k = 1
-    bool = True
-    while bool == True:
-        if not os.path.exists(output_directory+'/HyperSuprimeCam/'):
-            os.makedirs(output_directory+'/HyperSuprimeCam/')
-                                       
-        out_file = open(output_directory+'/HyperSuprimeCam/'+Object+
-                        '_HSC_mail_'+str(k)+'.txt', 'w')
-        out_file.write('SMOKAID \t \n \n')
-        out_file.write('PURPOSE \t Research(star formation)\n \n')
-        ascii.write([out_frames[a:b],out_dates[a:b]], out_file,
-                    names=['#FRAME_ID', 'DATE_OBS'])
-        out_file.close()
-        if len(out_frames) > b:
-            a += N_max
-            b += N_max
-            k += 1
-        else:
-            bool = False
-                                   
-    # Output file
-    list_file = open(output_directory+'/HyperSuprimeCam/'+Object+
-                     '_HSC_list.txt', 'w')
-    ascii.write([out_frames,out_dates,out_filters,out_ra,out_dec,
-                 out_ut,out_exptime,out_typ],list_file,
-                names=['#FRAME_ID', 'DATE_OBS', 'FILTER', 'RA2000',
-                       'DEC2000','UT_STR', 'EXPTIME', 'DATA_TYP'])
-    list_file.close()
-                                                                 
-    return
+    # Catalogue local (mis à jour si une nouvelle version existe)
+    catalog = smoka_catalog('HSC')
+
+    # Images scientifiques trouvées par l'index du ciel
+    index = smoka_sky_index('HSC')
+    rows = sky_box_lookup(index,RA_min,RA_max,DEC_min,DEC_max)
+
+    # Classement des observations en une seule passe sur les colonnes du
+    # catalogue.
+    (science,bias,flats,darks) = scan_catalog(catalog,rows)
+
+    # Association des calibrations et écriture des mails
+    return smoka_request(Object,'HSC',science,bias,flats,darks,dt_bias,
+                         dt_flat,dt_dark,min_calib,output_directory)
 
 ###############################################################################
 
@@ -1392,14 +1046,7 @@ if __name__ == "__main__":
 
 
     # --------- Coordonnées de l'objet en degrés ------------------
-    sd.reset_votable_fields()
-    sd.remove_votable_fields('coordinates')
-    sd.add_votable_fields('ra(d;A;ICRS)', 'dec(d;D;ICRS)')
-
-    table = sd.query_object(Object, wildcard=False)
-
-    RA_center_deg = table[0][1]
-    DEC_center_deg = table[0][2]
+    (RA_center_deg, DEC_center_deg) = simbad.object_center(Object)
 
     CENTRE = np.array([RA_center_deg, DEC_center_deg])
 